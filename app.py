@@ -1,13 +1,37 @@
-from flask import Flask, render_template, send_from_directory, request, jsonify, redirect, send_file
+from flask import (Flask, Response, render_template, send_from_directory, request, jsonify, redirect, send_file,
+                   stream_with_context)
 import os
 import logging
+import click
 from datetime import datetime
-from models import db, Client, RmrData, BodyCompositionData, UltrasoundData
-import csv
-import io
-import numpy as np
+from models import db, Client, RmrSession, OutboundEmail
 from sqlalchemy import func
-from app_routes import generate_pdf_report
+from app_routes import (generate_pdf_report, submit_pdf_report_job, pdf_report_job_status, download_pdf_report,
+                        submit_pdf_report_batch, pdf_report_batch_status, download_pdf_report_batch,
+                        client_report)
+from data_export import (DEFAULT_BATCH_SIZE as EXPORT_BATCH_SIZE, EXPORT_FORMATS, EXPORT_TABLES, export_filename,
+                         export_stream, write_export)
+from bulk_import import DEFAULT_BATCH_FILES, import_archive
+from percentile_index import record_percentiles, rebuild_percentile_index
+from cohort_analytics import DEFAULT_AGE_BAND, DEFAULT_HISTOGRAM_BINS, cached_cohort_stats
+from body_composition import (PROTOCOL_SITES, STORED_PROTOCOL, body_composition_records, stored_cohort_records,
+                              unstored_sites)
+from steady_state import detect_steady_state
+from resampling import resample_options, resample_series
+from rmr_predictions import backfill_client_predictions, predict_records
+from rmr_engine import RmrInputError, parse_rmr_csv, parse_rmr_stream, compute_rmr_stats
+from client_queries import (
+    DEFAULT_PAGE_SIZE, parse_fields, list_clients, search_clients, ensure_search_index,
+    parse_include, load_client_bundle, client_bundle_dict
+)
+from migrations import upgrade_database, migration_status
+from persistence import replace_rmr_data, replace_scan_data, replace_ultrasound_data
+from email_outbox import enqueue_email, drain_outbox, start_outbox_worker
+from report_artifacts import artifact_pdf, request_client_report
+from report_jobs import QueueFullError
+from rmr_trends import backfill_test_summaries, client_trend, record_body_composition, record_rmr_test
+from series_store import raw_points_to_columns, store_rmr_session, load_rmr_session, convert_rmr_data, series_to_json
+from rmr_pipeline import RmrTable, strip_units_row, trim_warmup, run_rmr_pipeline
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -21,12 +45,53 @@ app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key")
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///rmr_data.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Raw RMR series storage: 'rows' (one RmrData row per point, replaced on every
+# save), 'blob' (packed RmrSession kept per test date, see series_store.py) or 'both'
+app.config["RMR_STORAGE"] = os.environ.get("RMR_STORAGE", "both")
+
+# Background PDF rendering (see report_jobs.py); cache defaults to instance/pdf_cache
+app.config["PDF_CACHE_DIR"] = os.environ.get("PDF_CACHE_DIR")
+app.config["PDF_RENDER_WORKERS"] = int(os.environ.get("PDF_RENDER_WORKERS", 2))
+app.config["PDF_MAX_PENDING"] = int(os.environ.get("PDF_MAX_PENDING", 32))
+# Seconds /api/generate-pdf-report waits for its queued render before returning the job to poll
+app.config["PDF_SYNC_TIMEOUT"] = int(os.environ.get("PDF_SYNC_TIMEOUT", 60))
+# Cached PDFs, batch manifests and ZIPs older than this (seconds) are pruned; 0 keeps them
+app.config["PDF_CACHE_MAX_AGE"] = int(os.environ.get("PDF_CACHE_MAX_AGE", 7 * 24 * 3600))
+# 'wkhtmltopdf' (subprocess per report) or 'weasyprint' (in-process, optional dependency)
+app.config["PDF_RENDERER"] = os.environ.get("PDF_RENDERER", "wkhtmltopdf")
+# Outbound email (see email_outbox.py); the transport is chosen by EMAIL_TRANSPORT in email_service
+app.config["EMAIL_OUTBOX_WORKER"] = os.environ.get("EMAIL_OUTBOX_WORKER", "1") not in ("0", "false", "False")
+app.config["EMAIL_POLL_SECONDS"] = int(os.environ.get("EMAIL_POLL_SECONDS", 15))
+app.config["EMAIL_BATCH_SIZE"] = int(os.environ.get("EMAIL_BATCH_SIZE", 50))
+
+# Normative percentile index (see percentile_index.py); defaults to instance/percentile_index.npz
+app.config["PERCENTILE_INDEX_PATH"] = os.environ.get("PERCENTILE_INDEX_PATH")
+app.config["PERCENTILE_INDEX_MAX_AGE"] = int(os.environ.get("PERCENTILE_INDEX_MAX_AGE", 3600))
+
+# Client fields accepted alongside streamed RMR uploads (query string or form fields)
+RMR_CLIENT_FIELDS = ('age', 'gender', 'weight_kg', 'height_cm', 'lean_body_mass')
+
 # Initialize database
 db.init_app(app)
 
 # Create database tables
 with app.app_context():
     db.create_all()
+    upgrade_database()
+    ensure_search_index()
+    # Compile the report template and inline its logo/stylesheets once
+    try:
+        from services.pdf_service import report_assets
+        report_assets(app)
+    except Exception as e:
+        logging.warning(f"Report assets not preloaded: {str(e)}")
+
+# Deliver queued email in the background (disable to run "flask send-outbox" from cron instead).
+# Started by the first request a process serves, so CLI commands never run a second drainer.
+if app.config["EMAIL_OUTBOX_WORKER"]:
+    @app.before_request
+    def ensure_outbox_worker():
+        start_outbox_worker(app)
 
 @app.route('/')
 @app.route('/body-composition')
@@ -261,94 +326,19 @@ def save_body_composition():
         client.scan_device = client_data.get('scan_device', '')
         
         db.session.add(client)
-        db.session.commit()
+        db.session.flush()  # Assigns client.id for new clients
         
-        # Save scan data if provided
+        # Replace scan and ultrasound data if provided (same transaction as the client)
         if scan_data and len(scan_data) > 0:
-            # First, remove any existing data points for this client
-            BodyCompositionData.query.filter_by(client_id=client.id).delete()
-            
-            # Add new scan data points
-            for row in scan_data:
-                # Try to parse the scan date
-                scan_date = None
-                if row.get('Scan Date'):
-                    try:
-                        scan_date = datetime.strptime(row['Scan Date'], '%Y-%m-%d %H:%M:%S').date()
-                    except ValueError:
-                        try:
-                            scan_date = datetime.strptime(row['Scan Date'], '%Y-%m-%d').date()
-                        except ValueError:
-                            scan_date = None
-                
-                # Add important measurements as separate records
-                important_measurements = [
-                    'Height', 'Weight', 'Body Fat Percent', 'Lean Mass', 'Fat Mass',
-                    'Waist', 'Hips', 'Chest', 'Thigh Left', 'Thigh Right', 'Biceps Left', 'Biceps Right'
-                ]
-                
-                for measurement in important_measurements:
-                    if measurement in row and row[measurement]:
-                        try:
-                            value = float(row[measurement])
-                            measurement_data = BodyCompositionData()
-                            measurement_data.client_id = client.id
-                            measurement_data.scan_date = scan_date
-                            measurement_data.measurement_type = client_data.get('scan_device', 'Fit3D')
-                            measurement_data.measurement_name = measurement
-                            measurement_data.measurement_value = value
-                            measurement_data.measurement_unit = ('in' if measurement in ['Height', 'Waist', 'Hips', 'Chest', 'Thigh Left', 'Thigh Right', 'Biceps Left', 'Biceps Right'] else 
-                                               'lbs' if measurement in ['Weight', 'Lean Mass', 'Fat Mass'] else '%')
-                            db.session.add(measurement_data)
-                        except (ValueError, TypeError):
-                            pass
-            
-            db.session.commit()
+            replace_scan_data(client.id, scan_data, client_data.get('scan_device', 'Fit3D'))
         
-        # Save ultrasound data if provided
         if ultrasound_data and len(ultrasound_data) > 0:
-            # First, remove any existing ultrasound data for this client
-            UltrasoundData.query.filter_by(client_id=client.id).delete()
-            
-            # Add new ultrasound data points
-            for row in ultrasound_data:
-                # Try to parse the date
-                us_date = None
-                if row.get('Date'):
-                    try:
-                        us_date = datetime.strptime(row['Date'], '%Y-%m-%d %H-%M').date()
-                    except ValueError:
-                        try:
-                            us_date = datetime.strptime(row['Date'], '%Y-%m-%d').date()
-                        except ValueError:
-                            us_date = None
-                
-                # Add ultrasound measurements
-                ultrasound_sites = ['CH', 'WA', 'TR', 'TH', 'AX', 'SC']
-                
-                for site in ultrasound_sites:
-                    if site in row and row[site]:
-                        try:
-                            value = float(row[site])
-                            site_names = {
-                                'CH': 'Chest',
-                                'WA': 'Waist',
-                                'TR': 'Triceps',
-                                'TH': 'Thigh',
-                                'AX': 'Axilla',
-                                'SC': 'Subscapular'
-                            }
-                            
-                            us_data = UltrasoundData()
-                            us_data.client_id = client.id
-                            us_data.date = us_date
-                            us_data.site_name = site_names.get(site, site)
-                            us_data.measurement_value = value
-                            db.session.add(us_data)
-                        except (ValueError, TypeError):
-                            pass
-            
-            db.session.commit()
+            replace_ultrasound_data(client.id, ultrasound_data)
+        
+        # Body composition history for the trend endpoint
+        record_body_composition(client)
+        
+        db.session.commit()
         
         return jsonify({
             'status': 'success',
@@ -357,6 +347,7 @@ def save_body_composition():
         })
     
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error saving body composition data: {str(e)}")
         return jsonify({'status': 'error', 'message': f'Error saving data: {str(e)}'}), 500
 
@@ -417,27 +408,17 @@ def process_csv():
 def remove_units_row(csv_data):
     """Remove row 2 (units row) from CSV data."""
     try:
-        # Parse CSV
-        csv_reader = csv.reader(io.StringIO(csv_data))
-        rows = list(csv_reader)
+        table = RmrTable.from_csv(csv_data)
         
         # Debug info on CSV data
-        logger.debug(f"CSV parsing - received {len(rows)} rows")
+        logger.debug(f"CSV parsing - received {len(table.rows)} rows")
         
-        if len(rows) < 3:  # Need header + units + at least one data row
-            logger.error(f"CSV has insufficient rows: {len(rows)}")
+        processed = strip_units_row(table)
+        if processed is table:
             return csv_data  # Not enough rows to remove
+        logger.debug(f"After removing units row: {len(processed.rows)} rows")
         
-        # Remove row 2 (index 1)
-        processed_rows = [rows[0]] + rows[2:]
-        logger.debug(f"After removing units row: {len(processed_rows)} rows")
-        
-        # Convert back to CSV string
-        output = io.StringIO()
-        csv_writer = csv.writer(output)
-        csv_writer.writerows(processed_rows)
-        
-        return output.getvalue()
+        return processed.to_csv()
     
     except Exception as e:
         logger.error(f"Error removing units row: {str(e)}")
@@ -448,314 +429,211 @@ def remove_time_range(csv_data, minutes_to_remove=3):
     try:
         if minutes_to_remove <= 0:
             return csv_data  # No rows to remove
-            
-        # Parse CSV
-        csv_reader = csv.reader(io.StringIO(csv_data))
-        rows = list(csv_reader)
         
-        if len(rows) < 2:
-            return csv_data  # Not enough rows
-            
-        # Find time column
-        header_row = rows[0]
-        time_col_idx = -1
-        
-        for i, header in enumerate(header_row):
-            if header.lower() == 'time':
-                time_col_idx = i
-                break
-                
-        if time_col_idx == -1:
-            logger.warning("Time column not found, skipping time-based removal")
-            return csv_data
-            
-        # Keep header and rows after specified minutes
-        # Assuming format is "m:ss" (e.g., "0:15", "3:00")
-        header = rows[0]
-        filtered_rows = [header]
-        
-        for row in rows[1:]:
-            if len(row) <= time_col_idx:
-                continue  # Skip rows with insufficient columns
-                
-            time_str = row[time_col_idx]
-            try:
-                # Parse time (expected format "0:00" or "3:15")
-                time_parts = time_str.split(':')
-                if len(time_parts) != 2:
-                    filtered_rows.append(row)  # Keep row if can't parse time
-                    continue
-                    
-                minutes = int(time_parts[0])
-                
-                # Keep if minutes >= specified minutes to remove
-                if minutes >= minutes_to_remove:
-                    filtered_rows.append(row)
-            except:
-                # Keep row if can't parse time
-                filtered_rows.append(row)
-                
-        # Convert back to CSV string
-        output = io.StringIO()
-        csv_writer = csv.writer(output)
-        csv_writer.writerows(filtered_rows)
-        
-        return output.getvalue()
+        table = RmrTable.from_csv(csv_data)
+        processed = trim_warmup(table, {'minutesToRemove': minutes_to_remove})
+        if processed is table:
+            return csv_data  # Not enough rows or no time column
+        
+        return processed.to_csv()
     
     except Exception as e:
         logger.error(f"Error removing time range: {str(e)}")
         raise
 
+@app.route('/api/rmr-pipeline', methods=['POST'])
+def rmr_pipeline_api():
+    """Run the full RMR pipeline (units row, warm-up, steady state, stats) in one request."""
+    if not request.json:
+        return jsonify({'status': 'error', 'message': 'No data provided'}), 400
+    
+    try:
+        csv_data = request.json.get('csvData')
+        options = request.json.get('options', {}) or {}
+        client_data = request.json.get('clientData', {}) or {}
+        diagnostics = bool(request.json.get('diagnostics', False))
+        
+        if not csv_data:
+            return jsonify({'status': 'error', 'message': 'No CSV data provided'}), 400
+        
+        try:
+            resample = resample_options(request.json)
+            series, stage_log = run_rmr_pipeline(csv_data, options, diagnostics=diagnostics)
+            results = build_rmr_results(series, client_data, resample)
+        except RmrInputError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        
+        if diagnostics:
+            results['pipeline'] = stage_log
+        return jsonify(results)
+    
+    except Exception as e:
+        logger.error(f"Error running RMR pipeline: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error running RMR pipeline: {str(e)}'}), 500
+
+@app.route('/api/calculate-body-composition', methods=['POST'])
+def calculate_body_composition_api():
+    """
+    3C-Model body composition for one client, a list of clients or stored clients
+    
+    Body: a single record, {"clients": [records]} or {"client_ids": [...]} to
+    recompute saved clients from their stored water, ultrasound and scan data
+    (with the difference to the stored body_fat_percent). Records take
+    weight_kg or weight_lbs, age, gender, tbw_percent, body_density,
+    scan_body_fat, ultrasound_body_fat (measured) and sites (thickness in mm
+    per site). "protocol" selects the Jackson & Pollock site protocol ('3',
+    '4' or '7'; default '7', or '4' for saved clients, whose ultrasound data
+    has no hip site). Rows list the protocol sites they lack in missing_sites.
+    """
+    if not request.json:
+        return jsonify({'status': 'error', 'message': 'No data provided'}), 400
+    
+    try:
+        stored = 'client_ids' in request.json
+        protocol = str(request.json.get('protocol', STORED_PROTOCOL if stored else '7'))
+        if protocol not in PROTOCOL_SITES:
+            return jsonify({'status': 'error', 'message': f'Unknown protocol: {protocol}'}), 400
+        
+        if stored:
+            male_gaps, female_gaps = unstored_sites(protocol)
+            if male_gaps and female_gaps:
+                return jsonify({'status': 'error',
+                                'message': f"Protocol {protocol} needs {', '.join(sorted(set(male_gaps + female_gaps)))}, "
+                                           f"which saved ultrasound data does not include; use protocol {STORED_PROTOCOL}"}), 400
+            try:
+                client_ids = [int(i) for i in request.json['client_ids'] or []]
+            except (TypeError, ValueError):
+                return jsonify({'status': 'error', 'message': 'client_ids must be integers'}), 400
+            records = stored_cohort_records(client_ids or None)
+        elif 'clients' in request.json:
+            records = request.json['clients'] or []
+        else:
+            records = [request.json]
+        
+        if not records:
+            return jsonify({'status': 'error', 'message': 'No clients to calculate'}), 400
+        
+        try:
+            results = body_composition_records(records, protocol=protocol)
+        except (TypeError, ValueError) as e:
+            return jsonify({'status': 'error', 'message': f'Invalid input: {str(e)}'}), 400
+        
+        # Rank each 3C result against saved clients of the same sex and age band
+        percentiles = record_percentiles([
+            {'gender': record.get('gender'), 'age': record.get('age'), 'body_fat_percent': row['body_fat_3c'],
+             'lean_mass_kg': row['3c_ffm_kg'], 'height_cm': record.get('height_cm')}
+            for record, row in zip(records, results)
+        ])
+        for row, row_percentiles in zip(results, percentiles):
+            row['percentiles'] = row_percentiles
+        
+        return jsonify({'status': 'success', 'protocol': protocol, 'results': results})
+    
+    except Exception as e:
+        logger.error(f"Error calculating body composition: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error calculating body composition: {str(e)}'}), 500
+
+@app.route('/api/predict-rmr', methods=['POST'])
+def predict_rmr_api():
+    """
+    Predicted RMR (Cunningham, Mifflin-St Jeor, Harris-Benedict) for many clients at once
+    
+    Body: {"clients": [{age, gender, weight_kg, height_cm, lean_body_mass, rmr_kcal_day}, ...]}
+    or {"client_ids": [...]} for saved clients (height_cm and lean_mass_kg from the record).
+    """
+    if not request.json:
+        return jsonify({'status': 'error', 'message': 'No data provided'}), 400
+    
+    try:
+        if 'client_ids' in request.json:
+            try:
+                client_ids = [int(i) for i in request.json['client_ids'] or []]
+            except (TypeError, ValueError):
+                return jsonify({'status': 'error', 'message': 'client_ids must be integers'}), 400
+            rows = db.session.execute(
+                db.select(Client.id, Client.age, Client.gender, Client.weight_kg, Client.height_cm,
+                          Client.lean_mass_kg, Client.rmr_kcal_day).where(Client.id.in_(client_ids))
+            ).all()
+            records = [{'id': row.id, 'age': row.age, 'gender': row.gender, 'weight_kg': row.weight_kg,
+                        'height_cm': row.height_cm, 'lean_body_mass': row.lean_mass_kg,
+                        'rmr_kcal_day': row.rmr_kcal_day} for row in rows]
+        else:
+            records = request.json.get('clients') or []
+        
+        if not records:
+            return jsonify({'status': 'error', 'message': 'No clients to predict'}), 400
+        
+        try:
+            results = predict_records(records)
+        except (TypeError, ValueError) as e:
+            return jsonify({'status': 'error', 'message': f'Invalid input: {str(e)}'}), 400
+        
+        results = [{name: round(value, 2) if isinstance(value, float) else value
+                    for name, value in row.items()} for row in results]
+        return jsonify({'status': 'success', 'results': results})
+    
+    except Exception as e:
+        logger.error(f"Error predicting RMR: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error predicting RMR: {str(e)}'}), 500
+
 @app.route('/api/calculate-rmr', methods=['POST'])
 def calculate_rmr_api():
     """API endpoint for RMR calculation."""
+    if request.mimetype in ('text/csv', 'text/plain', 'multipart/form-data'):
+        return calculate_rmr_upload()
+    
     if not request.json or 'csv_data' not in request.json:
         return jsonify({'status': 'error', 'message': 'No CSV data provided'}), 400
     
     csv_data = request.json['csv_data']
     client_data = request.json.get('client_data', {}) or {}
     
-    return calculate_rmr(csv_data, client_data)
+    try:
+        resample = resample_options(request.json)
+    except RmrInputError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     
-def calculate_rmr(csv_data, client_data):
-    """Calculate RMR metrics from CSV data."""
+    return calculate_rmr(csv_data, client_data, resample)
+
+def calculate_rmr_upload():
+    """Calculate RMR from a streamed upload (raw text/csv body or multipart file field)."""
     try:
-        # Parse CSV data
-        client_data = client_data or {}
+        if request.mimetype == 'multipart/form-data':
+            upload = request.files.get('file')
+            if not upload:
+                return jsonify({'status': 'error', 'message': 'No CSV file provided'}), 400
+            stream = upload.stream
+            fields = request.form
+        else:
+            stream = request.stream
+            fields = request.args
         
-        # Create a CSV reader
-        csv_reader = csv.reader(io.StringIO(csv_data))
-        rows = list(csv_reader)
-        
-        if len(rows) < 3:  # Need at least header, units, and one data row
-            return jsonify({'status': 'error', 'message': 'CSV file has insufficient data'}), 400
-        
-        # Extract data, skipping the units row (row[1])
-        headers = rows[0]
-        data_rows = rows[2:]  # Skip the units row
-        
-        # Find column indexes
-        col_indexes = {
-            'time': headers.index('Time') if 'Time' in headers else -1,
-            'vo2_ml_min': headers.index('VO2') if 'VO2' in headers else -1,
-            'vo2_ml_kg_min': headers.index('VO2') + 1 if 'VO2' in headers else -1,  # Assuming it's the next column
-            'vco2_ml_min': headers.index('VCO2') if 'VCO2' in headers else -1,
-            'vco2_ml_kg_min': headers.index('VCO2') + 1 if 'VCO2' in headers else -1,  # Assuming it's the next column
-            'rer': headers.index('RER') if 'RER' in headers else -1
-        }
+        client_data = {key: fields[key] for key in RMR_CLIENT_FIELDS if fields.get(key)}
         
-        # Validate required columns exist
-        if -1 in col_indexes.values():
-            return jsonify({
-                'status': 'error', 
-                'message': 'Required columns not found in CSV. Needs: Time, VO2, VCO2, RER'
-            }), 400
+        try:
+            resample = resample_options(fields)
+            series = parse_rmr_stream(stream, request.mimetype_params.get('charset', 'utf-8-sig'))
+            results = build_rmr_results(series, client_data, resample)
+        except RmrInputError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
         
-        # Extract numerical data for calculations
-        vo2_values = []
-        vco2_values = []
-        rer_values = []
+        return jsonify(results)
+    
+    except Exception as e:
+        logger.error(f"Error calculating RMR from upload: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error calculating RMR: {str(e)}'}), 500
+    
+def calculate_rmr(csv_data, client_data, resample=None):
+    """Calculate RMR metrics from CSV data."""
+    try:
+        client_data = client_data or {}
         
-        for row in data_rows:
-            if len(row) <= max(col_indexes.values()):
-                continue  # Skip rows with insufficient columns
-                
-            try:
-                vo2 = float(row[col_indexes['vo2_ml_min']])
-                vco2 = float(row[col_indexes['vco2_ml_min']])
-                rer = float(row[col_indexes['rer']])
-                
-                vo2_values.append(vo2)
-                vco2_values.append(vco2)
-                rer_values.append(rer)
-            except (ValueError, IndexError) as e:
-                logger.warning(f"Skipping row due to error: {e}")
-                continue
-        
-        # Calculate averages
-        avg_vo2 = np.mean(vo2_values) if vo2_values else 0
-        avg_vco2 = np.mean(vco2_values) if vco2_values else 0
-        avg_rer = np.mean(rer_values) if rer_values else 0
-        
-        # Calculate RMR in kcal/day (Weir equation)
-        # RMR = (3.941 * VO2 + 1.106 * VCO2) * 1.44
-        rmr_kcal_day = (3.941 * avg_vo2 + 1.106 * avg_vco2) * 1.44
-        
-        # Calculate substrate oxidation (g/day)
-        # Fat oxidation = 1.67 * (VO2 - VCO2) * 1440
-        # Carbohydrate oxidation = 4.55 * VCO2 - 3.21 * VO2 * 1440
-        fat_oxidation = 1.67 * (avg_vo2 - avg_vco2) * 1.44  # g/day
-        carb_oxidation = (4.55 * avg_vco2 - 3.21 * avg_vo2) * 1.44  # g/day
-        # We're not calculating protein_oxidation anymore as requested
-        
-        # Calculate statistical metrics
-        vo2_median = np.median(vo2_values)
-        vco2_median = np.median(vco2_values)
-        rer_median = np.median(rer_values)
-        
-        # Mode approximation (using histogram bins)
-        vo2_mode = 0
-        vco2_mode = 0
-        rer_mode = 0
-        if len(vo2_values) > 0:
-            vo2_hist, vo2_bins = np.histogram(vo2_values, bins=10)
-            vo2_mode_index = np.argmax(vo2_hist)
-            vo2_mode = (vo2_bins[vo2_mode_index] + vo2_bins[vo2_mode_index+1]) / 2
-            
-            vco2_hist, vco2_bins = np.histogram(vco2_values, bins=10)
-            vco2_mode_index = np.argmax(vco2_hist)
-            vco2_mode = (vco2_bins[vco2_mode_index] + vco2_bins[vco2_mode_index+1]) / 2
-            
-            rer_hist, rer_bins = np.histogram(rer_values, bins=10)
-            rer_mode_index = np.argmax(rer_hist)
-            rer_mode = (rer_bins[rer_mode_index] + rer_bins[rer_mode_index+1]) / 2
-        
-        # Standard deviation
-        vo2_std = np.std(vo2_values)
-        vco2_std = np.std(vco2_values)
-        rer_std = np.std(rer_values)
-        
-        # Sample size
-        sample_size = len(vo2_values)
-        
-        # Coefficient of variation
-        vo2_cv = (vo2_std / avg_vo2 * 100) if avg_vo2 else 0
-        rer_cv = (rer_std / avg_rer * 100) if avg_rer else 0
-        
-        # 95% Confidence Intervals
-        # Standard Error = std / sqrt(n)
-        # 95% CI = mean ± (1.96 * SE)
-        if sample_size > 1:
-            vo2_se = vo2_std / np.sqrt(sample_size)
-            vco2_se = vco2_std / np.sqrt(sample_size)
-            rer_se = rer_std / np.sqrt(sample_size)
-            
-            vo2_ci_lower = avg_vo2 - (1.96 * vo2_se)
-            vo2_ci_upper = avg_vo2 + (1.96 * vo2_se)
-            
-            vco2_ci_lower = avg_vco2 - (1.96 * vco2_se)
-            vco2_ci_upper = avg_vco2 + (1.96 * vco2_se)
-            
-            rer_ci_lower = avg_rer - (1.96 * rer_se)
-            rer_ci_upper = avg_rer + (1.96 * rer_se)
-        else:
-            vo2_ci_lower = vo2_ci_upper = avg_vo2
-            vco2_ci_lower = vco2_ci_upper = avg_vco2
-            rer_ci_lower = rer_ci_upper = avg_rer
-        
-        # Calculate RMR bounds based on VO2 CI
-        rmr_lower_bound = (3.941 * vo2_ci_lower + 1.106 * avg_vco2) * 1.44
-        rmr_upper_bound = (3.941 * vo2_ci_upper + 1.106 * avg_vco2) * 1.44
-        
-        # Calculate substrate bounds
-        fat_lower_bound = 1.67 * (vo2_ci_lower - vco2_ci_upper) * 1.44
-        fat_upper_bound = 1.67 * (vo2_ci_upper - vco2_ci_lower) * 1.44
-        
-        glucose_lower_bound = (4.55 * vco2_ci_lower - 3.21 * vo2_ci_upper) * 1.44
-        glucose_upper_bound = (4.55 * vco2_ci_upper - 3.21 * vo2_ci_lower) * 1.44
-        
-        # Calculate predicted RMR based on client data
-        predicted_rmr = 0
-        rmr_percent_predicted = 0
-        
-        # Additional predictions
-        cunningham_rmr = 0
-        mifflin_rmr = 0 
-        harris_benedict_rmr = 0
-        
-        if client_data.get('age') and client_data.get('gender') and client_data.get('weight_kg'):
-            age = int(client_data['age'])
-            gender = client_data['gender']
-            weight_kg = float(client_data['weight_kg'])
-            
-            # Get height if provided, otherwise use defaults
-            height_cm = float(client_data.get('height_cm', 170 if gender == 'MALE' else 160))
-            
-            # Estimate lean body mass (LBM) if not provided
-            # Using rough estimation: Males ~85% of weight, Females ~75% of weight
-            lean_body_mass = float(client_data.get('lean_body_mass', 
-                                                   weight_kg * 0.85 if gender == 'MALE' else weight_kg * 0.75))
-            
-            # 1. Cunningham Equation: 500 + (22 * LBM)
-            cunningham_rmr = 500 + (22 * lean_body_mass)
-            
-            # 2. Mifflin-St Jeor Equation
-            if gender == 'MALE':
-                mifflin_rmr = (10 * weight_kg) + (6.25 * height_cm) - (5 * age) + 5
-            else:  # FEMALE
-                mifflin_rmr = (10 * weight_kg) + (6.25 * height_cm) - (5 * age) - 161
-            
-            # 3. Harris-Benedict Equation (Revised)
-            if gender == 'MALE':
-                harris_benedict_rmr = 88.362 + (13.397 * weight_kg) + (4.799 * height_cm) - (5.677 * age)
-            else:  # FEMALE
-                harris_benedict_rmr = 447.593 + (9.247 * weight_kg) + (3.098 * height_cm) - (4.330 * age)
-            
-            # Calculate the average of the three predictions
-            predicted_rmr = (cunningham_rmr + mifflin_rmr + harris_benedict_rmr) / 3
-            
-            # Calculate the percentage of measured RMR compared to the average predicted
-            if predicted_rmr > 0:
-                rmr_percent_predicted = (rmr_kcal_day / predicted_rmr) * 100
-        
-        # Prepare the results
-        results = {
-            'status': 'success',
-            'rmr_kcal_day': round(rmr_kcal_day, 2),
-            'vo2_avg': round(avg_vo2, 2),
-            'vco2_avg': round(avg_vco2, 2),
-            'rer_avg': round(avg_rer, 3),
-            'predicted_rmr': round(predicted_rmr, 2),
-            'rmr_percent_predicted': round(rmr_percent_predicted, 2),
-            'fat_oxidation': round(fat_oxidation, 2),
-            'carb_oxidation': round(carb_oxidation, 2),
-            'cunningham_rmr': round(cunningham_rmr, 2),
-            'mifflin_rmr': round(mifflin_rmr, 2), 
-            'harris_benedict_rmr': round(harris_benedict_rmr, 2),
-            
-            # Statistical metrics
-            'stats': {
-                'vo2': {
-                    'mean': round(avg_vo2, 2),
-                    'median': round(vo2_median, 2),
-                    'mode': round(vo2_mode, 2),
-                    'stdev': round(vo2_std, 2),
-                    'cv': round(vo2_cv, 2),
-                    'sample_size': sample_size,
-                    'ci_95': round(1.96 * vo2_std / np.sqrt(sample_size) if sample_size > 0 else 0, 2),
-                    'lower_bound_95_ci': round(vo2_ci_lower, 2),
-                    'upper_bound_95_ci': round(vo2_ci_upper, 2)
-                },
-                'rer': {
-                    'mean': round(avg_rer, 3),
-                    'median': round(rer_median, 3),
-                    'mode': round(rer_mode, 3),
-                    'stdev': round(rer_std, 3),
-                    'cv': round(rer_cv, 2),
-                    'sample_size': sample_size,
-                    'ci_95': round(1.96 * rer_std / np.sqrt(sample_size) if sample_size > 0 else 0, 3),
-                    'lower_bound_95_ci': round(rer_ci_lower, 3),
-                    'upper_bound_95_ci': round(rer_ci_upper, 3)
-                },
-                'rmr': {
-                    'lower_bound_95_ci_kcal_day': round(rmr_lower_bound, 2),
-                    'upper_bound_95_ci_kcal_day': round(rmr_upper_bound, 2)
-                },
-                'substrate': {
-                    'lower_bound_95_ci_glucose_g_day': round(glucose_lower_bound, 2),
-                    'upper_bound_95_ci_glucose_g_day': round(glucose_upper_bound, 2),
-                    'lower_bound_95_ci_fat_g_day': round(fat_lower_bound, 2),
-                    'upper_bound_95_ci_fat_g_day': round(fat_upper_bound, 2)
-                }
-            },
-            
-            'raw_data': {
-                'time_points': [row[col_indexes['time']] for row in data_rows if len(row) > col_indexes['time']],
-                'vo2_values': vo2_values,
-                'vco2_values': vco2_values,
-                'rer_values': rer_values
-            }
-        }
+        # Parse the selected columns into float64 arrays (units row skipped)
+        try:
+            series = parse_rmr_csv(csv_data)
+            results = build_rmr_results(series, client_data, resample)
+        except RmrInputError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
         
         return jsonify(results)
         
@@ -763,6 +641,111 @@ def calculate_rmr(csv_data, client_data):
         logger.error(f"Error calculating RMR: {str(e)}")
         return jsonify({'status': 'error', 'message': f'Error calculating RMR: {str(e)}'}), 500
 
+def build_rmr_results(series, client_data, resample=None):
+    """
+    Build the RMR response payload from parsed VO2/VCO2/RER series
+    
+    Statistics always use every sample; resample (see resampling.resample_options)
+    only shrinks the raw_data chart series.
+    """
+    vo2_values = series['vo2']
+    vco2_values = series['vco2']
+    rer_values = series['rer']
+    
+    # All statistics come from one fused reduction over the stacked signals
+    stats = compute_rmr_stats(vo2_values, vco2_values, rer_values)
+    vo2_stats = stats['vo2']
+    rer_stats = stats['rer']
+    sample_size = stats['sample_size']
+    avg_vo2 = vo2_stats['mean']
+    avg_vco2 = stats['vco2']['mean']
+    avg_rer = rer_stats['mean']
+    rmr_kcal_day = stats['rmr_kcal_day']
+    
+    # Predicted RMR from the client's age, sex and size (see rmr_predictions.py)
+    predictions = predict_records([client_data])[0]
+    cunningham_rmr = predictions['cunningham_rmr']
+    mifflin_rmr = predictions['mifflin_rmr']
+    harris_benedict_rmr = predictions['harris_benedict_rmr']
+    predicted_rmr = predictions['predicted_rmr']
+    
+    # Calculate the percentage of measured RMR compared to the average predicted
+    rmr_percent_predicted = 0
+    if predicted_rmr > 0:
+        rmr_percent_predicted = (rmr_kcal_day / predicted_rmr) * 100
+    
+    # Prepare the results
+    results = {
+        'status': 'success',
+        'rmr_kcal_day': round(rmr_kcal_day, 2),
+        'vo2_avg': round(avg_vo2, 2),
+        'vco2_avg': round(avg_vco2, 2),
+        'rer_avg': round(avg_rer, 3),
+        'predicted_rmr': round(predicted_rmr, 2),
+        'rmr_percent_predicted': round(rmr_percent_predicted, 2),
+        'fat_oxidation': round(stats['fat_oxidation'], 2),
+        'carb_oxidation': round(stats['carb_oxidation'], 2),
+        'cunningham_rmr': round(cunningham_rmr, 2),
+        'mifflin_rmr': round(mifflin_rmr, 2), 
+        'harris_benedict_rmr': round(harris_benedict_rmr, 2),
+        
+        # Statistical metrics
+        'stats': {
+            'vo2': {
+                'mean': round(avg_vo2, 2),
+                'median': round(vo2_stats['median'], 2),
+                'mode': round(vo2_stats['mode'], 2),
+                'stdev': round(vo2_stats['std'], 2),
+                'cv': round(vo2_stats['cv'], 2),
+                'sample_size': sample_size,
+                'ci_95': round(vo2_stats['ci_95'], 2),
+                'lower_bound_95_ci': round(vo2_stats['ci_lower'], 2),
+                'upper_bound_95_ci': round(vo2_stats['ci_upper'], 2)
+            },
+            'rer': {
+                'mean': round(avg_rer, 3),
+                'median': round(rer_stats['median'], 3),
+                'mode': round(rer_stats['mode'], 3),
+                'stdev': round(rer_stats['std'], 3),
+                'cv': round(rer_stats['cv'], 2),
+                'sample_size': sample_size,
+                'ci_95': round(rer_stats['ci_95'], 3),
+                'lower_bound_95_ci': round(rer_stats['ci_lower'], 3),
+                'upper_bound_95_ci': round(rer_stats['ci_upper'], 3)
+            },
+            'rmr': {
+                'lower_bound_95_ci_kcal_day': round(stats['rmr_lower_bound'], 2),
+                'upper_bound_95_ci_kcal_day': round(stats['rmr_upper_bound'], 2)
+            },
+            'substrate': {
+                'lower_bound_95_ci_glucose_g_day': round(stats['glucose_lower_bound'], 2),
+                'upper_bound_95_ci_glucose_g_day': round(stats['glucose_upper_bound'], 2),
+                'lower_bound_95_ci_fat_g_day': round(stats['fat_lower_bound'], 2),
+                'upper_bound_95_ci_fat_g_day': round(stats['fat_upper_bound'], 2)
+            }
+        },
+        
+        # Measured vs predicted RMR ranked against saved clients (see percentile_index.py)
+        'percentiles': record_percentiles([{
+            'gender': client_data.get('gender'), 'age': client_data.get('age'),
+            'rmr_percent_predicted': rmr_percent_predicted if predicted_rmr > 0 else None,
+        }])[0],
+        
+        # Lowest-CV steady-state window (see steady_state.py); None for short tests
+        'steady_state': detect_steady_state(vo2_values, vco2_values, rer_values, series['seconds']),
+        
+        'raw_data': resample_series(series, resample) if resample else {
+            'time_points': series['time_points'],
+            # Parsed elapsed seconds aligned with the value arrays (None where unparseable)
+            'time_seconds': [None if t != t else t for t in series['seconds'].tolist()],
+            'vo2_values': vo2_values.tolist(),
+            'vco2_values': vco2_values.tolist(),
+            'rer_values': rer_values.tolist()
+        }
+    }
+    
+    return results
+
 @app.route('/api/save-client', methods=['POST'])
 def save_client():
     """Save client data and RMR results."""
@@ -813,35 +796,23 @@ def save_client():
         client.protein_oxidation = float(rmr_results.get('protein_oxidation', 0)) if rmr_results.get('protein_oxidation') else None
         
         db.session.add(client)
-        db.session.commit()
+        db.session.flush()  # Assigns client.id for new clients
         
-        # Save raw data points if provided
+        # Replace raw data points if provided (same transaction as the client)
+        columns = None
         if raw_data and len(raw_data) > 0:
-            # First, remove any existing data points for this client
-            RmrData.query.filter_by(client_id=client.id).delete()
-            
-            # Add new data points
-            for row in raw_data:
-                # Create new RmrData instance
-                data_point = RmrData()
-                
-                # Set attributes
-                data_point.client_id = client.id
-                data_point.time_point = row.get('time_point', '')
-                data_point.tidal_volume = float(row.get('tidal_volume', 0)) if row.get('tidal_volume') else None
-                data_point.respiratory_rate = float(row.get('respiratory_rate', 0)) if row.get('respiratory_rate') else None
-                data_point.vo2_ml_min = float(row.get('vo2_ml_min', 0)) if row.get('vo2_ml_min') else None
-                data_point.vo2_ml_kg_min = float(row.get('vo2_ml_kg_min', 0)) if row.get('vo2_ml_kg_min') else None
-                data_point.ve_vo2 = float(row.get('ve_vo2', 0)) if row.get('ve_vo2') else None
-                data_point.feo2 = float(row.get('feo2', 0)) if row.get('feo2') else None
-                data_point.vco2_ml_min = float(row.get('vco2_ml_min', 0)) if row.get('vco2_ml_min') else None
-                data_point.vco2_ml_kg_min = float(row.get('vco2_ml_kg_min', 0)) if row.get('vco2_ml_kg_min') else None
-                data_point.ve_vco2 = float(row.get('ve_vco2', 0)) if row.get('ve_vco2') else None
-                data_point.feco2 = float(row.get('feco2', 0)) if row.get('feco2') else None
-                data_point.rer = float(row.get('rer', 0)) if row.get('rer') else None
-                db.session.add(data_point)
-            
-            db.session.commit()
+            storage = app.config["RMR_STORAGE"]
+            if storage in ('rows', 'both'):
+                replace_rmr_data(client.id, raw_data)
+            columns, time_points = raw_points_to_columns(raw_data)
+            if storage in ('blob', 'both'):
+                store_rmr_session(client.id, columns, time_points, test_date)
+        
+        # Per-test aggregates for the trend endpoint, kept for every test date
+        if rmr_results or columns is not None:
+            record_rmr_test(client, rmr_results, columns)
+        
+        db.session.commit()
         
         return jsonify({
             'status': 'success',
@@ -851,54 +822,185 @@ def save_client():
         })
         
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error saving client data: {str(e)}")
         return jsonify({'status': 'error', 'message': f'Error saving client data: {str(e)}'}), 500
 
 @app.route('/api/clients', methods=['GET'])
 def get_clients():
-    """Get a list of all clients."""
+    """Get a page of clients, most recently updated first.
+    
+    Query parameters: limit (page size), cursor (next_cursor of the previous page)
+    and fields (comma-separated Client columns; defaults to the summary fields).
+    """
     try:
-        clients = Client.query.order_by(Client.updated_at.desc()).all()
+        try:
+            fields = parse_fields(request.args.get('fields', ''))
+            limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+            clients, next_cursor = list_clients(limit, request.args.get('cursor'), fields)
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        
         return jsonify({
             'status': 'success',
-            'clients': [client.to_dict() for client in clients]
+            'clients': clients,
+            'next_cursor': next_cursor
         })
     except Exception as e:
         logger.error(f"Error retrieving clients: {str(e)}")
         return jsonify({'status': 'error', 'message': f'Error retrieving clients: {str(e)}'}), 500
 
+@app.route('/api/clients/search', methods=['GET'])
+def search_clients_api():
+    """Search clients by name with optional gender, scan device and test date filters.
+    
+    Query parameters: q, gender, scan_device, date_from, date_to (YYYY-MM-DD),
+    limit, page and fields. Name matches are ranked by relevance.
+    """
+    try:
+        try:
+            fields = parse_fields(request.args.get('fields', ''))
+            date_from = request.args.get('date_from')
+            date_to = request.args.get('date_to')
+            date_from = datetime.strptime(date_from, '%Y-%m-%d').date() if date_from else None
+            date_to = datetime.strptime(date_to, '%Y-%m-%d').date() if date_to else None
+            page = int(request.args.get('page', 1))
+            clients, has_more = search_clients(
+                request.args.get('q', ''),
+                gender=request.args.get('gender'),
+                scan_device=request.args.get('scan_device'),
+                date_from=date_from,
+                date_to=date_to,
+                limit=int(request.args.get('limit', DEFAULT_PAGE_SIZE)),
+                page=page,
+                fields=fields
+            )
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        
+        return jsonify({
+            'status': 'success',
+            'clients': clients,
+            'page': page,
+            'has_more': has_more
+        })
+    except Exception as e:
+        logger.error(f"Error searching clients: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error searching clients: {str(e)}'}), 500
+
 @app.route('/api/client/<int:client_id>', methods=['GET'])
 def get_client(client_id):
     """Get client data by ID."""
     try:
-        client = Client.query.get(client_id)
+        client = load_client_bundle(client_id, include=['rmr'])
         if not client:
             return jsonify({'status': 'error', 'message': 'Client not found'}), 404
         
-        # Get associated raw data
-        raw_data = RmrData.query.filter_by(client_id=client_id).all()
-        
         return jsonify({
             'status': 'success',
             'client': client.to_dict(),
-            'raw_data': [data.to_dict() for data in raw_data]
+            'raw_data': [data.to_dict() for data in client.rmr_points]
         })
     except Exception as e:
         logger.error(f"Error retrieving client data: {str(e)}")
         return jsonify({'status': 'error', 'message': f'Error retrieving client data: {str(e)}'}), 500
 
+@app.route('/api/client/<int:client_id>/detail', methods=['GET'])
+def get_client_detail(client_id):
+    """Get a client with RMR points, scan measurements and ultrasound sites in one bundle.
+    
+    Query parameter include= limits the collections (rmr, scans, ultrasound).
+    """
+    try:
+        try:
+            include = parse_include(request.args.get('include', ''))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        
+        client = load_client_bundle(client_id, include=include)
+        if not client:
+            return jsonify({'status': 'error', 'message': 'Client not found'}), 404
+        
+        bundle = client_bundle_dict(client, include)
+        bundle['status'] = 'success'
+        return jsonify(bundle)
+    except Exception as e:
+        logger.error(f"Error retrieving client detail: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error retrieving client detail: {str(e)}'}), 500
+
+@app.route('/api/client/<int:client_id>/rmr-sessions', methods=['GET'])
+def get_client_rmr_sessions(client_id):
+    """List a client's stored RMR sessions (headers only, no series data)."""
+    try:
+        sessions = RmrSession.query.filter_by(client_id=client_id).order_by(RmrSession.id).all()
+        return jsonify({
+            'status': 'success',
+            'sessions': [session.to_dict() for session in sessions]
+        })
+    except Exception as e:
+        logger.error(f"Error retrieving RMR sessions: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error retrieving RMR sessions: {str(e)}'}), 500
+
+@app.route('/api/rmr-sessions/<int:session_id>', methods=['GET'])
+def get_rmr_session(session_id):
+    """Get one stored RMR session's series for charting."""
+    try:
+        session = load_rmr_session(session_id)
+        if not session:
+            return jsonify({'status': 'error', 'message': 'RMR session not found'}), 404
+        
+        return jsonify({
+            'status': 'success',
+            'session_id': session['id'],
+            'client_id': session['client_id'],
+            'test_date': session['test_date'].strftime('%Y-%m-%d') if session['test_date'] else None,
+            'sample_count': session['sample_count'],
+            'raw_data': series_to_json(session['series'], session['time_points'])
+        })
+    except Exception as e:
+        logger.error(f"Error retrieving RMR session: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error retrieving RMR session: {str(e)}'}), 500
+
 @app.route('/api/generate-pdf-report', methods=['POST'])
 def pdf_report_endpoint():
     return generate_pdf_report()
 
+@app.route('/api/pdf-reports', methods=['POST'])
+def pdf_report_job_endpoint():
+    return submit_pdf_report_job()
+
+@app.route('/api/pdf-reports/<job_id>', methods=['GET'])
+def pdf_report_job_status_endpoint(job_id):
+    return pdf_report_job_status(job_id)
+
+@app.route('/api/pdf-reports/<job_id>/download', methods=['GET'])
+def pdf_report_job_download_endpoint(job_id):
+    return download_pdf_report(job_id)
+
+@app.route('/api/client/<int:client_id>/report', methods=['GET'])
+def client_report_endpoint(client_id):
+    return client_report(client_id)
+
+@app.route('/api/pdf-report-batches', methods=['POST'])
+def pdf_report_batch_endpoint():
+    return submit_pdf_report_batch()
+
+@app.route('/api/pdf-report-batches/<batch_id>', methods=['GET'])
+def pdf_report_batch_status_endpoint(batch_id):
+    return pdf_report_batch_status(batch_id)
+
+@app.route('/api/pdf-report-batches/<batch_id>/download', methods=['GET'])
+def pdf_report_batch_download_endpoint(batch_id):
+    return download_pdf_report_batch(batch_id)
+
 @app.route('/api/send-report-email', methods=['POST'])
 def send_report_email_api():
-    """Send RMR report via email to client."""
+    """Queue an RMR report email to a client; delivery happens in the outbox worker."""
     if not request.json:
         return jsonify({'status': 'error', 'message': 'No data provided'}), 400
     
     try:
-        from services.email_service import send_report_email, create_html_report
+        from services.email_service import create_html_report
         
         # Get the client and report data
         client_data = request.json.get('clientData', {})
@@ -910,7 +1012,7 @@ def send_report_email_api():
             return jsonify({'status': 'error', 'message': 'Client email address is required'}), 400
         
         # Check for SendGrid API key
-        if not os.environ.get('SENDGRID_API_KEY'):
+        if os.environ.get('EMAIL_TRANSPORT', 'sendgrid') == 'sendgrid' and not os.environ.get('SENDGRID_API_KEY'):
             return jsonify({
                 'status': 'error', 
                 'message': 'SendGrid API key is not configured. Please set the SENDGRID_API_KEY environment variable.'
@@ -926,28 +1028,39 @@ def send_report_email_api():
         # Create HTML email content
         html_content = create_html_report(client_data, report_data)
         
-        # TODO: Generate PDF and attach (future enhancement)
+        # Attach the stored report PDF for a saved client; if it is not rendered
+        # yet, one background render is queued and attached when it finishes
+        client_id = request.json.get('clientId') or client_data.get('id')
         pdf_content = None
-        
-        # Send email
-        response = send_report_email(
+        attachment_name = None
+        attachment_key = None
+        if client_id:
+            artifact = request_client_report(client_id, client_data.get('testDate') or client_data.get('test_date'))
+            if artifact:
+                attachment_name = artifact.filename
+                pdf_content = artifact_pdf(artifact)
+                if pdf_content is None:
+                    attachment_key = artifact.job_key
+        
+        # Queue the email; the request does not wait for the mail provider
+        email = enqueue_email(
             to_email=client_email,
             subject=subject,
             html_content=html_content,
-            pdf_content=pdf_content
+            pdf_content=pdf_content,
+            attachment_name=attachment_name,
+            attachment_key=attachment_key,
+            client_id=client_id
         )
         
-        if response.get('status') == 'success':
-            return jsonify({
-                'status': 'success',
-                'message': 'Email sent successfully'
-            })
-        else:
-            return jsonify({
-                'status': 'error',
-                'message': f"Failed to send email: {response.get('message')}"
-            }), 500
+        return jsonify({
+            'status': 'success',
+            'message': 'Email queued for delivery',
+            'email': email.to_dict()
+        }), 202
             
+    except QueueFullError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 503
     except ImportError as e:
         logger.error(f"Email service module not found: {str(e)}")
         return jsonify({
@@ -955,11 +1068,189 @@ def send_report_email_api():
             'message': 'Email service is not available. Please ensure the required modules are installed.'
         }), 500
     except Exception as e:
-        logger.error(f"Error sending email: {str(e)}")
+        db.session.rollback()
+        logger.error(f"Error queueing email: {str(e)}")
         return jsonify({
             'status': 'error',
             'message': f'Error sending email: {str(e)}'
         }), 500
 
+@app.route('/api/emails/<int:email_id>', methods=['GET'])
+def get_email_status(email_id):
+    """Delivery status of a queued email."""
+    email = db.session.get(OutboundEmail, email_id)
+    if not email:
+        return jsonify({'status': 'error', 'message': 'Email not found'}), 404
+    return jsonify({'status': 'success', 'email': email.to_dict()})
+
+@app.route('/api/analytics/cohort', methods=['GET'])
+def cohort_analytics_api():
+    """
+    Facility-level statistics of client metrics, aggregated in the database
+    
+    Query parameters: metrics (comma-separated, see cohort_analytics.COHORT_METRICS),
+    group_by (gender, age_band and/or scan_device), age_band (years, default 10),
+    bins (histogram bins per metric; histogram=1 for the default), gender,
+    date_from and date_to (test date, YYYY-MM-DD). Results are cached until
+    the next write to Client.
+    """
+    try:
+        args = request.args
+        try:
+            metrics = [m for m in args.get('metrics', 'body_fat_percent,rmr_percent_predicted,rer_avg').split(',') if m]
+            group_by = [g for g in args.get('group_by', '').split(',') if g]
+            bins = int(args['bins']) if args.get('bins') else (DEFAULT_HISTOGRAM_BINS if args.get('histogram') else None)
+            date_from = datetime.strptime(args['date_from'], '%Y-%m-%d').date() if args.get('date_from') else None
+            date_to = datetime.strptime(args['date_to'], '%Y-%m-%d').date() if args.get('date_to') else None
+            result, cached = cached_cohort_stats(
+                metrics=metrics, group_by=group_by, age_band=int(args.get('age_band', DEFAULT_AGE_BAND)),
+                bins=bins, date_from=date_from, date_to=date_to, gender=args.get('gender') or None,
+            )
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        
+        return jsonify(dict(result, status='success', metrics=metrics, group_by=group_by, cached=cached))
+    except Exception as e:
+        logger.error(f"Error computing cohort analytics: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error computing cohort analytics: {str(e)}'}), 500
+
+@app.route('/api/client/<int:client_id>/trend', methods=['GET'])
+def get_client_trend(client_id):
+    """
+    Longitudinal RMR and body composition series for a client
+    
+    Read from the per-test summaries (see rmr_trends.py), oldest test first;
+    date_from and date_to (YYYY-MM-DD) narrow the range.
+    """
+    try:
+        try:
+            date_from = datetime.strptime(request.args['date_from'], '%Y-%m-%d').date() \
+                if request.args.get('date_from') else None
+            date_to = datetime.strptime(request.args['date_to'], '%Y-%m-%d').date() \
+                if request.args.get('date_to') else None
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'Dates must be YYYY-MM-DD'}), 400
+        
+        trend = client_trend(client_id, date_from, date_to)
+        if not trend['test_dates'] and not db.session.get(Client, client_id):
+            return jsonify({'status': 'error', 'message': 'Client not found'}), 404
+        
+        return jsonify({'status': 'success', 'client_id': client_id, 'trend': trend})
+    except Exception as e:
+        logger.error(f"Error retrieving client trend: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error retrieving client trend: {str(e)}'}), 500
+
+@app.route('/api/export/<table_name>', methods=['GET'])
+def export_table(table_name):
+    """
+    Stream a table as a file download
+    
+    table_name is one of data_export.EXPORT_TABLES; query parameters: format
+    (csv, parquet or arrow; the last two need pyarrow) and client_id
+    (comma-separated ids). Rows are read and sent in batches.
+    """
+    try:
+        fmt = request.args.get('format', 'csv')
+        try:
+            client_ids = [int(i) for i in request.args.get('client_id', '').split(',') if i]
+            chunks = export_stream(table_name, fmt, client_ids or None)
+        except ValueError as e:
+            status = 404 if table_name not in EXPORT_TABLES else 400
+            return jsonify({'status': 'error', 'message': str(e)}), status
+        
+        return Response(
+            stream_with_context(chunks),
+            mimetype=EXPORT_FORMATS[fmt][0],
+            headers={'Content-Disposition': f'attachment; filename="{export_filename(table_name, fmt)}"'},
+        )
+    except Exception as e:
+        logger.error(f"Error exporting {table_name}: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error exporting data: {str(e)}'}), 500
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending schema migrations to the configured database."""
+    applied = upgrade_database()
+    if not applied:
+        print("Database is up to date")
+    for version, name in applied:
+        print(f"Applied {version}: {name}")
+
+@app.cli.command('db-status')
+def db_status_command():
+    """Show which schema migrations have been applied."""
+    for version, name, done in migration_status():
+        print(f"{version:4d}  {'applied' if done else 'pending':8}  {name}")
+
+@app.cli.command('convert-rmr-data')
+@click.option('--client-id', 'client_ids', type=int, multiple=True, help='Only convert these clients')
+@click.option('--dtype', type=click.Choice(['float32', 'float64']), default='float32')
+@click.option('--codec', type=click.Choice(['zlib', 'raw']), default='zlib')
+@click.option('--delete-rows', is_flag=True, help='Remove the RmrData rows after conversion')
+def convert_rmr_data_command(client_ids, dtype, codec, delete_rows):
+    """Convert per-point RmrData rows into packed RmrSession blobs."""
+    converted = convert_rmr_data(list(client_ids) or None, dtype, codec, delete_rows)
+    print(f"Converted {converted} client(s)")
+
+@app.cli.command('backfill-rmr-predictions')
+@click.option('--client-id', 'client_ids', type=int, multiple=True, help='Only update these clients')
+@click.option('--dry-run', is_flag=True, help='Report how many clients would change without writing')
+def backfill_rmr_predictions_command(client_ids, dry_run):
+    """Recompute predicted_rmr and rmr_percent_predicted for stored clients."""
+    changed = backfill_client_predictions(list(client_ids) or None, dry_run=dry_run)
+    print(f"{'Would update' if dry_run else 'Updated'} {changed} client(s)")
+
+@app.cli.command('backfill-test-summaries')
+@click.option('--client-id', 'client_ids', type=int, multiple=True, help='Only rebuild these clients')
+def backfill_test_summaries_command(client_ids):
+    """Rebuild the per-test trend summaries from stored clients and RMR sessions."""
+    written = backfill_test_summaries(list(client_ids) or None)
+    print(f"Wrote {written} test summar{'y' if written == 1 else 'ies'}")
+
+@app.cli.command('build-percentile-index')
+def build_percentile_index_command():
+    """Rebuild the normative percentile index from every saved client (run from cron)."""
+    index = rebuild_percentile_index()
+    for metric, values in index.values.items():
+        print(f"{metric}: {len(values)} reference values")
+
+@app.cli.command('export-data')
+@click.argument('table_name', type=click.Choice(list(EXPORT_TABLES)))
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), default='csv')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='Defaults to <table>_<date>.<ext>')
+@click.option('--client-id', 'client_ids', type=int, multiple=True, help='Only export these clients')
+@click.option('--batch-size', type=int, default=EXPORT_BATCH_SIZE, help='Rows fetched and written per batch')
+def export_data_command(table_name, fmt, output, client_ids, batch_size):
+    """Export a table as CSV, Parquet or Arrow, streaming it in batches."""
+    output = output or export_filename(table_name, fmt)
+    try:
+        with open(output, 'wb') as f:
+            written = write_export(f, table_name, fmt, list(client_ids) or None, batch_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"Wrote {written} bytes to {output}")
+
+@app.cli.command('import-archive')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False),
+              help='CSV mapping file paths to client name, age, gender, height, weight and test date')
+@click.option('--workers', type=int, default=None, help='Parser processes (defaults to the CPU count)')
+@click.option('--batch-files', type=int, default=DEFAULT_BATCH_FILES, help='Files written per transaction')
+def import_archive_command(directory, manifest, workers, batch_files):
+    """Import legacy metabolic-cart, 3D scan and ultrasound CSVs; rerunning skips imported files."""
+    try:
+        counts = import_archive(directory, manifest, workers, batch_files)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"Imported {counts['imported']}, skipped {counts['skipped']} already imported, "
+          f"{counts['duplicates']} duplicate(s) in the archive, failed {counts['failed']}")
+
+@app.cli.command('send-outbox')
+@click.option('--batch-size', type=int, default=None, help='Messages sent per transport connection')
+def send_outbox_command(batch_size):
+    """Send every queued email that is due."""
+    counts = drain_outbox(batch_size=batch_size or app.config['EMAIL_BATCH_SIZE'])
+    print(f"Sent {counts['sent']}, retrying {counts['retried']}, failed {counts['failed']}")
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -1,52 +1,236 @@
-from flask import send_file, request, jsonify
-import io
+from flask import current_app, send_file, request, jsonify, url_for
+from concurrent.futures import TimeoutError as RenderTimeout
 from datetime import datetime
 import json
 import logging
 
+from report_jobs import QueueFullError, get_render_queue, report_cache_key
+from report_artifacts import (client_report_inputs, record_artifact, record_download, report_filename,
+                              request_client_report)
+
+# Largest number of reports accepted in one batch request
+MAX_BATCH_REPORTS = 500
+
+def _report_inputs(data):
+    """Pull the report inputs out of a PDF request payload."""
+    return (
+        data.get('client_data', {}),
+        data.get('scan_data', {}),
+        data.get('ultrasound_data', {}),
+        data.get('body_density'),
+        data.get('body_fat_results', {}),
+    )
+
+def _record_payload_artifact(client_data, key, filename):
+    """Remember the render for a saved client's test date so report emails can reuse it."""
+    try:
+        record_download(client_data, key, filename)
+    except Exception as e:
+        logging.warning(f"Could not record report artifact: {str(e)}")
+
 # PDF generation route
 def generate_pdf_report():
-    """Generate a PDF report for body composition."""
+    """
+    Generate a PDF report for body composition
+    
+    The render goes through the bounded render queue like /api/pdf-reports
+    (503 when it is full); this request waits up to PDF_SYNC_TIMEOUT for the
+    PDF and otherwise returns the job to poll (202).
+    """
     try:
         # Check if request contains data
         if not request.json:
             return jsonify({'status': 'error', 'message': 'No data provided'}), 400
-            
+
         # Get data from request
-        data = request.json
-        client_data = data.get('client_data', {})
-        scan_data = data.get('scan_data', {})
-        ultrasound_data = data.get('ultrasound_data', {})
-        body_density = data.get('body_density')
-        body_fat_results = data.get('body_fat_results', {})
+        inputs = _report_inputs(request.json)
+        client_data = inputs[0]
+        date_str = datetime.now().strftime('%Y-%m-%d')
+        filename = report_filename(client_data, date_str)
+
+        # Serve a previously rendered copy of the same report if there is one,
+        # otherwise queue the render (HTML here, wkhtmltopdf in the pool)
+        queue = get_render_queue()
+        key = report_cache_key(*inputs, date_str)
+        if not queue.cached(key):
+            from services.pdf_service import render_body_composition_html
+            html_content = render_body_composition_html(*inputs, report_date=date_str)
+            queue.submit(key, html_content, filename)
+
+        try:
+            path = queue.wait(key, timeout=current_app.config.get('PDF_SYNC_TIMEOUT', 60))
+        except RenderTimeout:
+            return jsonify(_job_response(queue.status(key))), 202
+        if not path:
+            job = queue.status(key)
+            return jsonify({'status': 'error',
+                            'message': f"Error generating PDF: {job.get('message', job['status'])}"}), 500
+        _record_payload_artifact(client_data, key, filename)
+
+        # Return PDF as download
+        return send_file(path, mimetype='application/pdf', as_attachment=True, download_name=filename)
+
+    except QueueFullError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 503
+    except Exception as e:
+        logging.error(f"Error generating PDF report: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error generating PDF: {str(e)}'}), 500
+
+def _job_response(job):
+    """Add status and download URLs to a render job status."""
+    job = dict(job)
+    job['status_url'] = url_for('pdf_report_job_status_endpoint', job_id=job['job_id'])
+    if job['status'] == 'done':
+        job['download_url'] = url_for('pdf_report_job_download_endpoint', job_id=job['job_id'])
+    return job
+
+def submit_pdf_report_job():
+    """Queue a PDF report render; returns immediately with a job id."""
+    try:
+        if not request.json:
+            return jsonify({'status': 'error', 'message': 'No data provided'}), 400
+
+        inputs = _report_inputs(request.json)
+        date_str = datetime.now().strftime('%Y-%m-%d')
+        queue = get_render_queue()
+        key = report_cache_key(*inputs, date_str)
+
+        if queue.cached(key):
+            job = queue.status(key)
+        else:
+            # HTML is rendered here (needs the app context); only wkhtmltopdf runs in the pool
+            from services.pdf_service import render_body_composition_html
+            html_content = render_body_composition_html(*inputs, report_date=date_str)
+            job = queue.submit(key, html_content, report_filename(inputs[0], date_str))
+        _record_payload_artifact(inputs[0], key, queue.filename(key))
+
+        return jsonify(_job_response(job)), 200 if job['status'] == 'done' else 202
+
+    except QueueFullError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 503
+    except Exception as e:
+        logging.error(f"Error queueing PDF report: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error queueing PDF: {str(e)}'}), 500
+
+def pdf_report_job_status(job_id):
+    """Report the state of a queued PDF render."""
+    job = get_render_queue().status(job_id)
+    if job['status'] == 'unknown':
+        return jsonify({'status': 'error', 'message': 'Report job not found'}), 404
+    return jsonify(_job_response(job))
+
+def download_pdf_report(job_id):
+    """Download a finished PDF render."""
+    queue = get_render_queue()
+    path = queue.cached(job_id)
+    if not path:
+        job = queue.status(job_id)
+        if job['status'] == 'unknown':
+            return jsonify({'status': 'error', 'message': 'Report job not found'}), 404
+        return jsonify(_job_response(job)), 409
+    return send_file(path, mimetype='application/pdf', as_attachment=True,
+                     download_name=queue.filename(job_id))
+
+def _batch_response(batch):
+    """Add status and download URLs to a batch status."""
+    batch = dict(batch)
+    batch['status_url'] = url_for('pdf_report_batch_status_endpoint', batch_id=batch['batch_id'])
+    if batch['status'] == 'done':
+        batch['download_url'] = url_for('pdf_report_batch_download_endpoint', batch_id=batch['batch_id'])
+    return batch
+
+def submit_pdf_report_batch():
+    """
+    Queue PDF reports for many stored clients at once
+    
+    Body: {"client_ids": [...]} or {"date_from": "YYYY-MM-DD", "date_to": "YYYY-MM-DD"}
+    (test_date range). Returns a batch id; poll its status and download the ZIP when done.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        client_ids = data.get('client_ids')
+        date_from = data.get('date_from')
+        date_to = data.get('date_to')
+        if not client_ids and not (date_from or date_to):
+            return jsonify({'status': 'error', 'message': 'Provide client_ids or a date_from/date_to range'}), 400
         
-        # Import PDF service
-        from services.pdf_service import generate_body_composition_report
+        try:
+            client_ids = [int(i) for i in client_ids] if client_ids else None
+            date_from = datetime.strptime(date_from, '%Y-%m-%d').date() if date_from else None
+            date_to = datetime.strptime(date_to, '%Y-%m-%d').date() if date_to else None
+        except (TypeError, ValueError) as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
         
-        # Generate PDF
-        pdf_content = generate_body_composition_report(
-            client_data, 
-            scan_data, 
-            ultrasound_data, 
-            body_density,
-            body_fat_results
-        )
+        from client_queries import load_client_bundles
+        from models import db
+        clients = load_client_bundles(client_ids, date_from, date_to, include=['scans', 'ultrasound'],
+                                      limit=MAX_BATCH_REPORTS + 1)
+        if not clients:
+            return jsonify({'status': 'error', 'message': 'No clients found'}), 404
+        if len(clients) > MAX_BATCH_REPORTS:
+            return jsonify({'status': 'error',
+                            'message': f'Batches are limited to {MAX_BATCH_REPORTS} reports'}), 400
         
-        # Generate filename based on client name and date
-        client_name = f"{client_data.get('first_name', '')}_{client_data.get('last_name', '')}".strip()
-        if not client_name:
-            client_name = "Client"
+        # HTML needs the app context, so it is rendered here; the PDFs render in the pool
+        from services.pdf_service import render_body_composition_html
         date_str = datetime.now().strftime('%Y-%m-%d')
-        filename = f"Body_Composition_{client_name}_{date_str}.pdf"
-        
-        # Return PDF as download
-        return send_file(
-            io.BytesIO(pdf_content),
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name=filename
-        )
+        jobs = []
+        for client in clients:
+            inputs = client_report_inputs(client)
+            key = report_cache_key(*inputs, date_str)
+            html_content = render_body_composition_html(*inputs, report_date=date_str)
+            jobs.append((key, html_content, report_filename(inputs[0], date_str)))
+            record_artifact(client.id, client.test_date, key, jobs[-1][2],
+                            inputs_key=report_cache_key(*inputs), commit=False)
+        db.session.commit()
         
+        queue = get_render_queue()
+        batch = queue.batch_status(queue.submit_batch(jobs))
+        return jsonify(_batch_response(batch)), 200 if batch['status'] == 'done' else 202
+    
     except Exception as e:
-        logging.error(f"Error generating PDF report: {str(e)}")
-        return jsonify({'status': 'error', 'message': f'Error generating PDF: {str(e)}'}), 500
\ No newline at end of file
+        logging.error(f"Error queueing PDF report batch: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error queueing PDF batch: {str(e)}'}), 500
+
+def pdf_report_batch_status(batch_id):
+    """Report the progress of a PDF report batch."""
+    batch = get_render_queue().batch_status(batch_id)
+    if batch is None:
+        return jsonify({'status': 'error', 'message': 'Report batch not found'}), 404
+    return jsonify(_batch_response(batch))
+
+def download_pdf_report_batch(batch_id):
+    """Download every PDF of a finished batch as one ZIP."""
+    queue = get_render_queue()
+    batch = queue.batch_status(batch_id)
+    if batch is None:
+        return jsonify({'status': 'error', 'message': 'Report batch not found'}), 404
+    path = queue.batch_zip(batch_id)
+    if not path:
+        return jsonify(_batch_response(batch)), 409
+    return send_file(path, mimetype='application/zip', as_attachment=True,
+                     download_name=f"Body_Composition_Reports_{datetime.now().strftime('%Y-%m-%d')}.zip")
+
+def client_report(client_id):
+    """
+    Report PDF for a saved client's test date (query parameter test_date, defaults to the client's)
+    
+    Serves the stored artifact when it is rendered; otherwise queues (or joins) its
+    render and returns the job status, as /api/pdf-reports does.
+    """
+    try:
+        artifact = request_client_report(client_id, request.args.get('test_date'))
+        if artifact is None:
+            return jsonify({'status': 'error', 'message': 'Client or test date not found'}), 404
+        queue = get_render_queue()
+        path = queue.cached(artifact.job_key)
+        if path:
+            return send_file(path, mimetype='application/pdf', as_attachment=True,
+                             download_name=artifact.filename)
+        return jsonify(_job_response(queue.status(artifact.job_key))), 202
+    
+    except QueueFullError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 503
+    except Exception as e:
+        logging.error(f"Error loading client report: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Error loading report: {str(e)}'}), 500
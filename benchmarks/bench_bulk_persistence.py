@@ -0,0 +1,114 @@
+"""
+Benchmark: per-object ORM saves vs. the bulk persistence layer
+
+Saves a 2,000-point RMR session and a 500-row scan history (12 measurements
+per row) through the original db.session.add loop and through persistence.py.
+
+Usage:
+    python benchmarks/bench_bulk_persistence.py [--database sqlite:///bench.db] [--repeat 3]
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+
+from models import db, Client, RmrData, BodyCompositionData  # noqa: E402
+from persistence import (  # noqa: E402
+    SCAN_MEASUREMENTS, replace_rmr_data, replace_scan_data, scan_unit,
+)
+
+
+def make_payloads(rmr_points, scan_rows):
+    raw_data = [{
+        'time_point': f"{(i * 4) // 60}:{(i * 4) % 60:02d}",
+        'tidal_volume': '0.55', 'respiratory_rate': '12',
+        'vo2_ml_min': str(250 + i % 17), 'vo2_ml_kg_min': '3.3', 've_vo2': '30', 'feo2': '16.5',
+        'vco2_ml_min': str(205 + i % 13), 'vco2_ml_kg_min': '2.7', 've_vco2': '33', 'feco2': '4.1',
+        'rer': '0.82',
+    } for i in range(rmr_points)]
+    scan_data = [dict({'Scan Date': f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}"},
+                      **{name: str(10 + j + i % 5) for j, name in enumerate(SCAN_MEASUREMENTS)})
+                 for i in range(scan_rows)]
+    return raw_data, scan_data
+
+
+def legacy_save(client_id, raw_data, scan_data):
+    """The original save_client / save_body_composition loops."""
+    RmrData.query.filter_by(client_id=client_id).delete()
+    for row in raw_data:
+        point = RmrData()
+        point.client_id = client_id
+        point.time_point = row.get('time_point', '')
+        for field in ('tidal_volume', 'respiratory_rate', 'vo2_ml_min', 'vo2_ml_kg_min', 've_vo2', 'feo2',
+                      'vco2_ml_min', 'vco2_ml_kg_min', 've_vco2', 'feco2', 'rer'):
+            setattr(point, field, float(row[field]) if row.get(field) else None)
+        db.session.add(point)
+    db.session.commit()
+
+    BodyCompositionData.query.filter_by(client_id=client_id).delete()
+    for row in scan_data:
+        scan_date = datetime.strptime(row['Scan Date'], '%Y-%m-%d').date()
+        for measurement in SCAN_MEASUREMENTS:
+            item = BodyCompositionData()
+            item.client_id = client_id
+            item.scan_date = scan_date
+            item.measurement_type = 'Fit3D'
+            item.measurement_name = measurement
+            item.measurement_value = float(row[measurement])
+            item.measurement_unit = scan_unit(measurement)
+            db.session.add(item)
+    db.session.commit()
+
+
+def bulk_save(client_id, raw_data, scan_data):
+    replace_rmr_data(client_id, raw_data)
+    replace_scan_data(client_id, scan_data, 'Fit3D')
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', default='sqlite://')
+    parser.add_argument('--rmr-points', type=int, default=2000)
+    parser.add_argument('--scan-rows', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    db.init_app(app)
+    raw_data, scan_data = make_payloads(args.rmr_points, args.scan_rows)
+
+    with app.app_context():
+        db.create_all()
+        client = Client(first_name='Bench', last_name='Mark')
+        db.session.add(client)
+        db.session.commit()
+        client_id = client.id
+
+        results = {}
+        for label, fn in (('legacy ORM loop', legacy_save), ('bulk executemany', bulk_save)):
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                fn(client_id, raw_data, scan_data)
+                timings.append(time.perf_counter() - start)
+                db.session.expunge_all()
+            results[label] = min(timings)
+            counts = (RmrData.query.filter_by(client_id=client_id).count(),
+                      BodyCompositionData.query.filter_by(client_id=client_id).count())
+            print(f"{label:17}: {results[label] * 1000:8.1f} ms  (rows: rmr={counts[0]}, scan={counts[1]})")
+
+        db.drop_all()
+
+    print(f"speedup          : {results['legacy ORM loop'] / results['bulk executemany']:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Benchmark: client detail loading, lazy per-collection queries vs. eager bundle
+
+Counts the SQL statements issued while loading and serializing one client with
+its RMR points, scan measurements and ultrasound sites, and fails if the
+eager bundle needs more than one query per collection plus one for the client.
+
+Usage:
+    python benchmarks/bench_client_detail.py [--clients 50] [--rmr-points 300]
+"""
+
+import argparse
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from models import db, Client, RmrData, BodyCompositionData, UltrasoundData  # noqa: E402
+from client_queries import CLIENT_COLLECTIONS, load_client_bundle, client_bundle_dict  # noqa: E402
+from persistence import replace_rmr_data, replace_scan_data, replace_ultrasound_data  # noqa: E402
+
+
+@contextmanager
+def count_queries(engine):
+    """Count statements executed on the engine inside the block."""
+    counter = {'queries': 0}
+
+    def before_cursor_execute(*args):
+        counter['queries'] += 1
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def legacy_detail(client_id):
+    """Client plus one filter_by query per child table, as get_client did."""
+    client = db.session.get(Client, client_id)
+    return {
+        'client': client.to_dict(),
+        'raw_data': [d.to_dict() for d in RmrData.query.filter_by(client_id=client_id).all()],
+        'scan_data': [d.to_dict() for d in BodyCompositionData.query.filter_by(client_id=client_id).all()],
+        'ultrasound_data': [d.to_dict() for d in UltrasoundData.query.filter_by(client_id=client_id).all()],
+    }
+
+
+def lazy_detail(client_id):
+    """Client plus relationship lazy loads (one query per collection access)."""
+    return client_bundle_dict(db.session.get(Client, client_id))
+
+
+def bundle_detail(client_id):
+    return client_bundle_dict(load_client_bundle(client_id))
+
+
+def lazy_listing(client_ids):
+    """The N+1 pattern: every client in a list touches its collections lazily."""
+    return [client_bundle_dict(db.session.get(Client, cid)) for cid in client_ids]
+
+
+def bundle_listing(client_ids):
+    from sqlalchemy.orm import selectinload
+    clients = Client.query.filter(Client.id.in_(client_ids)).options(
+        *[selectinload(getattr(Client, attr)) for attr in CLIENT_COLLECTIONS.values()]
+    ).all()
+    return [client_bundle_dict(c) for c in clients]
+
+
+def seed(n_clients, rmr_points):
+    ids = []
+    for i in range(n_clients):
+        client = Client(first_name=f'C{i}', last_name='Bench')
+        db.session.add(client)
+        db.session.flush()
+        replace_rmr_data(client.id, [{'time_point': f'{j}', 'vo2_ml_min': '250', 'rer': '0.8'}
+                                     for j in range(rmr_points)])
+        replace_scan_data(client.id, [{'Scan Date': '2024-01-01', 'Weight': '180', 'Waist': '32'}] * 10)
+        replace_ultrasound_data(client.id, [{'Date': '2024-01-01', 'CH': '5', 'WA': '12', 'TH': '9'}] * 3)
+        ids.append(client.id)
+    db.session.commit()
+    return ids
+
+
+def measure(engine, fn, arg):
+    db.session.expunge_all()
+    with count_queries(engine) as counter:
+        start = time.perf_counter()
+        fn(arg)
+        elapsed = time.perf_counter() - start
+    return counter['queries'], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--rmr-points', type=int, default=300)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        ids = seed(args.clients, args.rmr_points)
+        engine = db.engine
+
+        print("single client detail:")
+        for label, fn in (('legacy filter_by', legacy_detail), ('lazy relationships', lazy_detail),
+                          ('eager bundle', bundle_detail)):
+            queries, elapsed = measure(engine, fn, ids[0])
+            print(f"  {label:20}: {queries:4d} queries {elapsed * 1000:8.2f} ms")
+        bundle_queries, _ = measure(engine, bundle_detail, ids[0])
+        assert bundle_queries <= 1 + len(CLIENT_COLLECTIONS), bundle_queries
+
+        print(f"{len(ids)} client listing with collections:")
+        for label, fn in (('lazy (N+1)', lazy_listing), ('selectin eager', bundle_listing)):
+            queries, elapsed = measure(engine, fn, ids)
+            print(f"  {label:20}: {queries:4d} queries {elapsed * 1000:8.2f} ms")
+        listing_queries, _ = measure(engine, bundle_listing, ids)
+        assert listing_queries <= 1 + len(CLIENT_COLLECTIONS), listing_queries
+
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
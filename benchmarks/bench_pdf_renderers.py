@@ -0,0 +1,113 @@
+"""
+Benchmark: PDF renderer backends
+
+Renders the same one-page report HTML through
+  legacy      pdfkit.from_string per call (binary lookup + wkhtmltopdf spawn each time)
+  wkhtmltopdf WkhtmltopdfRenderer with its cached configuration
+  pool        a warm ProcessPoolExecutor as used by report_jobs.ReportRenderQueue
+  weasyprint  WeasyPrintRenderer in-process (skipped if WeasyPrint is not installed)
+and reports reports/sec and p50/p95 latency for each.
+
+Usage:
+    python benchmarks/bench_pdf_renderers.py [--reports 40] [--workers 2] [--backends legacy,wkhtmltopdf,pool,weasyprint]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdfkit  # noqa: E402
+
+import pdf_service  # noqa: E402
+from pdf_service import PDF_OPTIONS, get_renderer  # noqa: E402
+
+
+def sample_html():
+    """A self-contained page about the size of a body composition report."""
+    rows = ''.join(
+        f"<tr><td>Site {i}</td><td>{10 + i * 0.7:.1f} mm</td><td>{18 + i * 0.3:.1f} %</td></tr>"
+        for i in range(24)
+    )
+    return f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><style>
+body {{ font-family: sans-serif; color: #333; }}
+h1 {{ color: #1c4e80; border-bottom: 2px solid #1c4e80; }}
+table {{ width: 100%; border-collapse: collapse; }}
+td {{ border-bottom: 1px solid #ddd; padding: 4px; }}
+</style></head><body>
+<h1>Body Composition Assessment</h1>
+<p>Client: Jane Doe &middot; Test date: 2024-05-01</p>
+<table>{rows}</table>
+</body></html>"""
+
+
+def _time_serial(render, html, reports):
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(reports):
+        t0 = time.perf_counter()
+        render(html)
+        latencies.append(time.perf_counter() - t0)
+    return time.perf_counter() - started, latencies
+
+
+def _pool_init(name):
+    pdf_service.get_renderer(name)
+
+
+def _pool_render(name, html):
+    t0 = time.perf_counter()
+    pdf_service.html_to_pdf(html, renderer=name)
+    return time.perf_counter() - t0
+
+
+def _time_pool(html, reports, workers):
+    with ProcessPoolExecutor(max_workers=workers, initializer=_pool_init, initargs=('wkhtmltopdf',)) as pool:
+        # Warm every worker before timing
+        list(pool.map(_pool_render, ['wkhtmltopdf'] * workers, [html] * workers))
+        started = time.perf_counter()
+        latencies = list(pool.map(_pool_render, ['wkhtmltopdf'] * reports, [html] * reports))
+        return time.perf_counter() - started, latencies
+
+
+def report(name, elapsed, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(round(0.95 * (len(latencies) - 1))))]
+    print(f"{name:<12} {len(latencies) / elapsed:8.2f} reports/s   "
+          f"p50 {statistics.median(latencies) * 1000:8.1f} ms   p95 {p95 * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reports', type=int, default=40)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--backends', default='legacy,wkhtmltopdf,pool,weasyprint')
+    args = parser.parse_args()
+
+    html = sample_html()
+    backends = [b.strip() for b in args.backends.split(',') if b.strip()]
+
+    for backend in backends:
+        try:
+            if backend == 'legacy':
+                elapsed, latencies = _time_serial(
+                    lambda h: pdfkit.from_string(h, False, options=PDF_OPTIONS), html, args.reports)
+            elif backend == 'pool':
+                elapsed, latencies = _time_pool(html, args.reports, args.workers)
+            else:
+                renderer = get_renderer(backend)
+                renderer.render(html)  # warm-up
+                elapsed, latencies = _time_serial(renderer.render, html, args.reports)
+        except (ImportError, OSError, IOError) as e:
+            print(f"{backend:<12} skipped: {e}")
+            continue
+        report(backend, elapsed, latencies)
+
+
+if __name__ == '__main__':
+    main()
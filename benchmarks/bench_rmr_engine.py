@@ -0,0 +1,145 @@
+"""
+Benchmark: columnar RMR engine vs. the original row-loop calculate_rmr
+
+Usage:
+    python benchmarks/bench_rmr_engine.py [--rows 20000] [--repeat 5]
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rmr_engine import parse_rmr_csv, compute_rmr_stats  # noqa: E402
+
+HEADERS = ['Time', 'VT', 'RF', 'VO2', 'VO2/kg', 'VE/VO2', 'FeO2',
+           'VCO2', 'VCO2/kg', 'VE/VCO2', 'FeCO2', 'RER']
+UNITS = ['m:ss', 'L', 'b/min', 'ml/min', 'ml/min/kg', '', '%',
+         'ml/min', 'ml/min/kg', '', '%', '']
+
+
+def make_csv(n_rows, seed=0):
+    """Build a synthetic breath-by-breath export with a header and units row."""
+    rng = np.random.default_rng(seed)
+    vo2 = rng.normal(250, 25, n_rows)
+    vco2 = vo2 * rng.normal(0.82, 0.04, n_rows)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(HEADERS)
+    writer.writerow(UNITS)
+    for i in range(n_rows):
+        seconds = i * 4
+        writer.writerow([f"{seconds // 60}:{seconds % 60:02d}", '0.55', '12',
+                         f"{vo2[i]:.1f}", f"{vo2[i] / 75:.2f}", '30', '16.5',
+                         f"{vco2[i]:.1f}", f"{vco2[i] / 75:.2f}", '33', '4.1',
+                         f"{vco2[i] / vo2[i]:.3f}"])
+    return out.getvalue()
+
+
+def legacy_calculate(csv_data):
+    """The original per-row implementation, kept here as the baseline."""
+    rows = list(csv.reader(io.StringIO(csv_data)))
+    headers = rows[0]
+    data_rows = rows[2:]
+    col_indexes = {
+        'time': headers.index('Time'),
+        'vo2_ml_min': headers.index('VO2'),
+        'vo2_ml_kg_min': headers.index('VO2') + 1,
+        'vco2_ml_min': headers.index('VCO2'),
+        'vco2_ml_kg_min': headers.index('VCO2') + 1,
+        'rer': headers.index('RER'),
+    }
+    vo2_values, vco2_values, rer_values = [], [], []
+    for row in data_rows:
+        if len(row) <= max(col_indexes.values()):
+            continue
+        try:
+            vo2 = float(row[col_indexes['vo2_ml_min']])
+            vco2 = float(row[col_indexes['vco2_ml_min']])
+            rer = float(row[col_indexes['rer']])
+            vo2_values.append(vo2)
+            vco2_values.append(vco2)
+            rer_values.append(rer)
+        except (ValueError, IndexError):
+            continue
+
+    avg_vo2 = np.mean(vo2_values)
+    avg_vco2 = np.mean(vco2_values)
+    avg_rer = np.mean(rer_values)
+    modes = []
+    for values in (vo2_values, vco2_values, rer_values):
+        hist, bins = np.histogram(values, bins=10)
+        i = np.argmax(hist)
+        modes.append((bins[i] + bins[i + 1]) / 2)
+    vo2_std = np.std(vo2_values)
+    rer_std = np.std(rer_values)
+    return {
+        'rmr_kcal_day': round((3.941 * avg_vo2 + 1.106 * avg_vco2) * 1.44, 2),
+        'vo2_mean': round(avg_vo2, 2),
+        'vo2_median': round(np.median(vo2_values), 2),
+        'vo2_mode': round(modes[0], 2),
+        'vo2_stdev': round(vo2_std, 2),
+        'rer_mean': round(avg_rer, 3),
+        'rer_median': round(np.median(rer_values), 3),
+        'rer_mode': round(modes[2], 3),
+        'rer_stdev': round(rer_std, 3),
+        'time_points': len([r for r in data_rows if len(r) > col_indexes['time']]),
+    }
+
+
+def engine_calculate(csv_data):
+    series = parse_rmr_csv(csv_data)
+    stats = compute_rmr_stats(series['vo2'], series['vco2'], series['rer'])
+    return {
+        'rmr_kcal_day': round(stats['rmr_kcal_day'], 2),
+        'vo2_mean': round(stats['vo2']['mean'], 2),
+        'vo2_median': round(stats['vo2']['median'], 2),
+        'vo2_mode': round(stats['vo2']['mode'], 2),
+        'vo2_stdev': round(stats['vo2']['std'], 2),
+        'rer_mean': round(stats['rer']['mean'], 3),
+        'rer_median': round(stats['rer']['median'], 3),
+        'rer_mode': round(stats['rer']['mode'], 3),
+        'rer_stdev': round(stats['rer']['std'], 3),
+        'time_points': len(series['time_points']),
+    }
+
+
+def best_of(fn, arg, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(arg)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    csv_data = make_csv(args.rows)
+    legacy = legacy_calculate(csv_data)
+    engine = engine_calculate(csv_data)
+    mismatches = {k: (legacy[k], engine[k]) for k in legacy if float(legacy[k]) != float(engine[k])}
+    if mismatches:
+        print(f"Result mismatch: {mismatches}")
+        sys.exit(1)
+
+    legacy_t = best_of(legacy_calculate, csv_data, args.repeat)
+    engine_t = best_of(engine_calculate, csv_data, args.repeat)
+    print(f"rows: {args.rows}")
+    print(f"legacy row loop : {args.rows / legacy_t:12,.0f} rows/sec ({legacy_t * 1000:.1f} ms)")
+    print(f"columnar engine : {args.rows / engine_t:12,.0f} rows/sec ({engine_t * 1000:.1f} ms)")
+    print(f"speedup         : {legacy_t / engine_t:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""
+Body composition engine
+Ultrasound site-sum body density (Jackson & Pollock), Siri body fat, the
+3-component model and method averaging, evaluated over NumPy arrays so a
+whole cohort is computed in one call
+"""
+
+import logging
+
+import numpy as np
+
+from sqlalchemy import select
+
+from models import db, Client, BodyCompositionData, UltrasoundData
+
+logger = logging.getLogger(__name__)
+
+KG_TO_LBS = 2.20462
+LBS_TO_KG = 0.453592
+
+# 3C-Model: BF% = (2.118/BD - 0.78*TBW/100 - 1.354) * 100
+THREE_C_DENSITY = 2.118
+THREE_C_WATER = 0.78
+THREE_C_OFFSET = 1.354
+
+# Siri: BF% = 495/BD - 450
+SIRI_NUMERATOR = 495.0
+SIRI_OFFSET = 450.0
+
+# Ultrasound measures a single tissue layer; skinfold equations expect a doubled fold
+SITE_SUM_FACTOR = 2.0
+
+SITES = ('chest', 'abdomen', 'thigh', 'tricep', 'subscapular', 'axilla', 'hip')
+
+# Sites summed per protocol as (male sites, female sites); hip stands in for suprailiac
+PROTOCOL_SITES = {
+    '3': (('chest', 'abdomen', 'thigh'), ('tricep', 'hip', 'thigh')),
+    '4': (('abdomen', 'thigh', 'tricep', 'subscapular'), ('abdomen', 'thigh', 'tricep', 'subscapular')),
+    '7': (SITES, SITES),
+}
+
+# Jackson & Pollock coefficients per protocol and sex:
+# '3'/'7' give body density = a - b*S + c*S^2 - d*age
+# '4' gives body fat % = a*S - b*S^2 + c*age + d, converted to density with Siri
+DENSITY_COEFFICIENTS = {
+    ('3', 'male'): (1.10938, 0.0008267, 0.0000016, 0.0002574),
+    ('3', 'female'): (1.0994921, 0.0009929, 0.0000023, 0.0001392),
+    ('7', 'male'): (1.112, 0.00043499, 0.00000055, 0.00028826),
+    ('7', 'female'): (1.097, 0.00046971, 0.00000056, 0.00012828),
+}
+BODY_FAT_COEFFICIENTS = {
+    ('4', 'male'): (0.29288, 0.0005, 0.15845, -5.76377),
+    ('4', 'female'): (0.29669, 0.00043, 0.02963, 1.4072),
+}
+
+# UltrasoundData.site_name (see persistence.ULTRASOUND_SITES) -> engine site
+ULTRASOUND_SITE_ALIASES = {
+    'Chest': 'chest',
+    'Waist': 'abdomen',
+    'Triceps': 'tricep',
+    'Thigh': 'thigh',
+    'Axilla': 'axilla',
+    'Subscapular': 'subscapular',
+}
+# Gender strings (upper-cased) -> 1 male, 0 female
+SEX_CODES = {'MALE': 1, 'M': 1, 'FEMALE': 0, 'F': 0}
+
+# Engine sites stored ultrasound data can give; there is no hip site
+STORED_SITES = frozenset(ULTRASOUND_SITE_ALIASES.values())
+# Default protocol for stored clients (7 and the female 3-site sum need hip)
+STORED_PROTOCOL = '4'
+
+
+def _lenient_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def float_array(values, lenient=False):
+    """
+    float64 array with None and empty strings mapped to NaN
+
+    With lenient, values that are not numbers ('22.5%', '180cm') become NaN
+    as well instead of raising ValueError.
+    """
+    if lenient:
+        return np.array([_lenient_float(v) for v in values], dtype=np.float64)
+    return np.array([np.nan if v is None or v == '' else v for v in values], dtype=np.float64)
+
+
+def sex_codes(genders):
+    """1 where the gender is male, 0 where female, -1 where missing or unknown (case-insensitive)."""
+    return np.array([SEX_CODES.get(str(g or '').strip().upper(), -1) for g in genders], dtype=np.int64)
+
+
+def male_mask(genders):
+    """Boolean array: True where the gender is male ('MALE', 'Male', 'm', ...)."""
+    return sex_codes(genders) == 1
+
+
+def unstored_sites(protocol):
+    """Sites of a protocol that stored ultrasound data never has, as (male, female) lists."""
+    return tuple(sorted(set(sites) - STORED_SITES) for sites in PROTOCOL_SITES[protocol])
+
+
+def missing_sites(thickness, male, protocol='7'):
+    """Per client, the protocol sites without a thickness (NaN)."""
+    missing = []
+    for i, is_male in enumerate(male):
+        sites = PROTOCOL_SITES[protocol][0 if is_male else 1]
+        missing.append([site for site in sites if site not in thickness or np.isnan(thickness[site][i])])
+    return missing
+
+
+def site_sum(thickness, male, protocol='7'):
+    """
+    Doubled sum of the protocol's site thicknesses
+
+    Args:
+        thickness (dict): Site name -> array of thicknesses in mm (NaN where missing)
+        male (ndarray): Boolean sex mask
+        protocol (str, optional): '3', '4' or '7'
+
+    Returns:
+        ndarray: Site sums in mm; NaN where a required site is missing
+
+    Raises:
+        ValueError: If the protocol is unknown
+    """
+    if protocol not in PROTOCOL_SITES:
+        raise ValueError(f"Unknown site protocol: {protocol}")
+    missing = np.full(len(male), np.nan)
+    male_sites, female_sites = PROTOCOL_SITES[protocol]
+    male_sum = sum(thickness.get(site, missing) for site in male_sites)
+    female_sum = sum(thickness.get(site, missing) for site in female_sites)
+    return SITE_SUM_FACTOR * np.where(male, male_sum, female_sum)
+
+
+def body_density_from_sites(sums, age, male, protocol='7'):
+    """
+    Jackson & Pollock body density from doubled site sums
+
+    Args:
+        sums (ndarray): Output of site_sum
+        age (ndarray): Age in years
+        male (ndarray): Boolean sex mask
+        protocol (str, optional): '3', '4' or '7'
+
+    Returns:
+        ndarray: Body density in g/cm³
+    """
+    if (protocol, 'male') in BODY_FAT_COEFFICIENTS:
+        results = {}
+        for sex in ('male', 'female'):
+            a, b, c, d = BODY_FAT_COEFFICIENTS[(protocol, sex)]
+            results[sex] = a * sums - b * sums ** 2 + c * age + d
+        return siri_density(np.where(male, results['male'], results['female']))
+
+    results = {}
+    for sex in ('male', 'female'):
+        a, b, c, d = DENSITY_COEFFICIENTS[(protocol, sex)]
+        results[sex] = a - b * sums + c * sums ** 2 - d * age
+    return np.where(male, results['male'], results['female'])
+
+
+def siri_body_fat(body_density):
+    """Siri two-compartment body fat % from body density."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return SIRI_NUMERATOR / body_density - SIRI_OFFSET
+
+
+def siri_density(body_fat):
+    """Body density from body fat % (inverse Siri)."""
+    return SIRI_NUMERATOR / (body_fat + SIRI_OFFSET)
+
+
+def three_component_body_fat(body_density, tbw_percent):
+    """3C-Model body fat %: (2.118/BD - 0.78*TBW/100 - 1.354) * 100."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (THREE_C_DENSITY / body_density - THREE_C_WATER * tbw_percent / 100 - THREE_C_OFFSET) * 100
+
+
+def mass_split(weight_kg, body_fat):
+    """Fat mass and fat-free mass (kg and lbs) for a body fat %."""
+    fat_mass_kg = weight_kg * (body_fat / 100)
+    ffm_kg = weight_kg - fat_mass_kg
+    return {
+        'fat_mass_kg': fat_mass_kg,
+        'fat_mass_lbs': fat_mass_kg * KG_TO_LBS,
+        'ffm_kg': ffm_kg,
+        'ffm_lbs': ffm_kg * KG_TO_LBS,
+    }
+
+
+def average_methods(*body_fats):
+    """Mean of the positive body fat estimates per client (NaN if there are none)."""
+    stacked = np.vstack(body_fats)
+    valid = stacked > 0
+    counts = valid.sum(axis=0)
+    totals = np.where(valid, stacked, 0.0).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, totals / counts, np.nan)
+
+
+def compute_body_composition(weight_kg, age, male, tbw_percent, body_density=None, thickness=None,
+                             scan_body_fat=None, protocol='7', ultrasound_body_fat=None):
+    """
+    Body composition for a cohort, one array element per client
+
+    Body density is taken from body_density where given and otherwise derived
+    from the ultrasound site thicknesses with the selected protocol. The
+    ultrasound body fat averaged with the 3C and scan values is the measured
+    one, as in 3c-model-calculator.js; Siri from the density stands in only
+    where none was measured.
+
+    Args:
+        weight_kg (ndarray): Body weight in kg
+        age (ndarray): Age in years
+        male (ndarray): Boolean sex mask (see male_mask)
+        tbw_percent (ndarray): Total body water %
+        body_density (ndarray, optional): Measured body density
+        thickness (dict, optional): Site name -> thickness arrays in mm
+        scan_body_fat (ndarray, optional): 3D scan body fat %
+        protocol (str, optional): Site protocol, '3', '4' or '7'
+        ultrasound_body_fat (ndarray, optional): Body fat % measured by the ultrasound device
+
+    Returns:
+        dict: Arrays for site_sum, body_density, ultrasound/3C/scan/average body fat
+            and the fat/fat-free masses of each method (NaN where not computable)
+    """
+    n = len(weight_kg)
+    nan = np.full(n, np.nan)
+    sums = site_sum(thickness, male, protocol) if thickness else nan
+    site_density = body_density_from_sites(sums, age, male, protocol) if thickness else nan
+    density = site_density if body_density is None else np.where(np.isnan(body_density), site_density, body_density)
+
+    ultrasound_bf = siri_body_fat(density)
+    if ultrasound_body_fat is not None:
+        ultrasound_bf = np.where(np.isnan(ultrasound_body_fat), ultrasound_bf, ultrasound_body_fat)
+    bf_3c = three_component_body_fat(density, tbw_percent)
+    scan_bf = nan if scan_body_fat is None else scan_body_fat
+    average_bf = average_methods(bf_3c, scan_bf, ultrasound_bf)
+
+    results = {
+        'site_sum': sums,
+        'body_density': density,
+        'body_fat_3c': bf_3c,
+        'ultrasound_body_fat': ultrasound_bf,
+        'scan_body_fat': scan_bf,
+        'average_body_fat': average_bf,
+    }
+    for method, body_fat in (('3c', bf_3c), ('ultrasound', ultrasound_bf), ('scan', scan_bf),
+                             ('average', average_bf)):
+        for name, values in mass_split(weight_kg, body_fat).items():
+            results[f"{method}_{name}"] = values
+    return results
+
+
+def cohort_inputs(records):
+    """
+    Engine input arrays from a list of client records (request JSON)
+
+    Each record may give weight_kg or weight_lbs, age, gender, tbw_percent,
+    body_density, scan_body_fat, ultrasound_body_fat and a sites dict of
+    thicknesses in mm.
+    """
+    weight_kg = float_array([r.get('weight_kg') for r in records])
+    weight_lbs = float_array([r.get('weight_lbs') for r in records])
+    weight_kg = np.where(np.isnan(weight_kg), weight_lbs * LBS_TO_KG, weight_kg)
+    thickness = {site: float_array([(r.get('sites') or {}).get(site) for r in records]) for site in SITES}
+    return {
+        'weight_kg': weight_kg,
+        'age': float_array([r.get('age') for r in records]),
+        'male': male_mask([r.get('gender') for r in records]),
+        'tbw_percent': float_array([r.get('tbw_percent') for r in records]),
+        'body_density': float_array([r.get('body_density') for r in records]),
+        'thickness': thickness,
+        'scan_body_fat': float_array([r.get('scan_body_fat') for r in records]),
+        'ultrasound_body_fat': float_array([r.get('ultrasound_body_fat') for r in records]),
+    }
+
+
+def stored_cohort_records(client_ids=None):
+    """
+    Engine records built from stored clients
+
+    TBW is the mean of the recorded water percentages, the sites are each
+    client's latest ultrasound measurements and the scan body fat its latest
+    3D scan value.
+
+    Args:
+        client_ids (list, optional): Defaults to every client
+
+    Returns:
+        list: Records for cohort_inputs, each with id and stored_body_fat_percent
+    """
+    client_table = Client.__table__
+    query = select(client_table.c.id, client_table.c.age, client_table.c.gender, client_table.c.weight_kg,
+                   client_table.c.weight_lbs, client_table.c.water_percent1, client_table.c.water_percent2,
+                   client_table.c.water_percent3, client_table.c.body_fat_percent,
+                   client_table.c.height_cm).order_by(client_table.c.id)
+    if client_ids is not None:
+        query = query.where(client_table.c.id.in_(client_ids))
+    records = {}
+    for row in db.session.execute(query):
+        water = [w for w in (row.water_percent1, row.water_percent2, row.water_percent3) if w]
+        records[row.id] = {
+            'id': row.id, 'age': row.age, 'gender': row.gender,
+            'weight_kg': row.weight_kg, 'weight_lbs': row.weight_lbs, 'height_cm': row.height_cm,
+            'tbw_percent': sum(water) / len(water) if water else None,
+            'stored_body_fat_percent': row.body_fat_percent,
+            'sites': {}, 'scan_body_fat': None,
+        }
+    if not records:
+        return []
+    ids = list(records)
+
+    # Latest measurement per client and site: rows come in date order, later rows overwrite
+    us = UltrasoundData.__table__
+    for row in db.session.execute(
+        select(us.c.client_id, us.c.site_name, us.c.measurement_value)
+        .where(us.c.client_id.in_(ids)).order_by(us.c.client_id, us.c.date, us.c.id)
+    ):
+        site = ULTRASOUND_SITE_ALIASES.get(row.site_name)
+        if site:
+            records[row.client_id]['sites'][site] = row.measurement_value
+
+    scans = BodyCompositionData.__table__
+    for row in db.session.execute(
+        select(scans.c.client_id, scans.c.measurement_value)
+        .where(scans.c.client_id.in_(ids), scans.c.measurement_name == 'Body Fat Percent')
+        .order_by(scans.c.client_id, scans.c.scan_date, scans.c.id)
+    ):
+        records[row.client_id]['scan_body_fat'] = row.measurement_value
+
+    return list(records.values())
+
+
+def body_composition_records(records, protocol='7', digits=1, density_digits=5):
+    """
+    Compute body composition for request/stored records and format the results
+
+    Rows whose density comes from the sites list the protocol sites they
+    lack in missing_sites, which is why their site-based values are None.
+
+    Returns:
+        list: One result dict per record (None where a value is not computable)
+    """
+    inputs = cohort_inputs(records)
+    results = compute_body_composition(protocol=protocol, **inputs)
+    missing = missing_sites(inputs['thickness'], inputs['male'], protocol)
+
+    def value(array, i, places):
+        v = array[i]
+        return None if np.isnan(v) else round(float(v), places)
+
+    output = []
+    for i, record in enumerate(records):
+        row = {name: value(array, i, density_digits if name == 'body_density' else digits)
+               for name, array in results.items()}
+        row['missing_sites'] = [] if not np.isnan(inputs['body_density'][i]) else missing[i]
+        if 'id' in record:
+            row['id'] = record['id']
+        if 'stored_body_fat_percent' in record:
+            stored = record['stored_body_fat_percent']
+            row['stored_body_fat_percent'] = stored
+            row['body_fat_3c_difference'] = (round(row['body_fat_3c'] - stored, digits)
+                                             if stored is not None and row['body_fat_3c'] is not None else None)
+        output.append(row)
+    return output
@@ -0,0 +1,432 @@
+"""
+Bulk historical import
+Loads a directory of legacy metabolic-cart exports and Fit3D/Styku and
+ultrasound CSVs: files are parsed in a process pool, written one batch per
+transaction and recorded by content hash, so a rerun skips every file that
+is already loaded and picks up where an interrupted import stopped
+"""
+
+import csv
+import hashlib
+import io
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import delete, func, insert, select
+
+from body_composition import KG_TO_LBS, LBS_TO_KG
+from models import db, Client, RmrData, BodyCompositionData, UltrasoundData, ImportedFile
+from persistence import SCAN_MEASUREMENTS, ULTRASOUND_SITES, scan_measurement_rows, ultrasound_rows
+from rmr_engine import find_rmr_columns, parse_rmr_csv
+from rmr_predictions import predict_records
+from rmr_trends import series_aggregates, upsert_test_summary
+from series_store import store_rmr_session
+from time_index import format_time
+
+logger = logging.getLogger(__name__)
+
+IMPORT_KINDS = ('rmr', 'scan', 'ultrasound')
+# Files parsed ahead and written per transaction
+DEFAULT_BATCH_FILES = 100
+HASH_CHUNK_BYTES = 1024 * 1024
+# YYYY-MM-DD or YYYYMMDD anywhere in a file name
+FILENAME_DATE = re.compile(r'(\d{4})-?(\d{2})-?(\d{2})')
+# Client fields a manifest row may give for its file
+MANIFEST_FIELDS = {
+    'first_name': str, 'last_name': str, 'gender': str, 'scan_device': str, 'kind': str,
+    'age': lambda v: int(float(v)), 'height_cm': float, 'weight_kg': float,
+    'test_date': lambda v: datetime.strptime(v, '%Y-%m-%d').date(),
+}
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def detect_kind(headers):
+    """'rmr', 'scan' or 'ultrasound' from a CSV header row; None if it is none of them."""
+    names = {h.strip() for h in headers}
+    try:
+        find_rmr_columns(list(names))
+        return 'rmr'
+    except ValueError:
+        pass
+    if 'Date' in names and names & set(ULTRASOUND_SITES):
+        return 'ultrasound'
+    if names & set(SCAN_MEASUREMENTS):
+        return 'scan'
+    return None
+
+
+def path_identity(relative_path):
+    """
+    Client name and test date implied by an archive path
+
+    The file's folder is read as "Last_First" or "Last, First" and a date in
+    the file name as the test date. A folder without that separator names no
+    client, so its files need a manifest entry.
+    """
+    identity = {}
+    folder, filename = os.path.split(relative_path)
+    if folder:
+        name = os.path.basename(folder)
+        last, sep, first = name.partition(',') if ',' in name else name.partition('_')
+        if sep and last.strip() and first.strip():
+            identity['last_name'] = last.strip()
+            identity['first_name'] = first.strip()
+    match = FILENAME_DATE.search(filename)
+    if match:
+        try:
+            identity['test_date'] = datetime(*(int(g) for g in match.groups())).date()
+        except ValueError:
+            pass
+    return identity
+
+
+def load_manifest(path):
+    """
+    Per-file client fields from a manifest CSV
+
+    The manifest has a 'file' column (path relative to the archive root) and
+    any of MANIFEST_FIELDS; blank cells are ignored.
+    """
+    manifest = {}
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            if not row.get('file'):
+                continue
+            fields = {}
+            for name, convert in MANIFEST_FIELDS.items():
+                value = (row.get(name) or '').strip()
+                if value:
+                    try:
+                        fields[name] = convert(value)
+                    except ValueError:
+                        raise ValueError(f"Manifest line {line}: invalid {name} {value!r}")
+            manifest[os.path.normpath(row['file'].strip())] = fields
+    return manifest
+
+
+def _scan_body_composition(rows):
+    """Client body composition fields from the latest scan among measurement rows."""
+    dates = [r['scan_date'] for r in rows if r['scan_date'] is not None]
+    latest = max(dates) if dates else None
+    values = {r['measurement_name']: r['measurement_value'] for r in rows if r['scan_date'] == latest}
+    fields = {}
+    if 'Weight' in values:
+        fields['weight_lbs'] = values['Weight']
+        fields['weight_kg'] = round(values['Weight'] * LBS_TO_KG, 2)
+    if 'Body Fat Percent' in values:
+        fields['body_fat_percent'] = values['Body Fat Percent']
+    for name, prefix in (('Lean Mass', 'lean_mass'), ('Fat Mass', 'fat_mass')):
+        if name in values:
+            fields[f'{prefix}_lbs'] = values[name]
+            fields[f'{prefix}_kg'] = round(values[name] * LBS_TO_KG, 2)
+    return fields
+
+
+def parse_import_file(job):
+    """
+    Parse one archive file (process pool entry point)
+
+    RMR exports go through parse_rmr_csv like calculate_rmr (units row
+    skipped); scan and ultrasound rows are mapped with the same helpers as
+    save_body_composition, without a client id yet.
+
+    Args:
+        job (tuple): (absolute path, relative path, sha256, identity dict)
+
+    Returns:
+        dict: path, sha256, kind, identity, test_date and the parsed payload,
+            or an 'error' message
+    """
+    path, relative_path, digest, identity = job
+    result = {'path': relative_path, 'sha256': digest, 'kind': identity.get('kind'), 'identity': identity,
+              'test_date': identity.get('test_date'), 'error': None}
+    try:
+        if not (identity.get('first_name') or identity.get('last_name')):
+            raise ValueError('No client name: list the file in the manifest or keep it in a "Last_First" folder')
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            text = f.read()
+        headers = next(csv.reader(io.StringIO(text)), [])
+        kind = result['kind'] or detect_kind(headers)
+        if kind not in IMPORT_KINDS:
+            raise ValueError('Not a metabolic-cart, 3D scan or ultrasound export')
+        result['kind'] = kind
+
+        if kind == 'rmr':
+            series = parse_rmr_csv(text)
+            columns = {'vo2_ml_min': series['vo2'], 'vco2_ml_min': series['vco2'], 'rer': series['rer']}
+            aggregates = series_aggregates(columns)
+            if not aggregates:
+                raise ValueError('No complete VO2/VCO2/RER samples')
+            time_points = series['time_points']
+            if len(time_points) != len(series['vo2']):
+                # Rows were dropped: rebuild the times from the aligned seconds
+                time_points = [format_time(s) or '' for s in series['seconds'].tolist()]
+            result['payload'] = {'columns': columns, 'time_points': time_points, 'aggregates': aggregates}
+        elif kind == 'scan':
+            records = list(csv.DictReader(io.StringIO(text)))
+            device = identity.get('scan_device') or ('Styku' if 'styku' in relative_path.lower() else 'Fit3D')
+            rows = scan_measurement_rows(None, records, device)
+            if not rows:
+                raise ValueError('No numeric scan measurements')
+            dates = [r['scan_date'] for r in rows if r['scan_date'] is not None]
+            result['test_date'] = result['test_date'] or (max(dates) if dates else None)
+            result['payload'] = {'rows': rows, 'scan_device': device,
+                                 'body_composition': _scan_body_composition(rows)}
+        else:
+            rows = ultrasound_rows(None, list(csv.DictReader(io.StringIO(text))))
+            if not rows:
+                raise ValueError('No numeric ultrasound measurements')
+            dates = [r['date'] for r in rows if r['date'] is not None]
+            result['test_date'] = result['test_date'] or (max(dates) if dates else None)
+            result['payload'] = {'rows': rows}
+    except (OSError, UnicodeDecodeError, csv.Error, ValueError) as e:
+        result['error'] = str(e)
+    return result
+
+
+def _client_lookup():
+    """(lower first name, lower last name) -> lowest client id with that name."""
+    table = Client.__table__
+    lookup = {}
+    for row in db.session.execute(
+        select(table.c.id, func.lower(table.c.first_name), func.lower(table.c.last_name)).order_by(table.c.id.desc())
+    ):
+        lookup[(row[1] or '', row[2] or '')] = row[0]
+    return lookup
+
+
+def _resolve_client(identity, clients):
+    """Existing client with the identity's name, or a new one; blank fields are filled in."""
+    first, last = identity.get('first_name', ''), identity.get('last_name', '')
+    key = (first.lower(), last.lower())
+    client = db.session.get(Client, clients[key]) if key in clients else None
+    if client is None:
+        client = Client(first_name=first, last_name=last)
+        db.session.add(client)
+        db.session.flush()
+        clients[key] = client.id
+    for name in ('age', 'gender', 'height_cm', 'weight_kg'):
+        if identity.get(name) is not None and getattr(client, name) in (None, ''):
+            setattr(client, name, identity[name])
+    if client.weight_kg and not client.weight_lbs:
+        client.weight_lbs = round(client.weight_kg * KG_TO_LBS, 2)
+    return client
+
+
+def _write_file(result, clients, staged):
+    """
+    Write one parsed file in the current transaction
+
+    The per-date summary (and RMR session) is always written; the client's
+    own fields and RmrData rows only change when the file is at least as
+    recent as the client's current test date. Measurement rows are added to
+    `staged` and inserted for the whole batch by _insert_staged().
+    """
+    client = _resolve_client(result['identity'], clients)
+    test_date = result['test_date']
+    latest = client.test_date is None or (test_date is not None and test_date >= client.test_date)
+    payload = result['payload']
+
+    if result['kind'] == 'rmr':
+        values = dict(payload['aggregates'])
+        prediction = predict_records([{'age': client.age, 'gender': client.gender, 'weight_kg': client.weight_kg,
+                                       'height_cm': client.height_cm,
+                                       'rmr_kcal_day': values['rmr_kcal_day']}])[0]
+        values['predicted_rmr'] = round(prediction['predicted_rmr'], 2) or None
+        values['rmr_percent_predicted'] = round(prediction['rmr_percent_predicted'], 2) or None
+        values['weight_kg'] = client.weight_kg
+        upsert_test_summary(client.id, test_date, values)
+
+        storage = current_app.config.get('RMR_STORAGE', 'both')
+        if storage in ('blob', 'both'):
+            store_rmr_session(client.id, payload['columns'], payload['time_points'], test_date)
+        if latest:
+            for name, key in (('rmr_kcal_day', 'rmr_kcal_day'), ('vo2_avg', 'vo2_mean'), ('vco2_avg', 'vco2_mean'),
+                              ('rer_avg', 'rer_mean'), ('predicted_rmr', 'predicted_rmr'),
+                              ('rmr_percent_predicted', 'rmr_percent_predicted'),
+                              ('fat_oxidation', 'fat_oxidation'), ('carb_oxidation', 'carb_oxidation')):
+                setattr(client, name, values[key])
+            if storage in ('rows', 'both'):
+                keys = ('client_id', 'time_point', *payload['columns'])
+                signals = [[None if v != v else v for v in signal.tolist()] for signal in payload['columns'].values()]
+                rows = [dict(zip(keys, point))
+                        for point in zip([client.id] * len(payload['time_points']), payload['time_points'], *signals)]
+                # RmrData keeps one test per client: a later file replaces these
+                staged['rmr_data'][client.id] = rows
+    else:
+        staged[result['kind']].extend(dict(row, client_id=client.id) for row in payload['rows'])
+        body_composition = payload.get('body_composition')
+        if body_composition:
+            upsert_test_summary(client.id, test_date, {
+                name: body_composition[name]
+                for name in ('weight_kg', 'body_fat_percent', 'fat_mass_kg', 'lean_mass_kg') if name in body_composition
+            })
+            if latest:
+                for name, value in body_composition.items():
+                    setattr(client, name, value)
+                client.scan_device = payload['scan_device']
+
+    if latest and test_date is not None:
+        client.test_date = test_date
+    return client.id
+
+
+def _record_file(result, status, client_id=None, error=None):
+    record = db.session.execute(
+        select(ImportedFile).where(ImportedFile.sha256 == result['sha256'])
+    ).scalars().first() or ImportedFile(sha256=result['sha256'])
+    record.path = result['path']
+    record.kind = result['kind']
+    record.client_id = client_id
+    record.test_date = result['test_date']
+    record.status = status
+    record.error = error
+    record.imported_at = datetime.utcnow()
+    db.session.add(record)
+
+
+def _insert_staged(staged):
+    """Replace the staged clients' RmrData rows and insert the scan and ultrasound rows (Core executemany)."""
+    rmr_data = staged['rmr_data']
+    if rmr_data:
+        table = RmrData.__table__
+        db.session.execute(delete(table).where(table.c.client_id.in_(list(rmr_data))))
+        db.session.execute(insert(table), [row for rows in rmr_data.values() for row in rows])
+    for kind, model in (('scan', BodyCompositionData), ('ultrasound', UltrasoundData)):
+        if staged[kind]:
+            db.session.execute(insert(model.__table__), staged[kind])
+
+
+def _write_batch(results, clients):
+    """
+    Write a batch of parsed files in one transaction
+
+    Measurement rows of the whole batch go in with one executemany per
+    table. If the batch fails, each file is retried in its own transaction so
+    only the offending files are marked failed.
+
+    Returns:
+        dict: imported and failed counts
+    """
+    counts = {'imported': 0, 'failed': 0}
+    try:
+        staged = {'rmr_data': {}, 'scan': [], 'ultrasound': []}
+        for result in results:
+            if result['error']:
+                _record_file(result, 'failed', error=result['error'])
+                counts['failed'] += 1
+            else:
+                _record_file(result, 'imported', _write_file(result, clients, staged))
+                counts['imported'] += 1
+        _insert_staged(staged)
+        db.session.commit()
+        return counts
+    except Exception as e:
+        db.session.rollback()
+        if len(results) == 1:
+            raise
+        logger.warning(f"Import batch failed ({str(e)}); retrying its files one at a time")
+
+    # Clients created by the rolled-back transaction no longer exist
+    clients.clear()
+    clients.update(_client_lookup())
+    counts = {'imported': 0, 'failed': 0}
+    for result in results:
+        try:
+            part = _write_batch([result], clients)
+        except Exception as e:
+            db.session.rollback()
+            clients.clear()
+            clients.update(_client_lookup())
+            _record_file(result, 'failed', error=str(e))
+            db.session.commit()
+            part = {'imported': 0, 'failed': 1}
+        for name in counts:
+            counts[name] += part[name]
+    return counts
+
+
+def archive_files(root):
+    """(absolute path, path relative to root) of every CSV under root, in sorted order."""
+    for directory, subdirs, filenames in os.walk(root):
+        subdirs.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith('.csv'):
+                path = os.path.join(directory, filename)
+                yield path, os.path.relpath(path, root)
+
+
+def import_archive(root, manifest=None, workers=None, batch_files=DEFAULT_BATCH_FILES):
+    """
+    Import every new CSV under a directory
+
+    Files whose content hash is already recorded as imported are skipped.
+    Repeats of the same content within the run are imported once, from the
+    copy the manifest lists if any, and counted as duplicates. Parsing of
+    the next batch overlaps with writing the current one. Must run inside an
+    app context.
+
+    Args:
+        root (str): Archive directory
+        manifest (str, optional): Manifest CSV (see load_manifest); its entries
+            override the client and date read from the path
+        workers (int, optional): Parser processes; defaults to the CPU count
+        batch_files (int, optional): Files per transaction
+
+    Returns:
+        dict: imported, skipped (already imported), duplicates (same content
+            as another file of the run) and failed file counts
+    """
+    if batch_files < 1:
+        raise ValueError('batch_files must be at least 1')
+    manifest_fields = load_manifest(manifest) if manifest else {}
+    manifest_path = os.path.abspath(manifest) if manifest else None
+
+    imported = set(db.session.execute(
+        select(ImportedFile.sha256).where(ImportedFile.status == 'imported')
+    ).scalars())
+    counts = {'imported': 0, 'skipped': 0, 'duplicates': 0, 'failed': 0}
+    # sha256 -> (job, listed in the manifest), in archive order
+    candidates = {}
+    for path, relative_path in archive_files(root):
+        if os.path.abspath(path) == manifest_path:
+            continue
+        digest = file_sha256(path)
+        if digest in imported:
+            counts['skipped'] += 1
+            continue
+        listed = manifest_fields.get(os.path.normpath(relative_path))
+        job = (path, relative_path, digest, dict(path_identity(relative_path), **(listed or {})))
+        if digest in candidates:
+            counts['duplicates'] += 1
+            if listed is not None and not candidates[digest][1]:
+                candidates[digest] = (job, True)
+            continue
+        candidates[digest] = (job, listed is not None)
+    jobs = [job for job, _ in candidates.values()]
+    logger.info(f"Importing {len(jobs)} file(s) from {root}, {counts['skipped']} already imported, "
+                f"{counts['duplicates']} duplicate(s) in the archive")
+
+    clients = _client_lookup()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = None
+        for start in range(0, len(jobs) + batch_files, batch_files):
+            batch = [pool.submit(parse_import_file, job) for job in jobs[start:start + batch_files]]
+            if pending:
+                written = _write_batch([future.result() for future in pending], clients)
+                for name, count in written.items():
+                    counts[name] += count
+                logger.info(f"Imported {counts['imported']} of {len(jobs)} file(s), {counts['failed']} failed")
+            pending = batch
+    return counts
@@ -0,0 +1,316 @@
+"""
+Client listing, search and detail queries
+Keyset-paginated, column-projected reads of the Client table, a ranked
+name search backed by SQLite FTS5 and eager-loaded client bundles
+"""
+
+import base64
+import logging
+from datetime import datetime
+
+from sqlalchemy import and_, column, event, func, or_, select, text
+from sqlalchemy import table as sa_table
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import db, Client
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(updated_at, client_id):
+    """Opaque cursor for the (updated_at, id) position of the last row on a page."""
+    raw = f"{updated_at.isoformat()}|{client_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by encode_cursor
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        updated_at, client_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(updated_at), int(client_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def parse_fields(fields_param):
+    """
+    Resolve a comma-separated fields= parameter to Client column names
+
+    Args:
+        fields_param (str): e.g. "id,first_name,last_name"; empty for the summary fields
+
+    Returns:
+        list: Column names, always including id
+
+    Raises:
+        ValueError: If an unknown column is requested
+    """
+    if not fields_param:
+        return list(Client.SUMMARY_FIELDS)
+
+    columns = Client.__table__.columns
+    fields = [f.strip() for f in fields_param.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in columns]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    if 'id' not in fields:
+        fields.insert(0, 'id')
+    return fields
+
+
+def list_clients(limit=DEFAULT_PAGE_SIZE, cursor=None, fields=None):
+    """
+    One page of clients, most recently updated first
+
+    Only the requested columns (plus the keyset columns) are selected, and the
+    page is located with a seek on (updated_at, id) rather than an OFFSET.
+
+    Args:
+        limit (int, optional): Page size, capped at MAX_PAGE_SIZE
+        cursor (str, optional): next_cursor from the previous page
+        fields (list, optional): Column names to return (see parse_fields)
+
+    Returns:
+        tuple: (list of client dicts, next_cursor or None)
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    fields = fields or list(Client.SUMMARY_FIELDS)
+    table = Client.__table__
+    selected = list(dict.fromkeys(fields + ['updated_at', 'id']))
+
+    query = select(*[table.c[name] for name in selected]).order_by(
+        table.c.updated_at.desc(), table.c.id.desc()
+    )
+    if cursor:
+        after_updated, after_id = decode_cursor(cursor)
+        query = query.where(or_(
+            table.c.updated_at < after_updated,
+            and_(table.c.updated_at == after_updated, table.c.id < after_id),
+        ))
+
+    rows = db.session.execute(query.limit(limit + 1)).mappings().all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more and rows[-1]['updated_at'] is not None:
+        next_cursor = encode_cursor(rows[-1]['updated_at'], rows[-1]['id'])
+
+    clients = [Client.serialize_fields({name: row[name] for name in fields}) for row in rows]
+    return clients, next_cursor
+
+
+# Child collections that can be included in a client bundle
+CLIENT_COLLECTIONS = {
+    'rmr': 'rmr_points',
+    'scans': 'scan_measurements',
+    'ultrasound': 'ultrasound_sites',
+}
+
+
+def parse_include(include_param):
+    """
+    Resolve a comma-separated include= parameter to collection keys
+
+    Raises:
+        ValueError: If an unknown collection is requested
+    """
+    if not include_param:
+        return list(CLIENT_COLLECTIONS)
+    include = [i.strip() for i in include_param.split(',') if i.strip()]
+    unknown = [i for i in include if i not in CLIENT_COLLECTIONS]
+    if unknown:
+        raise ValueError(f"Unknown collections: {', '.join(unknown)}")
+    return include
+
+
+def load_client_bundle(client_id, include=None, strategy='selectin'):
+    """
+    Load a client together with its child collections
+
+    With the default selectin strategy this issues one query for the client
+    plus one SELECT ... WHERE client_id IN (...) per included collection,
+    regardless of how many rows each collection holds.
+
+    Args:
+        client_id (int): Client to load
+        include (list, optional): Keys of CLIENT_COLLECTIONS; defaults to all
+        strategy (str, optional): 'selectin' or 'joined'
+
+    Returns:
+        Client or None
+    """
+    loader = joinedload if strategy == 'joined' else selectinload
+    include = list(CLIENT_COLLECTIONS) if include is None else include
+    options = [loader(getattr(Client, CLIENT_COLLECTIONS[key])) for key in include]
+    return db.session.get(Client, client_id, options=options)
+
+
+def load_client_bundles(client_ids=None, date_from=None, date_to=None, include=None, limit=None):
+    """
+    Load several clients with their child collections in one round of queries
+
+    Args:
+        client_ids (list, optional): Clients to load
+        date_from (date, optional): Earliest test_date (inclusive), used when no ids are given
+        date_to (date, optional): Latest test_date (inclusive), used when no ids are given
+        include (list, optional): Keys of CLIENT_COLLECTIONS; defaults to all
+        limit (int, optional): Maximum number of clients
+
+    Returns:
+        list: Client objects ordered by test_date, last_name, first_name
+    """
+    include = list(CLIENT_COLLECTIONS) if include is None else include
+    query = select(Client).options(*[selectinload(getattr(Client, CLIENT_COLLECTIONS[key])) for key in include])
+    if client_ids is not None:
+        query = query.where(Client.id.in_(client_ids))
+    else:
+        if date_from:
+            query = query.where(Client.test_date >= date_from)
+        if date_to:
+            query = query.where(Client.test_date <= date_to)
+    query = query.order_by(Client.test_date, Client.last_name, Client.first_name, Client.id)
+    if limit:
+        query = query.limit(limit)
+    return db.session.execute(query).scalars().all()
+
+
+def client_bundle_dict(client, include=None):
+    """Serialize a client loaded by load_client_bundle."""
+    include = list(CLIENT_COLLECTIONS) if include is None else include
+    bundle = {'client': client.to_dict()}
+    if 'rmr' in include:
+        bundle['raw_data'] = [point.to_dict() for point in client.rmr_points]
+    if 'scans' in include:
+        bundle['scan_data'] = [item.to_dict() for item in client.scan_measurements]
+    if 'ultrasound' in include:
+        bundle['ultrasound_data'] = [site.to_dict() for site in client.ultrasound_sites]
+    return bundle
+
+
+# SQLite FTS5 index over client names; rowid is Client.id
+SEARCH_TABLE = 'client_fts'
+_fts_ready = {}
+
+
+def _search_available(connection):
+    return connection.dialect.name == 'sqlite' and _fts_ready.get(str(connection.engine.url), False)
+
+
+def ensure_search_index():
+    """
+    Create the FTS5 name index on SQLite and backfill it from Client if needed
+
+    Must be called inside an app context. On other databases, or SQLite builds
+    without FTS5, search falls back to indexed LIKE filters.
+    """
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.begin() as connection:
+        try:
+            connection.exec_driver_sql(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+                f"USING fts5(first_name, last_name, tokenize='unicode61', prefix='2 3')"
+            )
+        except Exception as e:
+            logger.warning(f"FTS5 unavailable, client search will use LIKE: {str(e)}")
+            _fts_ready[str(engine.url)] = False
+            return False
+        indexed = connection.exec_driver_sql(f"SELECT count(*) FROM {SEARCH_TABLE}").scalar()
+        total = connection.execute(select(func.count()).select_from(Client.__table__)).scalar()
+        if indexed != total:
+            connection.exec_driver_sql(f"DELETE FROM {SEARCH_TABLE}")
+            connection.exec_driver_sql(
+                f"INSERT INTO {SEARCH_TABLE}(rowid, first_name, last_name) "
+                f"SELECT id, coalesce(first_name, ''), coalesce(last_name, '') FROM client"
+            )
+    _fts_ready[str(engine.url)] = True
+    return True
+
+
+@event.listens_for(Client, 'after_insert')
+@event.listens_for(Client, 'after_update')
+def _index_client(mapper, connection, client):
+    """Keep the FTS row for a client in step with every insert/update of Client."""
+    if not _search_available(connection):
+        return
+    connection.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :id"), {'id': client.id})
+    connection.execute(
+        text(f"INSERT INTO {SEARCH_TABLE}(rowid, first_name, last_name) VALUES (:id, :first, :last)"),
+        {'id': client.id, 'first': client.first_name or '', 'last': client.last_name or ''}
+    )
+
+
+@event.listens_for(Client, 'after_delete')
+def _unindex_client(mapper, connection, client):
+    if _search_available(connection):
+        connection.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :id"), {'id': client.id})
+
+
+def _match_expression(query_text):
+    """Turn free text into an FTS5 query: every token must prefix-match a name."""
+    tokens = [t.replace('"', '""') for t in query_text.split() if t]
+    return ' '.join(f'"{t}"*' for t in tokens)
+
+
+def search_clients(query_text='', gender=None, scan_device=None, date_from=None, date_to=None,
+                   limit=DEFAULT_PAGE_SIZE, page=1, fields=None):
+    """
+    Ranked, paginated client search by name with optional filters
+
+    Args:
+        query_text (str, optional): Name fragments, e.g. "jo smi"
+        gender (str, optional): Exact gender filter
+        scan_device (str, optional): Exact scan device filter (Fit3D or Styku)
+        date_from (date, optional): Earliest test_date (inclusive)
+        date_to (date, optional): Latest test_date (inclusive)
+        limit (int, optional): Page size, capped at MAX_PAGE_SIZE
+        page (int, optional): 1-based page number
+        fields (list, optional): Column names to return (see parse_fields)
+
+    Returns:
+        tuple: (list of client dicts, has_more flag)
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    page = max(1, int(page))
+    fields = fields or list(Client.SUMMARY_FIELDS)
+    table = Client.__table__
+
+    query = select(*[table.c[name] for name in fields])
+    filters = []
+    if gender:
+        filters.append(table.c.gender == gender)
+    if scan_device:
+        filters.append(table.c.scan_device == scan_device)
+    if date_from:
+        filters.append(table.c.test_date >= date_from)
+    if date_to:
+        filters.append(table.c.test_date <= date_to)
+
+    query_text = (query_text or '').strip()
+    order = [table.c.updated_at.desc(), table.c.id.desc()]
+    if query_text and _search_available(db.session.connection()):
+        fts = sa_table(SEARCH_TABLE, column('rowid'))
+        query = query.select_from(table.join(fts, fts.c.rowid == table.c.id))
+        filters.append(text(f"{SEARCH_TABLE} MATCH :match").bindparams(match=_match_expression(query_text)))
+        order.insert(0, text(f"bm25({SEARCH_TABLE})"))
+    elif query_text:
+        for token in query_text.lower().split():
+            pattern = f"{token}%"
+            filters.append(or_(func.lower(table.c.first_name).like(pattern),
+                               func.lower(table.c.last_name).like(pattern)))
+
+    query = query.where(*filters).order_by(*order).limit(limit + 1).offset((page - 1) * limit)
+    rows = db.session.execute(query).mappings().all()
+    clients = [Client.serialize_fields(dict(row)) for row in rows[:limit]]
+    return clients, len(rows) > limit
@@ -0,0 +1,331 @@
+"""
+Cohort analytics
+Facility-level averages, percentiles and histograms of client metrics,
+grouped by gender, age band or scan device and computed in SQL, with
+results cached until the next write to Client
+"""
+
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import Integer, case, cast, event, func, select
+from sqlalchemy.orm import Session
+
+from models import db, Client
+
+logger = logging.getLogger(__name__)
+
+COHORT_METRICS = (
+    'body_fat_percent', 'lean_mass_kg', 'fat_mass_kg', 'weight_kg', 'rmr_kcal_day',
+    'predicted_rmr', 'rmr_percent_predicted', 'vo2_avg', 'rer_avg',
+)
+COHORT_GROUPS = ('gender', 'age_band', 'scan_device')
+PERCENTILES = (25, 50, 75, 90)
+DEFAULT_AGE_BAND = 10
+DEFAULT_HISTOGRAM_BINS = 10
+MAX_HISTOGRAM_BINS = 100
+# Cached results also expire, so writes made by other worker processes show up
+CACHE_SECONDS = 300
+
+
+def _group_column(name, age_band):
+    table = Client.__table__
+    if name == 'gender':
+        return func.upper(table.c.gender)
+    if name == 'age_band':
+        return table.c.age // age_band * age_band
+    return table.c[name]
+
+
+def _group_key(names, values, age_band):
+    key = {}
+    for name, value in zip(names, values):
+        if name == 'age_band' and value is not None:
+            value = f"{int(value)}-{int(value) + age_band - 1}"
+        key[name] = value
+    return key
+
+
+def _filters(date_from=None, date_to=None, gender=None):
+    table = Client.__table__
+    conditions = []
+    if date_from:
+        conditions.append(table.c.test_date >= date_from)
+    if date_to:
+        conditions.append(table.c.test_date <= date_to)
+    if gender:
+        conditions.append(func.upper(table.c.gender) == gender.upper())
+    return conditions
+
+
+def _metric_summary(count, mean, mean_sq, minimum, maximum, percentiles):
+    variance = max(mean_sq - mean * mean, 0.0) if count else 0.0
+    summary = {
+        'count': count,
+        'mean': round(mean, 3),
+        'std': round(math.sqrt(variance), 3),
+        'min': minimum,
+        'max': maximum,
+    }
+    for p, value in zip(PERCENTILES, percentiles):
+        summary[f'p{p}'] = value
+    return summary
+
+
+def _metric_rows(connection, query, n_groups):
+    results = []
+    for row in connection.execute(query):
+        key, (count, mean, mean_sq, minimum, maximum, *percentiles) = row[:n_groups], row[n_groups:]
+        results.append((tuple(key), _metric_summary(count, float(mean), float(mean_sq), minimum, maximum,
+                                                    percentiles)))
+    return results
+
+
+def _ordered_set_metric_groups(connection, metric, groups, conditions):
+    """
+    Per-group count, mean, mean of squares, min, max and nearest-rank percentiles
+
+    One GROUP BY with PERCENTILE_DISC ordered-set aggregates (PostgreSQL).
+    """
+    value = Client.__table__.c[metric]
+    query = select(
+        *groups,
+        func.count(),
+        func.avg(value),
+        func.avg(value * value),
+        func.min(value),
+        func.max(value),
+        *(func.percentile_disc(p / 100).within_group(value) for p in PERCENTILES),
+    ).where(value.isnot(None), *conditions).group_by(*groups).order_by(*groups)
+    return _metric_rows(connection, query, len(groups))
+
+
+def _window_metric_groups(connection, metric, groups, conditions):
+    """
+    Same as _ordered_set_metric_groups for databases without PERCENTILE_DISC
+
+    Percentiles come from ROW_NUMBER() and COUNT() windows partitioned by
+    group: the p-th percentile is the value at rank ceil(p * n / 100).
+    """
+    value = Client.__table__.c[metric]
+    labelled = [column.label(f'g{i}') for i, column in enumerate(groups)]
+    ranked = select(
+        *labelled,
+        value.label('v'),
+        func.row_number().over(partition_by=groups or None, order_by=value).label('rn'),
+        func.count().over(partition_by=groups or None).label('n'),
+    ).where(value.isnot(None), *conditions).subquery()
+
+    keys = [ranked.c[f'g{i}'] for i in range(len(groups))]
+    query = select(
+        *keys,
+        func.count(),
+        func.avg(ranked.c.v),
+        func.avg(ranked.c.v * ranked.c.v),
+        func.min(ranked.c.v),
+        func.max(ranked.c.v),
+        # Integer division: (n * p + 99) // 100 == ceil(n * p / 100)
+        *(func.max(case((ranked.c.rn == (ranked.c.n * p + 99) // 100, ranked.c.v))) for p in PERCENTILES),
+    ).group_by(*keys).order_by(*keys)
+    return _metric_rows(connection, query, len(groups))
+
+
+def _sqlite_metric_groups(connection, metric, groups, conditions):
+    """
+    Same as _ordered_set_metric_groups for SQLite, which has no percentile aggregate
+
+    SQLite 3.25+ ranks with window functions (_window_metric_groups). Older
+    versions still get count, mean, min and max from one GROUP BY; only the
+    percentiles are taken in NumPy from the values fetched in group order.
+    """
+    sqlite_version = getattr(connection.dialect.dbapi, 'sqlite_version_info', (0,))
+    if sqlite_version >= (3, 25):
+        return _window_metric_groups(connection, metric, groups, conditions)
+
+    value = Client.__table__.c[metric]
+    query = select(
+        *groups,
+        func.count(),
+        func.avg(value),
+        func.avg(value * value),
+        func.min(value),
+        func.max(value),
+    ).where(value.isnot(None), *conditions).group_by(*groups).order_by(*groups)
+    aggregates = connection.execute(query).all()
+
+    values = {}
+    query = select(*groups, value).where(value.isnot(None), *conditions).order_by(*groups)
+    for row in connection.execute(query):
+        values.setdefault(tuple(row[:-1]), []).append(row[-1])
+
+    results = []
+    for row in aggregates:
+        key, (count, mean, mean_sq, minimum, maximum) = tuple(row[:len(groups)]), row[len(groups):]
+        percentiles = np.percentile(np.array(values[key], dtype=np.float64), PERCENTILES, method='inverted_cdf')
+        results.append((key, _metric_summary(count, float(mean), float(mean_sq), minimum, maximum,
+                                             percentiles.tolist())))
+    return results
+
+
+def _histogram(connection, metric, groups, conditions, low, high, bins):
+    """Per-group counts over `bins` equal-width bins between low and high, bucketed in SQL."""
+    value = Client.__table__.c[metric]
+    width = (high - low) / bins if high > low else 1.0
+    position = (value - low) / width
+    # CAST to integer rounds on PostgreSQL, so floor() first; SQLite truncates
+    # (the same for these non-negative positions) and before 3.35 has no floor()
+    if connection.dialect.name != 'sqlite':
+        position = func.floor(position)
+    bucket = cast(position, Integer)
+    bucket = case((bucket >= bins, bins - 1), else_=bucket).label('bucket')
+    query = select(*groups, bucket, func.count()).where(value.isnot(None), *conditions) \
+        .group_by(*groups, bucket)
+
+    counts = {}
+    for row in connection.execute(query):
+        key, index, count = tuple(row[:len(groups)]), row[len(groups)], row[len(groups) + 1]
+        counts.setdefault(key, [0] * bins)[int(index)] += count
+    edges = [round(low + i * width, 4) for i in range(bins + 1)]
+    return edges, counts
+
+
+# Per-dialect implementation of the grouped summary; others use window functions
+METRIC_GROUP_QUERIES = {
+    'postgresql': _ordered_set_metric_groups,
+    'sqlite': _sqlite_metric_groups,
+}
+
+
+def cohort_stats(metrics, group_by=(), age_band=DEFAULT_AGE_BAND, bins=None,
+                 date_from=None, date_to=None, gender=None):
+    """
+    Grouped statistics of Client metrics, computed in the database
+
+    Args:
+        metrics (list): Names from COHORT_METRICS
+        group_by (list, optional): Names from COHORT_GROUPS; none for the whole cohort
+        age_band (int, optional): Width in years of the age_band groups
+        bins (int, optional): Also return histograms with this many bins per metric
+        date_from (date, optional): Earliest test date
+        date_to (date, optional): Latest test date
+        gender (str, optional): Only this gender (case-insensitive)
+
+    Returns:
+        dict: 'groups' (group keys plus per-metric count, mean, std, min, max and
+            percentiles) and, with bins, 'histograms' (metric -> edges and per-group counts)
+
+    Raises:
+        ValueError: On an unknown metric or group, or an out-of-range parameter
+    """
+    unknown = [m for m in metrics if m not in COHORT_METRICS] + [g for g in group_by if g not in COHORT_GROUPS]
+    if unknown:
+        raise ValueError(f"Unknown metric or group: {', '.join(unknown)}")
+    if not metrics:
+        raise ValueError('At least one metric is required')
+    if age_band < 1:
+        raise ValueError('age_band must be at least 1')
+    if bins is not None and not 1 <= bins <= MAX_HISTOGRAM_BINS:
+        raise ValueError(f"bins must be between 1 and {MAX_HISTOGRAM_BINS}")
+
+    group_by = list(group_by)
+    groups = [_group_column(name, age_band) for name in group_by]
+    conditions = _filters(date_from, date_to, gender)
+
+    by_key = {}
+    histograms = {}
+    with db.engine.connect() as connection:
+        metric_groups = METRIC_GROUP_QUERIES.get(connection.dialect.name, _window_metric_groups)
+        for metric in metrics:
+            summaries = metric_groups(connection, metric, groups, conditions)
+            for key, summary in summaries:
+                by_key.setdefault(key, {})[metric] = summary
+            if bins and summaries:
+                low = min(summary['min'] for _, summary in summaries)
+                high = max(summary['max'] for _, summary in summaries)
+                edges, counts = _histogram(connection, metric, groups, conditions, low, high, bins)
+                histograms[metric] = {
+                    'edges': edges,
+                    'groups': [dict(_group_key(group_by, key, age_band), counts=counts[key])
+                               for key in sorted(counts, key=lambda k: tuple((v is not None, v) for v in k))],
+                }
+
+    result = {
+        'groups': [dict(_group_key(group_by, key, age_band), metrics=by_key[key])
+                   for key in sorted(by_key, key=lambda k: tuple((v is not None, v) for v in k))],
+    }
+    if bins:
+        result['histograms'] = histograms
+    return result
+
+
+class CohortCache:
+    """Process-local result cache, cleared after any committed write to Client."""
+
+    def __init__(self, ttl=CACHE_SECONDS):
+        self.ttl = ttl
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == self._generation and time.monotonic() - entry[1] < self.ttl:
+                return entry[2]
+            return None
+
+    def put(self, key, value, generation):
+        with self._lock:
+            # Drop results computed while a write was being committed
+            if generation == self._generation:
+                self._entries[key] = (generation, time.monotonic(), value)
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+_cache = CohortCache()
+
+
+def invalidate_cohort_cache():
+    """Forget cached cohort results; call after Core-level writes to the client table."""
+    _cache.invalidate()
+
+
+def cached_cohort_stats(**params):
+    """
+    cohort_stats() through the process-local cache
+
+    Returns:
+        tuple: (result dict, whether it came from the cache)
+    """
+    key = tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                       for name, value in params.items()))
+    result = _cache.get(key)
+    if result is not None:
+        return result, True
+    generation = _cache.generation
+    result = cohort_stats(**params)
+    _cache.put(key, result, generation)
+    return result, False
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_client_writes(session, flush_context):
+    if any(isinstance(obj, Client) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info['cohort_dirty'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    if session.info.pop('cohort_dirty', False):
+        _cache.invalidate()
@@ -0,0 +1,266 @@
+"""
+Streaming data export
+Writes the client and measurement tables as CSV, or as Parquet / Arrow IPC
+when pyarrow is installed, from server-side cursors in fixed-size batches,
+so memory stays flat however many rows are exported
+"""
+
+import csv
+import io
+import logging
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, LargeBinary, select
+
+from models import db, Client, RmrData, RmrSession, BodyCompositionData, UltrasoundData, TestSummary
+from persistence import RMR_FLOAT_FIELDS
+from series_store import unpack_series
+
+logger = logging.getLogger(__name__)
+
+# Table name -> model; 'rmr_samples' expands the packed RmrSession series
+EXPORT_TABLES = {
+    'clients': Client,
+    'rmr_data': RmrData,
+    'rmr_samples': RmrSession,
+    'body_composition': BodyCompositionData,
+    'ultrasound': UltrasoundData,
+    'test_summaries': TestSummary,
+}
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+# Rows per fetch from the cursor, and per CSV chunk / Parquet row group
+DEFAULT_BATCH_SIZE = 5000
+# RmrSession rows per fetch; each one carries a whole packed series
+SESSION_BATCH_SIZE = 16
+
+SAMPLE_COLUMNS = [('session_id', 'int'), ('client_id', 'int'), ('test_date', 'date'),
+                  ('sample', 'int'), ('time_point', 'str')] + [(f, 'float') for f in RMR_FLOAT_FIELDS]
+
+
+def _column_kind(column_type):
+    if isinstance(column_type, Boolean):
+        return 'bool'
+    if isinstance(column_type, Integer):
+        return 'int'
+    if isinstance(column_type, Float):
+        return 'float'
+    if isinstance(column_type, DateTime):
+        return 'datetime'
+    if isinstance(column_type, Date):
+        return 'date'
+    return 'str'
+
+
+def export_columns(table_name):
+    """(name, kind) of every exported column; binary columns are left out."""
+    if table_name == 'rmr_samples':
+        return SAMPLE_COLUMNS
+    table = EXPORT_TABLES[table_name].__table__
+    return [(c.name, _column_kind(c.type)) for c in table.columns if not isinstance(c.type, LargeBinary)]
+
+
+def _table_batches(table_name, client_ids, batch_size):
+    """Row tuples of a table in id order, batch_size rows at a time."""
+    table = EXPORT_TABLES[table_name].__table__
+    query = select(*(table.c[name] for name, _ in export_columns(table_name))).order_by(table.c.id)
+    if client_ids:
+        key = table.c.id if table_name == 'clients' else table.c.client_id
+        query = query.where(key.in_(client_ids))
+    # yield_per streams from a server-side cursor where the driver supports one
+    result = db.session.execute(query.execution_options(yield_per=batch_size))
+    for rows in result.partitions():
+        yield [tuple(row) for row in rows]
+
+
+def _sample_batches(client_ids, batch_size):
+    """One row tuple per breath of every RmrSession, decoded a session at a time."""
+    table = RmrSession.__table__
+    query = select(table).order_by(table.c.id)
+    if client_ids:
+        query = query.where(table.c.client_id.in_(client_ids))
+    result = db.session.execute(query.execution_options(yield_per=SESSION_BATCH_SIZE))
+
+    pending = []
+    for row in result.mappings():
+        n = row['sample_count']
+        series = unpack_series(row['series'], row['signals'].split(','), n, row['dtype'], row['codec'])
+        times = row['time_points'].split('\n') if row['time_points'] else []
+        times += [None] * (n - len(times))
+        for start in range(0, n, batch_size):
+            stop = min(start + batch_size, n)
+            signals = []
+            for field in RMR_FLOAT_FIELDS:
+                if field in series:
+                    # Rounded like series_to_json: float32 blobs carry no more precision
+                    values = np.round(series[field][start:stop].astype(np.float64), 4)
+                    signals.append([None if v != v else v for v in values.tolist()])
+                else:
+                    signals.append([None] * (stop - start))
+            pending.extend(zip([row['id']] * (stop - start), [row['client_id']] * (stop - start),
+                               [row['test_date']] * (stop - start), range(start, stop),
+                               times[start:stop], *signals))
+            if len(pending) >= batch_size:
+                yield pending
+                pending = []
+    if pending:
+        yield pending
+
+
+def _csv_chunks(columns, batches):
+    """Encoded CSV text: the header, then one chunk per batch."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in columns])
+    # Timestamps as in the models' to_dict()
+    timestamps = [i for i, (_, kind) in enumerate(columns) if kind == 'datetime']
+    for rows in batches:
+        if timestamps:
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for i in timestamps:
+                    if row[i] is not None:
+                        row[i] = row[i].strftime('%Y-%m-%d %H:%M:%S')
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkSink:
+    """
+    Write-only file object handing bytes back as they are written
+
+    pyarrow writers need tell() to keep counting from the start of the file,
+    so the position is tracked separately from the drained buffer.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _arrow_schema(pa, columns):
+    types = {'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_(), 'date': pa.date32(),
+             'datetime': pa.timestamp('us'), 'str': pa.string()}
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+
+def _arrow_chunks(columns, batches, fmt):
+    """Parquet (one row group per batch) or Arrow IPC stream bytes, drained after every batch."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema(pa, columns)
+    sink = _ChunkSink()
+    if fmt == 'parquet':
+        writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    try:
+        for rows in batches:
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def pyarrow_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def export_filename(table_name, fmt):
+    return f"{table_name}_{datetime.now().strftime('%Y%m%d')}.{EXPORT_FORMATS[fmt][1]}"
+
+
+def export_stream(table_name, fmt='csv', client_ids=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Byte chunks of a table export
+
+    Rows are fetched batch_size at a time and each batch is written out
+    before the next is fetched. Must be consumed inside an app context
+    (stream_with_context for an HTTP response).
+
+    Args:
+        table_name (str): Key of EXPORT_TABLES
+        fmt (str, optional): 'csv', 'parquet' or 'arrow' (the last two need pyarrow)
+        client_ids (list, optional): Only these clients' rows
+        batch_size (int, optional): Rows per batch
+
+    Returns:
+        generator: bytes chunks of the file
+
+    Raises:
+        ValueError: On an unknown table or format, or a columnar format without pyarrow
+    """
+    if table_name not in EXPORT_TABLES:
+        raise ValueError(f"Unknown export table: {table_name}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if fmt != 'csv' and not pyarrow_available():
+        raise ValueError(f"{fmt} export needs pyarrow installed; use csv")
+    if batch_size < 1:
+        raise ValueError('batch_size must be at least 1')
+
+    columns = export_columns(table_name)
+    if table_name == 'rmr_samples':
+        batches = _sample_batches(client_ids, batch_size)
+    else:
+        batches = _table_batches(table_name, client_ids, batch_size)
+    if fmt == 'csv':
+        return _csv_chunks(columns, batches)
+    return _arrow_chunks(columns, batches, fmt)
+
+
+def write_export(output, table_name, fmt='csv', client_ids=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Write an export to a binary file object
+
+    Returns:
+        int: Bytes written
+    """
+    written = 0
+    for chunk in export_stream(table_name, fmt, client_ids, batch_size):
+        output.write(chunk)
+        written += len(chunk)
+    logger.info(f"Exported {table_name} as {fmt}: {written} bytes")
+    return written
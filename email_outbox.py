@@ -0,0 +1,256 @@
+"""
+Outbound email queue
+Web requests write messages to the OutboundEmail table and return; a
+background worker drains it in batches over one transport connection,
+retrying failures with exponential backoff
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import undefer
+
+from models import db, OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 50
+MAX_ATTEMPTS = 6
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+# A message claimed by a worker that died is picked up again after this long
+SEND_TIMEOUT_SECONDS = 300
+# How long to wait before checking again on a report render to attach
+ATTACHMENT_WAIT_SECONDS = 5
+
+
+def enqueue_email(to_email, subject, html_content, pdf_content=None, attachment_name=None,
+                  from_email=None, client_id=None, attachment_key=None):
+    """
+    Store a message in the outbox and wake the worker
+
+    Args:
+        to_email (str): Recipient email address
+        subject (str): Email subject
+        html_content (str): HTML content of the email
+        pdf_content (bytes, optional): PDF attachment
+        attachment_name (str, optional): Filename of the attachment
+        from_email (str, optional): Sender, defaults to the email service default
+        client_id (int, optional): Client the message is about
+        attachment_key (str, optional): Report render (ReportRenderQueue key) to attach
+            once it has finished, instead of pdf_content
+
+    Returns:
+        OutboundEmail: The committed outbox row
+    """
+    from services.email_service import DEFAULT_ATTACHMENT_NAME, DEFAULT_FROM_EMAIL
+
+    email = OutboundEmail(
+        client_id=client_id,
+        to_email=to_email,
+        from_email=from_email or DEFAULT_FROM_EMAIL,
+        subject=subject,
+        html_content=html_content,
+        attachment=pdf_content,
+        attachment_name=(attachment_name or DEFAULT_ATTACHMENT_NAME) if pdf_content or attachment_key else None,
+        attachment_key=attachment_key,
+        status='queued',
+        next_attempt_at=datetime.utcnow(),
+    )
+    db.session.add(email)
+    db.session.commit()
+    if _worker is not None:
+        _worker.wake()
+    return email
+
+
+def retry_delay(attempts):
+    """Backoff before the next attempt after `attempts` failures."""
+    return timedelta(seconds=min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS))
+
+
+def _report_attachment(key):
+    """(PDF bytes or None, render status) of a queued report render."""
+    from report_jobs import get_render_queue
+
+    queue = get_render_queue()
+    path = queue.cached(key)
+    if path:
+        with open(path, 'rb') as f:
+            return f.read(), 'done'
+    return None, queue.status(key)['status']
+
+
+def _claim_batch(batch_size, now):
+    """
+    Mark up to batch_size due messages as sending and return their ids
+
+    Each row is claimed with an UPDATE that re-checks it is still due, so when
+    several processes drain the outbox at once a message goes to only one of
+    them: ids another drainer claimed first update no rows and are dropped.
+    """
+    table = OutboundEmail.__table__
+    due = (table.c.status.in_(('queued', 'sending')), table.c.next_attempt_at <= now)
+    ids = db.session.execute(
+        select(table.c.id)
+        .where(*due)
+        .order_by(table.c.next_attempt_at, table.c.id)
+        .limit(batch_size)
+    ).scalars().all()
+    claim = update(table).values(status='sending', next_attempt_at=now + timedelta(seconds=SEND_TIMEOUT_SECONDS))
+    claimed = [email_id for email_id in ids
+               if db.session.execute(claim.where(table.c.id == email_id, *due)).rowcount == 1]
+    db.session.commit()
+    return claimed
+
+
+def drain_outbox(transport=None, batch_size=DEFAULT_BATCH_SIZE, max_batches=None):
+    """
+    Send every message that is due, batch by batch
+
+    Must be called inside an app context.
+
+    Args:
+        transport (EmailTransport, optional): Defaults to email_service.get_transport()
+        batch_size (int, optional): Messages per transport connection
+        max_batches (int, optional): Stop after this many batches
+
+    Returns:
+        dict: Counts of sent, retried, failed and waiting (for a report render) messages
+    """
+    from services.email_service import build_message, get_transport
+
+    transport = transport or get_transport()
+    counts = {'sent': 0, 'retried': 0, 'failed': 0, 'waiting': 0}
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        now = datetime.utcnow()
+        ids = _claim_batch(batch_size, now)
+        if not ids:
+            break
+        batches += 1
+
+        emails = db.session.execute(
+            select(OutboundEmail).where(OutboundEmail.id.in_(ids))
+            .options(undefer(OutboundEmail.html_content), undefer(OutboundEmail.attachment))
+            .order_by(OutboundEmail.id)
+        ).scalars().all()
+
+        ready, messages, outcomes = [], [], []
+        for email in emails:
+            attachment = email.attachment
+            if attachment is None and email.attachment_key:
+                attachment, render_status = _report_attachment(email.attachment_key)
+                if render_status in ('pending', 'rendering'):
+                    # Not an attempt: check again once the render has had time to finish
+                    email.status = 'queued'
+                    email.next_attempt_at = now + timedelta(seconds=ATTACHMENT_WAIT_SECONDS)
+                    counts['waiting'] += 1
+                    continue
+                if attachment is None:
+                    outcomes.append((email, f"Report render {render_status}"))
+                    _rerequest_report(email)
+                    continue
+            ready.append(email)
+            messages.append(build_message(email.to_email, email.subject, email.html_content, attachment,
+                                          email.from_email, email.attachment_name))
+
+        if messages:
+            try:
+                results = transport.send_batch(messages)
+            except Exception as e:
+                # The connection could not be opened; nothing in the batch was sent
+                results = [str(e)] * len(messages)
+            outcomes.extend(zip(ready, results))
+
+        finished = datetime.utcnow()
+        for email, error in outcomes:
+            email.attempts += 1
+            if error is None:
+                email.status = 'sent'
+                email.sent_at = finished
+                email.last_error = None
+                counts['sent'] += 1
+            elif email.attempts >= MAX_ATTEMPTS:
+                email.status = 'failed'
+                email.last_error = error
+                counts['failed'] += 1
+                logger.error(f"Email {email.id} to {email.to_email} failed permanently: {error}")
+            else:
+                email.status = 'queued'
+                email.last_error = error
+                email.next_attempt_at = finished + retry_delay(email.attempts)
+                counts['retried'] += 1
+                logger.warning(f"Email {email.id} attempt {email.attempts} failed, retrying: {error}")
+        db.session.commit()
+    return counts
+
+
+def _rerequest_report(email):
+    """Queue a fresh render for an email whose report render failed or was lost."""
+    from report_artifacts import request_client_report
+
+    try:
+        artifact = request_client_report(email.client_id) if email.client_id else None
+    except Exception as e:
+        logger.error(f"Could not re-queue report for email {email.id}: {str(e)}")
+        return
+    if artifact is not None:
+        email.attachment_key = artifact.job_key
+
+
+class OutboxWorker:
+    """Daemon thread that drains the outbox when woken and every poll_seconds."""
+
+    def __init__(self, app, poll_seconds=15, batch_size=DEFAULT_BATCH_SIZE):
+        self.app = app
+        self.poll_seconds = poll_seconds
+        self.batch_size = batch_size
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='email-outbox', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            timeout = self.poll_seconds
+            try:
+                with self.app.app_context():
+                    counts = drain_outbox(batch_size=self.batch_size)
+                if counts['waiting']:
+                    timeout = min(timeout, ATTACHMENT_WAIT_SECONDS)
+            except Exception as e:
+                logger.error(f"Email outbox drain failed: {str(e)}")
+            self._wake.wait(timeout)
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def start_outbox_worker(app):
+    """Start the process-wide outbox worker for app (once) and return it."""
+    global _worker
+    if _worker is not None:
+        return _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = OutboxWorker(
+                app,
+                poll_seconds=app.config.get('EMAIL_POLL_SECONDS', 15),
+                batch_size=app.config.get('EMAIL_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+            ).start()
+        return _worker
@@ -1,19 +1,223 @@
 """
 Email service for sending RMR reports
+Pluggable transports (SendGrid, SMTP, local .eml files) that send a batch
+of messages over one client/connection
 """
 import os
 import sys
 import base64
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import (
-    Mail, Attachment, FileContent, FileName,
-    FileType, Disposition, ContentId, Email,
-    To, Subject, PlainTextContent, HtmlContent
-)
+import smtplib
+from contextlib import contextmanager
+from datetime import datetime
+from email.message import EmailMessage
 
-def send_report_email(to_email, subject, html_content, pdf_content=None, from_email="reports@fitomics.com"):
+DEFAULT_FROM_EMAIL = "reports@fitomics.com"
+DEFAULT_ATTACHMENT_NAME = 'rmr_report.pdf'
+
+def build_message(to_email, subject, html_content, pdf_content=None, from_email=DEFAULT_FROM_EMAIL,
+                  attachment_name=DEFAULT_ATTACHMENT_NAME):
+    """
+    Transport-neutral message dict accepted by every EmailTransport
+    
+    Args:
+        to_email (str): Recipient email address
+        subject (str): Email subject
+        html_content (str): HTML content of the email
+        pdf_content (bytes, optional): PDF report content as bytes
+        from_email (str, optional): Sender email address
+        attachment_name (str, optional): Filename of the PDF attachment
+        
+    Returns:
+        dict: Message fields
+    """
+    return {
+        'to_email': to_email,
+        'from_email': from_email,
+        'subject': subject,
+        'html_content': html_content,
+        'attachment': pdf_content,
+        'attachment_name': attachment_name,
+    }
+
+def mime_message(message):
+    """Build a MIME message (HTML body plus optional PDF) from a message dict"""
+    mime = EmailMessage()
+    mime['From'] = message['from_email']
+    mime['To'] = message['to_email']
+    mime['Subject'] = message['subject']
+    mime.set_content('This message requires an HTML capable email client.')
+    mime.add_alternative(message['html_content'], subtype='html')
+    if message.get('attachment'):
+        mime.add_attachment(message['attachment'], maintype='application', subtype='pdf',
+                            filename=message.get('attachment_name') or DEFAULT_ATTACHMENT_NAME)
+    return mime
+
+class EmailTransport:
+    """
+    Base transport: send_batch() opens one connection and sends every message over it
+    
+    Subclasses implement connection() and _send(connection, message).
+    """
+    
+    name = None
+    
+    @contextmanager
+    def connection(self):
+        yield None
+    
+    def _send(self, connection, message):
+        raise NotImplementedError
+    
+    def send_batch(self, messages):
+        """
+        Send messages over a single connection
+        
+        Args:
+            messages (list): Message dicts from build_message
+            
+        Returns:
+            list: None for each message sent, or the error string for each one that failed
+            
+        Raises:
+            Exception: If the connection itself cannot be opened (nothing was sent)
+        """
+        results = []
+        with self.connection() as connection:
+            for message in messages:
+                try:
+                    self._send(connection, message)
+                    results.append(None)
+                except Exception as e:
+                    results.append(str(e))
+        return results
+
+class SendGridTransport(EmailTransport):
+    """Sends through the SendGrid API with one long-lived API client"""
+    
+    name = 'sendgrid'
+    
+    def __init__(self, api_key=None):
+        from sendgrid import SendGridAPIClient
+        
+        api_key = api_key or os.environ.get('SENDGRID_API_KEY')
+        if not api_key:
+            raise ValueError("SENDGRID_API_KEY environment variable is not set")
+        self.client = SendGridAPIClient(api_key)
+    
+    @contextmanager
+    def connection(self):
+        yield self.client
+    
+    def _send(self, client, message):
+        from sendgrid.helpers.mail import (
+            Mail, Attachment, FileContent, FileName,
+            FileType, Disposition, ContentId
+        )
+        
+        mail = Mail(
+            from_email=message['from_email'],
+            to_emails=message['to_email'],
+            subject=message['subject'],
+            html_content=message['html_content']
+        )
+        
+        # Add PDF attachment if provided
+        if message.get('attachment'):
+            encoded_content = base64.b64encode(message['attachment']).decode()
+            attachment = Attachment()
+            attachment.file_content = FileContent(encoded_content)
+            attachment.file_name = FileName(message.get('attachment_name') or DEFAULT_ATTACHMENT_NAME)
+            attachment.file_type = FileType('application/pdf')
+            attachment.disposition = Disposition('attachment')
+            attachment.content_id = ContentId('rmr_report')
+            mail.add_attachment(attachment)
+        
+        response = client.send(mail)
+        if response.status_code >= 400:
+            raise RuntimeError(f"SendGrid returned HTTP {response.status_code}")
+
+class SmtpTransport(EmailTransport):
+    """Sends over SMTP, one session (connect, STARTTLS, login) per batch"""
+    
+    name = 'smtp'
+    
+    def __init__(self, host=None, port=None, username=None, password=None, starttls=None):
+        self.host = host or os.environ.get('SMTP_HOST', 'localhost')
+        self.port = int(port or os.environ.get('SMTP_PORT', 587))
+        self.username = username or os.environ.get('SMTP_USERNAME')
+        self.password = password or os.environ.get('SMTP_PASSWORD')
+        if starttls is None:
+            starttls = os.environ.get('SMTP_STARTTLS', '1') not in ('0', 'false', 'False')
+        self.starttls = starttls
+    
+    @contextmanager
+    def connection(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=30)
+        try:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password or '')
+            yield smtp
+        finally:
+            try:
+                smtp.quit()
+            except smtplib.SMTPException:
+                smtp.close()
+    
+    def _send(self, smtp, message):
+        smtp.send_message(mime_message(message))
+
+class FileTransport(EmailTransport):
+    """Writes each message as an .eml file; for development and tests"""
+    
+    name = 'file'
+    
+    def __init__(self, directory=None):
+        self.directory = directory or os.environ.get('EMAIL_FILE_DIR', os.path.join('instance', 'outbox'))
+        os.makedirs(self.directory, exist_ok=True)
+    
+    @contextmanager
+    def connection(self):
+        yield self.directory
+    
+    def _send(self, directory, message):
+        stamp = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+        path = os.path.join(directory, f"{stamp}_{os.getpid()}.eml")
+        with open(path, 'wb') as f:
+            f.write(bytes(mime_message(message)))
+
+EMAIL_TRANSPORTS = {
+    SendGridTransport.name: SendGridTransport,
+    SmtpTransport.name: SmtpTransport,
+    FileTransport.name: FileTransport,
+}
+
+_transports = {}
+
+def get_transport(name=None):
+    """
+    Process-wide transport instance, created on first use
+    
+    Args:
+        name (str, optional): 'sendgrid', 'smtp' or 'file'; defaults to the
+            EMAIL_TRANSPORT environment variable and then sendgrid
+            
+    Returns:
+        EmailTransport
+    """
+    name = name or os.environ.get('EMAIL_TRANSPORT', SendGridTransport.name)
+    if name not in EMAIL_TRANSPORTS:
+        raise ValueError(f"Unknown email transport: {name}")
+    if name not in _transports:
+        _transports[name] = EMAIL_TRANSPORTS[name]()
+    return _transports[name]
+
+def send_report_email(to_email, subject, html_content, pdf_content=None, from_email=DEFAULT_FROM_EMAIL):
     """
-    Send an email with the RMR report
+    Send an email with the RMR report right away through the configured transport
+    
+    Web requests should queue mail with email_outbox.enqueue_email instead.
     
     Args:
         to_email (str): Recipient email address
@@ -23,47 +227,23 @@ def send_report_email(to_email, subject, html_content, pdf_content=None, from_em
         from_email (str, optional): Sender email address
         
     Returns:
-        dict: Response from SendGrid API
+        dict: Send status
     """
-    # Check for SendGrid API key
-    api_key = os.environ.get('SENDGRID_API_KEY')
-    if not api_key:
-        raise ValueError("SENDGRID_API_KEY environment variable is not set")
-    
-    # Create message
-    message = Mail(
-        from_email=from_email,
-        to_emails=to_email,
-        subject=subject,
-        html_content=html_content
-    )
-    
-    # Add PDF attachment if provided
-    if pdf_content:
-        encoded_content = base64.b64encode(pdf_content).decode()
-        attachment = Attachment()
-        attachment.file_content = FileContent(encoded_content)
-        attachment.file_name = FileName('rmr_report.pdf')
-        attachment.file_type = FileType('application/pdf')
-        attachment.disposition = Disposition('attachment')
-        attachment.content_id = ContentId('rmr_report')
-        message.add_attachment(attachment)
-    
-    # Send email
+    transport = get_transport()
     try:
-        sg = SendGridAPIClient(api_key)
-        response = sg.send(message)
-        return {
-            'status': 'success',
-            'status_code': response.status_code,
-            'message': 'Email sent successfully'
-        }
+        error = transport.send_batch([build_message(to_email, subject, html_content, pdf_content, from_email)])[0]
     except Exception as e:
-        print(f"Error sending email: {e}", file=sys.stderr)
+        error = str(e)
+    if error:
+        print(f"Error sending email: {error}", file=sys.stderr)
         return {
             'status': 'error',
-            'message': str(e)
+            'message': error
         }
+    return {
+        'status': 'success',
+        'message': 'Email sent successfully'
+    }
 
 def create_html_report(client_data, report_data):
     """
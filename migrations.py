@@ -0,0 +1,114 @@
+"""
+Schema migrations
+Versioned, idempotent upgrade steps for databases created before a model
+change; db.create_all() only creates missing tables, never new indexes or
+columns on existing ones
+"""
+
+import logging
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select
+
+from models import db, Client, RmrData, BodyCompositionData, UltrasoundData, OutboundEmail, ReportArtifact
+
+logger = logging.getLogger(__name__)
+
+# Kept out of db.metadata so db.create_all()/drop_all() never touch it
+_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def create_model_indexes(connection, model, names):
+    """Create the named indexes declared on a model if they do not exist yet."""
+    existing = {ix['name'] for ix in inspect(connection).get_indexes(model.__tablename__)}
+    for index in model.__table__.indexes:
+        if index.name in names and index.name not in existing:
+            logger.info(f"Creating index {index.name}")
+            index.create(connection)
+
+
+def add_model_columns(connection, model, names):
+    """Add the named columns declared on a model if the table does not have them yet."""
+    table = model.__tablename__
+    existing = {column['name'] for column in inspect(connection).get_columns(table)}
+    for name in names:
+        if name not in existing:
+            column = model.__table__.c[name]
+            logger.info(f"Adding column {table}.{name}")
+            connection.exec_driver_sql(
+                f"ALTER TABLE {table} ADD COLUMN {name} {column.type.compile(connection.dialect)}")
+
+
+def _client_listing_indexes(connection):
+    create_model_indexes(connection, Client, {
+        'ix_client_updated_at_id', 'ix_client_last_first', 'ix_client_test_date',
+        'ix_client_gender_test_date', 'ix_client_scan_device_test_date',
+    })
+
+
+def _child_table_indexes(connection):
+    create_model_indexes(connection, RmrData, {'ix_rmr_data_client_created'})
+    create_model_indexes(connection, BodyCompositionData, {'ix_body_composition_client_measurement_date'})
+    create_model_indexes(connection, UltrasoundData, {'ix_ultrasound_client_site_date'})
+
+
+def _outbound_email_attachment_key(connection):
+    add_model_columns(connection, OutboundEmail, ['attachment_key'])
+
+
+def _report_artifact_inputs_key(connection):
+    add_model_columns(connection, ReportArtifact, ['inputs_key'])
+
+
+# (version, name, upgrade function); append new steps, never reorder
+MIGRATIONS = [
+    (1, 'client listing and search indexes', _client_listing_indexes),
+    (2, 'child table client_id composite indexes', _child_table_indexes),
+    (3, 'outbound email report attachment key', _outbound_email_attachment_key),
+    (4, 'report artifact inputs key', _report_artifact_inputs_key),
+]
+
+
+def applied_versions(connection):
+    _metadata.create_all(connection)
+    return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+
+def upgrade_database(engine=None):
+    """
+    Apply every pending migration, each in its own transaction
+
+    Args:
+        engine (Engine, optional): Defaults to db.engine (requires an app context)
+
+    Returns:
+        list: (version, name) of the migrations applied by this call
+    """
+    engine = engine or db.engine
+    applied = []
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+    for version, name, upgrade in MIGRATIONS:
+        if version in done:
+            continue
+        with engine.begin() as connection:
+            upgrade(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=version, name=name, applied_at=datetime.utcnow()))
+        logger.info(f"Applied migration {version}: {name}")
+        applied.append((version, name))
+    return applied
+
+
+def migration_status(engine=None):
+    """List every known migration with whether it has been applied."""
+    engine = engine or db.engine
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+    return [(version, name, version in done) for version, name, _ in MIGRATIONS]
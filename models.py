@@ -1,10 +1,26 @@
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import datetime, date
 
 db = SQLAlchemy()
 
 class Client(db.Model):
     """Client model to store client information and test results"""
+    __table_args__ = (
+        # Keyset pagination of the client listing: ORDER BY updated_at DESC, id DESC
+        db.Index('ix_client_updated_at_id', 'updated_at', 'id'),
+        # Front-desk search and filters
+        db.Index('ix_client_last_first', 'last_name', 'first_name'),
+        db.Index('ix_client_test_date', 'test_date'),
+        db.Index('ix_client_gender_test_date', 'gender', 'test_date'),
+        db.Index('ix_client_scan_device_test_date', 'scan_device', 'test_date'),
+    )
+    
+    # Columns returned by the lightweight listing serializer
+    SUMMARY_FIELDS = (
+        'id', 'first_name', 'last_name', 'age', 'gender', 'test_date', 'scan_device',
+        'rmr_kcal_day', 'body_fat_percent', 'updated_at'
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.String(100), nullable=False)
     last_name = db.Column(db.String(100), nullable=False)
@@ -49,6 +65,15 @@ class Client(db.Model):
     specific_gravity = db.Column(db.Float)
     scan_device = db.Column(db.String(50))  # Fit3D or Styku
     
+    # Child collections; load them with selectinload()/joinedload() options
+    # (see load_client_bundle) instead of relying on per-attribute lazy loads
+    rmr_points = db.relationship('RmrData', back_populates='client', order_by='RmrData.id')
+    scan_measurements = db.relationship('BodyCompositionData', back_populates='client',
+                                        order_by='BodyCompositionData.id')
+    ultrasound_sites = db.relationship('UltrasoundData', back_populates='client',
+                                       order_by='UltrasoundData.id')
+    rmr_sessions = db.relationship('RmrSession', back_populates='client', order_by='RmrSession.id')
+    
     def to_dict(self):
         """Convert client object to dictionary"""
         return {
@@ -97,9 +122,29 @@ class Client(db.Model):
             'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
             'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S')
         }
+    
+    def to_summary_dict(self):
+        """Convert client object to the lightweight listing dictionary"""
+        return Client.serialize_fields({name: getattr(self, name) for name in Client.SUMMARY_FIELDS})
+    
+    @staticmethod
+    def serialize_fields(values):
+        """Format a mapping of column name -> value the same way to_dict does"""
+        result = {}
+        for name, value in values.items():
+            if isinstance(value, datetime):
+                value = value.strftime('%Y-%m-%d %H:%M:%S')
+            elif isinstance(value, date):
+                value = value.strftime('%Y-%m-%d')
+            result[name] = value
+        return result
 
 class RmrData(db.Model):
     """Model to store raw RMR data points"""
+    __table_args__ = (
+        db.Index('ix_rmr_data_client_created', 'client_id', 'created_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
     time_point = db.Column(db.String(10))  # e.g., "0:00", "0:14", etc.
@@ -115,6 +160,8 @@ class RmrData(db.Model):
     feco2 = db.Column(db.Float)
     rer = db.Column(db.Float)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    client = db.relationship('Client', back_populates='rmr_points')
 
     def to_dict(self):
         """Convert RMR data point to dictionary"""
@@ -136,8 +183,46 @@ class RmrData(db.Model):
             'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S')
         }
 
+class RmrSession(db.Model):
+    """Model to store one RMR test as packed columnar signal arrays (see series_store.py)"""
+    __table_args__ = (
+        db.Index('ix_rmr_session_client_test_date', 'client_id', 'test_date'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    test_date = db.Column(db.Date)
+    sample_count = db.Column(db.Integer, nullable=False)
+    signals = db.Column(db.String(255), nullable=False)  # Comma-separated signal names, in blob order
+    dtype = db.Column(db.String(10), nullable=False)  # 'float32' or 'float64'
+    codec = db.Column(db.String(10), nullable=False)  # 'zlib' or 'raw'
+    stored_bytes = db.Column(db.Integer, nullable=False)
+    time_points = db.deferred(db.Column(db.Text))  # Newline-separated time strings, e.g. "0:00"
+    series = db.deferred(db.Column(db.LargeBinary, nullable=False))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    client = db.relationship('Client', back_populates='rmr_sessions')
+    
+    def to_dict(self):
+        """Convert RMR session header to dictionary (without the packed series)"""
+        return {
+            'id': self.id,
+            'client_id': self.client_id,
+            'test_date': self.test_date.strftime('%Y-%m-%d') if self.test_date else None,
+            'sample_count': self.sample_count,
+            'signals': self.signals.split(','),
+            'dtype': self.dtype,
+            'codec': self.codec,
+            'stored_bytes': self.stored_bytes,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
 class BodyCompositionData(db.Model):
     """Model to store body composition measurement data"""
+    __table_args__ = (
+        db.Index('ix_body_composition_client_measurement_date', 'client_id', 'measurement_name', 'scan_date'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
     scan_date = db.Column(db.DateTime)
@@ -150,6 +235,8 @@ class BodyCompositionData(db.Model):
     
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    client = db.relationship('Client', back_populates='scan_measurements')
+    
     def to_dict(self):
         """Convert body composition data point to dictionary"""
         return {
@@ -165,6 +252,10 @@ class BodyCompositionData(db.Model):
 
 class UltrasoundData(db.Model):
     """Model to store body composition ultrasound data"""
+    __table_args__ = (
+        db.Index('ix_ultrasound_client_site_date', 'client_id', 'site_name', 'date'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
     date = db.Column(db.DateTime)
@@ -175,6 +266,8 @@ class UltrasoundData(db.Model):
     
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    client = db.relationship('Client', back_populates='ultrasound_sites')
+    
     def to_dict(self):
         """Convert ultrasound data point to dictionary"""
         return {
@@ -185,3 +278,154 @@ class UltrasoundData(db.Model):
             'measurement_value': self.measurement_value,
             'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S')
         }
+
+class OutboundEmail(db.Model):
+    """Model to store queued outgoing email until the outbox worker delivers it (see email_outbox.py)"""
+    __table_args__ = (
+        # Outbox drain: WHERE status IN (...) AND next_attempt_at <= now
+        db.Index('ix_outbound_email_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'))
+    to_email = db.Column(db.String(255), nullable=False)
+    from_email = db.Column(db.String(255), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html_content = db.deferred(db.Column(db.Text, nullable=False))
+    attachment_name = db.Column(db.String(255))
+    attachment = db.deferred(db.Column(db.LargeBinary))
+    attachment_key = db.Column(db.String(64))  # Report render to attach once finished (see report_artifacts.py)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, sending, sent or failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    
+    def to_dict(self):
+        """Convert outbound email to dictionary (without content and attachment)"""
+        return {
+            'id': self.id,
+            'client_id': self.client_id,
+            'to_email': self.to_email,
+            'subject': self.subject,
+            'attachment_name': self.attachment_name,
+            'attachment_key': self.attachment_key,
+            'status': self.status,
+            'attempts': self.attempts,
+            'next_attempt_at': self.next_attempt_at.strftime('%Y-%m-%d %H:%M:%S') if self.next_attempt_at else None,
+            'last_error': self.last_error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'sent_at': self.sent_at.strftime('%Y-%m-%d %H:%M:%S') if self.sent_at else None
+        }
+
+class ReportArtifact(db.Model):
+    """Model to map a client's test date to the rendered report PDF in the render cache (see report_artifacts.py)"""
+    __table_args__ = (
+        db.UniqueConstraint('client_id', 'test_date', name='uq_report_artifact_client_test_date'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    test_date = db.Column(db.Date, nullable=False)
+    job_key = db.Column(db.String(64), nullable=False)  # ReportRenderQueue cache key
+    inputs_key = db.Column(db.String(64))  # client_inputs_key() of the stored data the PDF shows
+    filename = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def to_dict(self):
+        """Convert report artifact to dictionary"""
+        return {
+            'id': self.id,
+            'client_id': self.client_id,
+            'test_date': self.test_date.strftime('%Y-%m-%d'),
+            'job_key': self.job_key,
+            'inputs_key': self.inputs_key,
+            'filename': self.filename,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+class TestSummary(db.Model):
+    """Model to store precomputed per-test aggregates for longitudinal trends (see rmr_trends.py)"""
+    __table_args__ = (
+        db.UniqueConstraint('client_id', 'test_date', name='uq_test_summary_client_test_date'),
+    )
+    
+    # Aggregate columns returned by the trend endpoint, in order
+    TREND_FIELDS = (
+        'sample_count', 'rmr_kcal_day', 'rmr_ci_lower', 'rmr_ci_upper',
+        'vo2_mean', 'vo2_ci_lower', 'vo2_ci_upper', 'vco2_mean',
+        'rer_mean', 'rer_ci_lower', 'rer_ci_upper', 'predicted_rmr', 'rmr_percent_predicted',
+        'fat_oxidation', 'carb_oxidation',
+        'weight_kg', 'body_fat_percent', 'fat_mass_kg', 'lean_mass_kg',
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    test_date = db.Column(db.Date)
+    
+    # RMR session aggregates
+    sample_count = db.Column(db.Integer)
+    rmr_kcal_day = db.Column(db.Float)
+    rmr_ci_lower = db.Column(db.Float)
+    rmr_ci_upper = db.Column(db.Float)
+    vo2_mean = db.Column(db.Float)
+    vo2_ci_lower = db.Column(db.Float)
+    vo2_ci_upper = db.Column(db.Float)
+    vco2_mean = db.Column(db.Float)
+    rer_mean = db.Column(db.Float)
+    rer_ci_lower = db.Column(db.Float)
+    rer_ci_upper = db.Column(db.Float)
+    predicted_rmr = db.Column(db.Float)
+    rmr_percent_predicted = db.Column(db.Float)
+    fat_oxidation = db.Column(db.Float)
+    carb_oxidation = db.Column(db.Float)
+    
+    # Body composition on the test date
+    weight_kg = db.Column(db.Float)
+    body_fat_percent = db.Column(db.Float)
+    fat_mass_kg = db.Column(db.Float)
+    lean_mass_kg = db.Column(db.Float)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def to_dict(self):
+        """Convert test summary to dictionary"""
+        data = {
+            'id': self.id,
+            'client_id': self.client_id,
+            'test_date': self.test_date.strftime('%Y-%m-%d') if self.test_date else None,
+        }
+        data.update({name: getattr(self, name) for name in TestSummary.TREND_FIELDS})
+        data['updated_at'] = self.updated_at.strftime('%Y-%m-%d %H:%M:%S')
+        return data
+
+class ImportedFile(db.Model):
+    """Model to record archive files loaded by the bulk import, keyed by content hash (see bulk_import.py)"""
+    
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False)
+    path = db.Column(db.String(1024), nullable=False)  # As found on the first import
+    kind = db.Column(db.String(20))  # 'rmr', 'scan' or 'ultrasound'
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'))
+    test_date = db.Column(db.Date)
+    status = db.Column(db.String(20), nullable=False)  # 'imported' or 'failed' (retried on the next run)
+    error = db.Column(db.Text)
+    imported_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        """Convert imported file record to dictionary"""
+        return {
+            'id': self.id,
+            'sha256': self.sha256,
+            'path': self.path,
+            'kind': self.kind,
+            'client_id': self.client_id,
+            'test_date': self.test_date.strftime('%Y-%m-%d') if self.test_date else None,
+            'status': self.status,
+            'error': self.error,
+            'imported_at': self.imported_at.strftime('%Y-%m-%d %H:%M:%S')
+        }
@@ -7,8 +7,41 @@ import pdfkit
 import os
 import base64
 import io
+import mimetypes
+import threading
+import time
 from datetime import datetime
-from flask import render_template, current_app
+from flask import current_app
+
+# wkhtmltopdf options for all body composition reports
+PDF_OPTIONS = {
+    'page-size': 'Letter',
+    'margin-top': '0.75in',
+    'margin-right': '0.75in',
+    'margin-bottom': '0.75in',
+    'margin-left': '0.75in',
+    'encoding': 'UTF-8',
+    'no-outline': None,
+}
+
+# Same page setup as PDF_OPTIONS, for renderers that take CSS
+PDF_PAGE_CSS = '@page { size: Letter; margin: 0.75in; }'
+
+REPORT_TEMPLATE = 'report_template.html'
+
+# Logo candidates relative to the app root; the first one found is inlined
+REPORT_LOGO_PATHS = (
+    os.path.join('static', 'img', 'fitomics_logo.png'),
+    os.path.join('attached_assets', 'Fitomics Logomark – Dark Blue.png'),
+)
+
+# Stylesheets relative to the app root, inlined into the report as report_css
+REPORT_STYLESHEETS = (
+    os.path.join('static', 'css', 'report.css'),
+)
+
+# Seconds between mtime checks of the cached report assets
+ASSET_CHECK_INTERVAL = 5.0
 
 def generate_body_composition_report(client_data, scan_data=None, ultrasound_data=None, 
                                      body_density=None, body_fat_results=None):
@@ -26,85 +59,267 @@ def generate_body_composition_report(client_data, scan_data=None, ultrasound_dat
         bytes: PDF file as bytes
     """
     try:
-        # Prepare client info
-        client_info = {
-            'name': f"{client_data.get('first_name', '')} {client_data.get('last_name', '')}",
-            'age': client_data.get('age', ''),
-            'gender': client_data.get('gender', ''),
-            'height_cm': client_data.get('height_cm', ''),
-            'height_in': client_data.get('height_in', ''),
-            'weight_kg': client_data.get('weight_kg', ''),
-            'weight_lbs': client_data.get('weight_lbs', ''),
-            'test_date': client_data.get('test_date', datetime.now().strftime('%Y-%m-%d')),
-        }
+        html_content = render_body_composition_html(
+            client_data, scan_data, ultrasound_data, body_density, body_fat_results
+        )
+        return html_to_pdf(html_content)
         
-        # Get water data
-        water_data = {
-            'water_percent1': client_data.get('water_percent1', ''),
-            'water_percent2': client_data.get('water_percent2', ''),
-            'water_percent3': client_data.get('water_percent3', ''),
-            'water_device1': client_data.get('water_device1', ''),
-            'water_device2': client_data.get('water_device2', ''),
-            'water_device3': client_data.get('water_device3', ''),
-            'water_liters1': client_data.get('water_liters1', ''),
-            'water_liters2': client_data.get('water_liters2', ''),
-            'water_liters3': client_data.get('water_liters3', ''),
-            'water_liters_avg': client_data.get('water_liters_avg', ''),
-            'water_liters_final': client_data.get('water_liters_final', ''),
-            'specific_gravity': client_data.get('specific_gravity', ''),
-        }
+    except Exception as e:
+        current_app.logger.error(f"Error generating PDF report: {str(e)}")
+        raise
+
+def render_body_composition_html(client_data, scan_data=None, ultrasound_data=None,
+                                 body_density=None, body_fat_results=None, report_date=None):
+    """
+    Render the body composition report HTML (requires an app context)
+    
+    Args:
+        client_data (dict): Client personal information and metrics
+        scan_data (dict, optional): 3D scan data results
+        ultrasound_data (dict, optional): Ultrasound measurement data
+        body_density (float, optional): Calculated body density
+        body_fat_results (dict, optional): Body fat calculation results
+        report_date (str, optional): Date printed on the report, defaults to today
         
-        # Organize 3C-Model results
-        model_results = {}
-        if body_fat_results:
-            model_results = {
-                'body_fat': body_fat_results.get('body_fat_3c', ''),
-                'fat_mass_kg': body_fat_results.get('fat_mass_kg', ''),
-                'fat_mass_lbs': body_fat_results.get('fat_mass_lbs', ''),
-                'ffm_kg': body_fat_results.get('ffm_kg', ''),
-                'ffm_lbs': body_fat_results.get('ffm_lbs', ''),
-                'fmi': body_fat_results.get('fmi', ''),
-                'ffmi': body_fat_results.get('ffmi', ''),
-                'body_density': body_density or '',
-            }
+    Returns:
+        str: Report HTML ready for html_to_pdf
+    """
+    # Prepare client info
+    client_info = {
+        'name': f"{client_data.get('first_name', '')} {client_data.get('last_name', '')}",
+        'age': client_data.get('age', ''),
+        'gender': client_data.get('gender', ''),
+        'height_cm': client_data.get('height_cm', ''),
+        'height_in': client_data.get('height_in', ''),
+        'weight_kg': client_data.get('weight_kg', ''),
+        'weight_lbs': client_data.get('weight_lbs', ''),
+        'test_date': client_data.get('test_date', datetime.now().strftime('%Y-%m-%d')),
+    }
+    
+    # Get water data
+    water_data = {
+        'water_percent1': client_data.get('water_percent1', ''),
+        'water_percent2': client_data.get('water_percent2', ''),
+        'water_percent3': client_data.get('water_percent3', ''),
+        'water_device1': client_data.get('water_device1', ''),
+        'water_device2': client_data.get('water_device2', ''),
+        'water_device3': client_data.get('water_device3', ''),
+        'water_liters1': client_data.get('water_liters1', ''),
+        'water_liters2': client_data.get('water_liters2', ''),
+        'water_liters3': client_data.get('water_liters3', ''),
+        'water_liters_avg': client_data.get('water_liters_avg', ''),
+        'water_liters_final': client_data.get('water_liters_final', ''),
+        'specific_gravity': client_data.get('specific_gravity', ''),
+    }
+    
+    # Organize 3C-Model results
+    model_results = {}
+    if body_fat_results:
+        model_results = {
+            'body_fat': body_fat_results.get('body_fat_3c', ''),
+            'fat_mass_kg': body_fat_results.get('fat_mass_kg', ''),
+            'fat_mass_lbs': body_fat_results.get('fat_mass_lbs', ''),
+            'ffm_kg': body_fat_results.get('ffm_kg', ''),
+            'ffm_lbs': body_fat_results.get('ffm_lbs', ''),
+            'fmi': body_fat_results.get('fmi', ''),
+            'ffmi': body_fat_results.get('ffmi', ''),
+            'body_density': body_density or '',
+        }
+    
+    # Population percentiles of the client's results (empty until the index is built)
+    from percentile_index import record_percentiles
+    
+    percentiles = record_percentiles([{
+        'gender': client_data.get('gender'),
+        'age': client_data.get('age'),
+        'body_fat_percent': (body_fat_results or {}).get('body_fat_3c') or client_data.get('body_fat_percent'),
+        'ffmi': (body_fat_results or {}).get('ffmi'),
+        'lean_mass_kg': client_data.get('lean_mass_kg'),
+        'height_cm': client_data.get('height_cm'),
+        'rmr_percent_predicted': client_data.get('rmr_percent_predicted'),
+    }])[0]
+    
+    assets = report_assets()
+    context = dict(
+        client=client_info,
+        water=water_data,
+        scan=scan_data,
+        ultrasound=ultrasound_data,
+        model_results=model_results,
+        percentiles=percentiles,
+        report_date=report_date or datetime.now().strftime('%Y-%m-%d'),
+        # Inlined as data: URIs / CSS text so the HTML needs no local file access
+        logo_path=assets.logo_data_uri,
+        report_css=assets.css,
+    )
+    current_app.update_template_context(context)
+    return assets.template.render(context)
+
+class ReportAssets:
+    """
+    Compiled report template plus the logo and stylesheets it embeds
+    
+    Everything is loaded once and reloaded only when one of the files changes
+    on disk. Modification times are checked at most every ASSET_CHECK_INTERVAL
+    seconds, so rendering a report normally touches no files.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+        self.template = None
+        self.logo_data_uri = ''
+        self.css = ''
+        self._mtimes = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+    
+    def _template_path(self):
+        return os.path.join(self.app.root_path, self.app.template_folder or 'templates', REPORT_TEMPLATE)
+    
+    def _snapshot(self):
+        paths = [os.path.join(self.app.root_path, path) for path in REPORT_LOGO_PATHS + REPORT_STYLESHEETS]
+        paths.append(self._template_path())
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+    
+    def _load(self, mtimes):
+        self.template = self.app.jinja_env.get_template(REPORT_TEMPLATE)
         
-        # Get logos and branding
-        logo_path = os.path.join('static', 'img', 'fitomics_logo.png')
-        if not os.path.isfile(os.path.join(current_app.root_path, logo_path)):
-            logo_path = os.path.join('attached_assets', 'Fitomics Logomark – Dark Blue.png')
+        self.logo_data_uri = ''
+        for path in REPORT_LOGO_PATHS:
+            path = os.path.join(self.app.root_path, path)
+            if mtimes.get(path) is not None:
+                mime_type = mimetypes.guess_type(path)[0] or 'image/png'
+                self.logo_data_uri = f"data:{mime_type};base64,{encode_image_base64(path)}"
+                break
         
-        # Render HTML template
-        html_content = render_template(
-            'report_template.html',
-            client=client_info,
-            water=water_data,
-            scan=scan_data,
-            ultrasound=ultrasound_data,
-            model_results=model_results,
-            report_date=datetime.now().strftime('%Y-%m-%d'),
-            logo_path=logo_path
-        )
+        stylesheets = []
+        for path in REPORT_STYLESHEETS:
+            path = os.path.join(self.app.root_path, path)
+            if mtimes.get(path) is not None:
+                with open(path, encoding='utf-8') as f:
+                    stylesheets.append(f.read())
+        self.css = '\n'.join(stylesheets)
         
-        # Configure PDF options
-        options = {
-            'page-size': 'Letter',
-            'margin-top': '0.75in',
-            'margin-right': '0.75in',
-            'margin-bottom': '0.75in',
-            'margin-left': '0.75in',
-            'encoding': 'UTF-8',
-            'no-outline': None,
-            'enable-local-file-access': '',
-        }
+        self._mtimes = mtimes
+    
+    def refresh(self, force=False):
+        """Reload the assets if any of their files changed (or if force is set)."""
+        now = time.monotonic()
+        if not force and self._mtimes is not None and now - self._checked < ASSET_CHECK_INTERVAL:
+            return self
+        with self._lock:
+            mtimes = self._snapshot()
+            if force or mtimes != self._mtimes:
+                self._load(mtimes)
+            self._checked = now
+        return self
+
+def report_assets(app=None):
+    """
+    Report assets for an app, loaded on first use (call once at startup to preload)
+    
+    Args:
+        app (Flask, optional): Defaults to current_app
         
-        # Generate PDF
-        pdf_content = pdfkit.from_string(html_content, False, options=options)
+    Returns:
+        ReportAssets: Up-to-date template, logo and stylesheets
+    """
+    app = app or current_app._get_current_object()
+    assets = app.extensions.get('report_assets')
+    if assets is None:
+        assets = app.extensions.setdefault('report_assets', ReportAssets(app))
+    return assets.refresh()
+
+class WkhtmltopdfRenderer:
+    """
+    Renders with the wkhtmltopdf binary through pdfkit
+    
+    The binary lookup (pdfkit spawns `which wkhtmltopdf` for every call made
+    without a configuration) is done once per renderer instead of per report.
+    """
+    
+    name = 'wkhtmltopdf'
+    
+    def __init__(self, binary=None):
+        self.configuration = pdfkit.configuration(wkhtmltopdf=binary or os.environ.get('WKHTMLTOPDF_BINARY', ''))
+    
+    def render(self, html_content, options=None):
+        return pdfkit.from_string(html_content, False, options=options or PDF_OPTIONS,
+                                  configuration=self.configuration)
+
+class WeasyPrintRenderer:
+    """
+    Renders in-process with WeasyPrint (optional dependency)
+    
+    No subprocess per report; the font configuration is built once and
+    reused. Page size and margins come from PDF_PAGE_CSS instead of the
+    wkhtmltopdf options.
+    """
+    
+    name = 'weasyprint'
+    
+    def __init__(self, base_url=None):
+        import weasyprint
+        from weasyprint.text.fonts import FontConfiguration
         
-        return pdf_content
+        self._weasyprint = weasyprint
+        self.font_config = FontConfiguration()
+        self.page_css = weasyprint.CSS(string=PDF_PAGE_CSS, font_config=self.font_config)
+        self.base_url = base_url
+    
+    def render(self, html_content, options=None):
+        document = self._weasyprint.HTML(string=html_content, base_url=self.base_url)
+        return document.write_pdf(stylesheets=[self.page_css], font_config=self.font_config)
+
+PDF_RENDERERS = {
+    WkhtmltopdfRenderer.name: WkhtmltopdfRenderer,
+    WeasyPrintRenderer.name: WeasyPrintRenderer,
+}
+
+_renderers = {}
+
+def get_renderer(name=None):
+    """
+    Process-wide renderer instance for a backend, created on first use
+    
+    Args:
+        name (str, optional): 'wkhtmltopdf' or 'weasyprint'; defaults to the
+            PDF_RENDERER app config (or environment variable) and then wkhtmltopdf
+            
+    Returns:
+        Renderer with a render(html_content, options=None) -> bytes method
+    """
+    if name is None:
+        try:
+            name = current_app.config.get('PDF_RENDERER')
+        except RuntimeError:  # No app context, e.g. in a render worker process
+            name = None
+        name = name or os.environ.get('PDF_RENDERER', WkhtmltopdfRenderer.name)
+    if name not in PDF_RENDERERS:
+        raise ValueError(f"Unknown PDF renderer: {name}")
+    if name not in _renderers:
+        _renderers[name] = PDF_RENDERERS[name]()
+    return _renderers[name]
+
+def html_to_pdf(html_content, options=None, renderer=None):
+    """
+    Convert report HTML to PDF bytes
+    
+    Args:
+        html_content (str): Rendered report HTML
+        options (dict, optional): wkhtmltopdf options, defaults to PDF_OPTIONS
+        renderer (str, optional): Backend name, see get_renderer
         
-    except Exception as e:
-        current_app.logger.error(f"Error generating PDF report: {str(e)}")
-        raise
+    Returns:
+        bytes: PDF file as bytes
+    """
+    return get_renderer(renderer).render(html_content, options)
 
 def encode_image_base64(image_path):
     """
@@ -0,0 +1,256 @@
+"""
+Normative percentile index
+Sorted per sex x age band arrays of body fat %, FFMI and RMR % predicted
+across saved clients, so a result is ranked against the population with a
+binary search instead of a scan of the Client table
+"""
+
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import select
+
+from body_composition import float_array, sex_codes
+from models import db, Client
+
+logger = logging.getLogger(__name__)
+
+PERCENTILE_METRICS = ('body_fat_percent', 'ffmi', 'rmr_percent_predicted')
+AGE_BAND_YEARS = 10
+# Bands 0-9, 10-19, ... with everyone from 90 up in the last one
+AGE_BANDS = 10
+SEXES = ('female', 'male')
+# Fewer reference values than this in a band gives no percentile
+MIN_BAND_SIZE = 20
+# Rebuild in the background once the index is older than this (seconds)
+DEFAULT_MAX_AGE = 3600
+
+
+def band_ids(genders, ages):
+    """Sex x age band group of every client (-1 where gender or age is missing or not a number)."""
+    ages = float_array(ages, lenient=True)
+    sex = sex_codes(genders)
+    with np.errstate(invalid='ignore'):
+        band = np.clip(np.nan_to_num(ages, nan=-1) // AGE_BAND_YEARS, 0, AGE_BANDS - 1).astype(np.int64)
+    return np.where((sex >= 0) & ~np.isnan(ages), sex * AGE_BANDS + band, -1)
+
+
+def band_label(group):
+    sex, band = divmod(int(group), AGE_BANDS)
+    low = band * AGE_BAND_YEARS
+    ages = f"{low}+" if band == AGE_BANDS - 1 else f"{low}-{low + AGE_BAND_YEARS - 1}"
+    return f"{SEXES[sex]} {ages}"
+
+
+def ffmi(lean_mass_kg, height_cm):
+    """Fat-free mass index (kg/m^2); NaN where either input is missing."""
+    lean_mass_kg = np.asarray(lean_mass_kg, dtype=np.float64)
+    height_m = np.asarray(height_cm, dtype=np.float64) / 100
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(height_m > 0, lean_mass_kg / (height_m * height_m), np.nan)
+
+
+class PercentileIndex:
+    """
+    Per-metric reference values sorted within each sex x age band group
+
+    Each metric is one float32 array holding every group's values back to
+    back plus an offsets array (group g is values[offsets[g]:offsets[g + 1]]),
+    so the whole index is a few contiguous arrays.
+    """
+
+    def __init__(self, values, offsets, built_at):
+        self.values = values
+        self.offsets = offsets
+        self.built_at = built_at
+
+    @classmethod
+    def build(cls, groups, columns):
+        """
+        Index reference values
+
+        Args:
+            groups (ndarray): band_ids() of every client
+            columns (dict): Metric name -> float values aligned with groups (NaN if missing)
+        """
+        values, offsets = {}, {}
+        n_groups = len(SEXES) * AGE_BANDS
+        for metric, column in columns.items():
+            column = np.asarray(column, dtype=np.float64)
+            keep = (groups >= 0) & ~np.isnan(column)
+            # Sort by group, then by value within the group
+            order = np.lexsort((column[keep], groups[keep]))
+            values[metric] = column[keep][order].astype(np.float32)
+            offsets[metric] = np.searchsorted(groups[keep][order], np.arange(n_groups + 1)).astype(np.int64)
+        return cls(values, offsets, time.time())
+
+    def ranks(self, metric, values, groups):
+        """
+        Percentile (0-100, mid-rank for ties) of each value within its group
+
+        Returns:
+            tuple: (percentiles, band sizes); NaN percentile where the value is
+                missing or its band has fewer than MIN_BAND_SIZE reference values
+        """
+        values = np.asarray(values, dtype=np.float64)
+        groups = np.asarray(groups, dtype=np.int64)
+        percentiles = np.full(len(values), np.nan)
+        sizes = np.zeros(len(values), dtype=np.int64)
+        reference, offsets = self.values[metric], self.offsets[metric]
+        for group in np.unique(groups[groups >= 0]):
+            lo, hi = offsets[group], offsets[group + 1]
+            rows = np.nonzero((groups == group) & ~np.isnan(values))[0]
+            sizes[groups == group] = hi - lo
+            if hi - lo < MIN_BAND_SIZE or not len(rows):
+                continue
+            band = reference[lo:hi]
+            query = values[rows].astype(np.float32)
+            below = np.searchsorted(band, query, side='left')
+            at_or_below = np.searchsorted(band, query, side='right')
+            percentiles[rows] = (below + at_or_below) / 2 / (hi - lo) * 100
+        return percentiles, sizes
+
+    def save(self, path):
+        arrays = {'built_at': np.array(self.built_at)}
+        for metric in self.values:
+            arrays[f'{metric}.values'] = self.values[metric]
+            arrays[f'{metric}.offsets'] = self.offsets[metric]
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            metrics = {name.rsplit('.', 1)[0] for name in data.files if name.endswith('.values')}
+            return cls({m: data[f'{m}.values'] for m in metrics}, {m: data[f'{m}.offsets'] for m in metrics},
+                       float(data['built_at']))
+
+
+def build_percentile_index():
+    """
+    Build the index from every saved client in one query over the needed columns
+
+    Must be called inside an app context.
+    """
+    table = Client.__table__
+    rows = db.session.execute(
+        select(table.c.gender, table.c.age, table.c.body_fat_percent, table.c.lean_mass_kg,
+               table.c.height_cm, table.c.rmr_percent_predicted)
+    ).all()
+
+    groups = band_ids([r.gender for r in rows], [r.age for r in rows])
+    rmr_percent = float_array([r.rmr_percent_predicted for r in rows])
+    return PercentileIndex.build(groups, {
+        'body_fat_percent': float_array([r.body_fat_percent for r in rows]),
+        'ffmi': ffmi(float_array([r.lean_mass_kg for r in rows]), float_array([r.height_cm for r in rows])),
+        # 0 means no RMR was measured
+        'rmr_percent_predicted': np.where(rmr_percent > 0, rmr_percent, np.nan),
+    })
+
+
+def index_path(app=None):
+    app = app or current_app
+    return app.config.get('PERCENTILE_INDEX_PATH') or os.path.join(app.instance_path, 'percentile_index.npz')
+
+
+_index = None
+_index_lock = threading.Lock()
+_rebuilding = threading.Event()
+
+
+def rebuild_percentile_index(app=None):
+    """Build, save and publish a fresh index (inside an app context unless app is given)."""
+    global _index
+    app = app or current_app._get_current_object()
+    with app.app_context():
+        index = build_percentile_index()
+        path = index_path(app)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        index.save(path)
+    with _index_lock:
+        _index = index
+    logger.info(f"Percentile index rebuilt ({', '.join(f'{m}: {len(v)}' for m, v in index.values.items())})")
+    return index
+
+
+def _rebuild_in_background(app):
+    def run():
+        try:
+            rebuild_percentile_index(app)
+        except Exception as e:
+            logger.error(f"Percentile index rebuild failed: {str(e)}")
+        finally:
+            _rebuilding.clear()
+
+    if not _rebuilding.is_set():
+        _rebuilding.set()
+        threading.Thread(target=run, name='percentile-index', daemon=True).start()
+
+
+def get_percentile_index():
+    """
+    The current index, loading it from disk on first use
+
+    An index older than PERCENTILE_INDEX_MAX_AGE is still served while a
+    background thread rebuilds it. Returns None until a first index exists.
+    """
+    global _index
+    app = current_app._get_current_object()
+    with _index_lock:
+        index = _index
+        if index is None and os.path.exists(index_path(app)):
+            try:
+                index = _index = PercentileIndex.load(index_path(app))
+            except Exception as e:
+                logger.error(f"Could not load percentile index: {str(e)}")
+    max_age = app.config.get('PERCENTILE_INDEX_MAX_AGE', DEFAULT_MAX_AGE)
+    if index is None or (max_age and time.time() - index.built_at > max_age):
+        _rebuild_in_background(app)
+    return index
+
+
+def record_percentiles(records):
+    """
+    Percentile of each record's metrics within its sex and age band
+
+    Records give gender and age plus any of body_fat_percent,
+    rmr_percent_predicted, ffmi, or lean_mass_kg and height_cm for FFMI.
+    Values that are not numbers get no percentile rather than an error, since
+    they come straight from request payloads.
+
+    Returns:
+        list: One dict per record mapping metric -> {'percentile', 'band', 'band_size'};
+            empty while no index has been built yet
+    """
+    index = get_percentile_index()
+    if index is None:
+        return [{} for _ in records]
+
+    groups = band_ids([r.get('gender') for r in records], [r.get('age') for r in records])
+
+    def column(name):
+        return float_array([r.get(name) for r in records], lenient=True)
+
+    values = {
+        'body_fat_percent': column('body_fat_percent'),
+        'rmr_percent_predicted': column('rmr_percent_predicted'),
+        'ffmi': np.where(np.isnan(column('ffmi')), ffmi(column('lean_mass_kg'), column('height_cm')),
+                         column('ffmi')),
+    }
+    output = [{} for _ in records]
+    for metric, metric_values in values.items():
+        if metric not in index.values:
+            continue
+        percentiles, sizes = index.ranks(metric, metric_values, groups)
+        for i in np.nonzero(~np.isnan(percentiles))[0]:
+            output[i][metric] = {
+                'percentile': round(float(percentiles[i]), 1),
+                'band': band_label(groups[i]),
+                'band_size': int(sizes[i]),
+            }
+    return output
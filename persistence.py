@@ -0,0 +1,176 @@
+"""
+Bulk persistence for client child tables
+Replaces a client's RmrData, BodyCompositionData and UltrasoundData rows
+with Core executemany inserts instead of one ORM object per data point
+"""
+
+from datetime import datetime
+
+from sqlalchemy import delete, insert
+
+from models import db, RmrData, BodyCompositionData, UltrasoundData
+
+RMR_FLOAT_FIELDS = (
+    'tidal_volume', 'respiratory_rate', 'vo2_ml_min', 'vo2_ml_kg_min', 've_vo2', 'feo2',
+    'vco2_ml_min', 'vco2_ml_kg_min', 've_vco2', 'feco2', 'rer',
+)
+
+# 3D scan columns stored as separate measurement records, with their units
+SCAN_MEASUREMENTS = [
+    'Height', 'Weight', 'Body Fat Percent', 'Lean Mass', 'Fat Mass',
+    'Waist', 'Hips', 'Chest', 'Thigh Left', 'Thigh Right', 'Biceps Left', 'Biceps Right'
+]
+SCAN_UNITS_IN = ['Height', 'Waist', 'Hips', 'Chest', 'Thigh Left', 'Thigh Right', 'Biceps Left', 'Biceps Right']
+SCAN_UNITS_LBS = ['Weight', 'Lean Mass', 'Fat Mass']
+
+ULTRASOUND_SITES = {
+    'CH': 'Chest',
+    'WA': 'Waist',
+    'TR': 'Triceps',
+    'TH': 'Thigh',
+    'AX': 'Axilla',
+    'SC': 'Subscapular'
+}
+
+
+def _optional_float(value):
+    return float(value) if value else None
+
+
+def _parse_date(value, formats):
+    if not value:
+        return None
+    for fmt in formats:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def scan_unit(measurement):
+    """Unit stored with a 3D scan measurement."""
+    if measurement in SCAN_UNITS_IN:
+        return 'in'
+    if measurement in SCAN_UNITS_LBS:
+        return 'lbs'
+    return '%'
+
+
+def rmr_data_rows(client_id, raw_data):
+    """
+    Build RmrData insert parameters from the raw data points posted by the client
+
+    Args:
+        client_id (int): Owning client
+        raw_data (list): Dicts keyed by RmrData column name
+
+    Returns:
+        list: One parameter dict per data point
+    """
+    rows = []
+    for point in raw_data:
+        row = {'client_id': client_id, 'time_point': point.get('time_point', '')}
+        for field in RMR_FLOAT_FIELDS:
+            row[field] = _optional_float(point.get(field))
+        rows.append(row)
+    return rows
+
+
+def scan_measurement_rows(client_id, scan_data, scan_device='Fit3D'):
+    """
+    Build BodyCompositionData insert parameters from 3D scan CSV rows
+
+    Args:
+        client_id (int): Owning client
+        scan_data (list): Scan CSV rows as dicts keyed by column header
+        scan_device (str, optional): 'Fit3D' or 'Styku'
+
+    Returns:
+        list: One parameter dict per numeric measurement
+    """
+    rows = []
+    for scan in scan_data:
+        scan_date = _parse_date(scan.get('Scan Date'), ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'))
+        for measurement in SCAN_MEASUREMENTS:
+            if measurement in scan and scan[measurement]:
+                try:
+                    value = float(scan[measurement])
+                except (ValueError, TypeError):
+                    continue
+                rows.append({
+                    'client_id': client_id,
+                    'scan_date': scan_date,
+                    'measurement_type': scan_device,
+                    'measurement_name': measurement,
+                    'measurement_value': value,
+                    'measurement_unit': scan_unit(measurement),
+                })
+    return rows
+
+
+def ultrasound_rows(client_id, ultrasound_data):
+    """
+    Build UltrasoundData insert parameters from ultrasound CSV rows
+
+    Args:
+        client_id (int): Owning client
+        ultrasound_data (list): Ultrasound CSV rows keyed by site code (CH, WA, ...)
+
+    Returns:
+        list: One parameter dict per numeric site measurement
+    """
+    rows = []
+    for record in ultrasound_data:
+        us_date = _parse_date(record.get('Date'), ('%Y-%m-%d %H-%M', '%Y-%m-%d'))
+        for site, site_name in ULTRASOUND_SITES.items():
+            if site in record and record[site]:
+                try:
+                    value = float(record[site])
+                except (ValueError, TypeError):
+                    continue
+                rows.append({
+                    'client_id': client_id,
+                    'date': us_date,
+                    'site_name': site_name,
+                    'measurement_value': value,
+                })
+    return rows
+
+
+def replace_client_rows(model, client_id, rows):
+    """
+    Delete a client's rows in a child table and insert the new ones
+
+    Runs in the current session transaction; the caller commits so the
+    delete and the insert become visible together.
+
+    Args:
+        model: RmrData, BodyCompositionData or UltrasoundData
+        client_id (int): Owning client
+        rows (list): Insert parameter dicts
+
+    Returns:
+        int: Number of rows inserted
+    """
+    db.session.execute(delete(model).where(model.client_id == client_id))
+    if rows:
+        # A list of parameter sets runs as a single executemany
+        db.session.execute(insert(model), rows)
+    return len(rows)
+
+
+def replace_rmr_data(client_id, raw_data):
+    """Replace all raw RMR points for a client."""
+    return replace_client_rows(RmrData, client_id, rmr_data_rows(client_id, raw_data))
+
+
+def replace_scan_data(client_id, scan_data, scan_device='Fit3D'):
+    """Replace all 3D scan measurements for a client."""
+    return replace_client_rows(BodyCompositionData, client_id,
+                               scan_measurement_rows(client_id, scan_data, scan_device))
+
+
+def replace_ultrasound_data(client_id, ultrasound_data):
+    """Replace all ultrasound site measurements for a client."""
+    return replace_client_rows(UltrasoundData, client_id, ultrasound_rows(client_id, ultrasound_data))
@@ -0,0 +1,210 @@
+"""
+Report artifact store
+Maps (client, test date) to the rendered report PDF in the render cache so
+the PDF downloads and the report email share one render
+"""
+
+import logging
+from datetime import date, datetime
+
+from sqlalchemy import select
+
+from models import db, ReportArtifact
+from report_jobs import get_render_queue, report_cache_key
+
+logger = logging.getLogger(__name__)
+
+
+def parse_test_date(value):
+    """A test date from a date or a 'YYYY-MM-DD' string; None if missing or malformed."""
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def report_filename(client_data, date_str):
+    """Generate filename based on client name and date"""
+    client_name = f"{client_data.get('first_name', '')}_{client_data.get('last_name', '')}".strip()
+    if not client_name:
+        client_name = "Client"
+    return f"Body_Composition_{client_name}_{date_str}.pdf"
+
+
+def client_report_inputs(client):
+    """
+    Report inputs for a stored client, in the same shape as a PDF request payload
+
+    Uses the latest scan and ultrasound dates on file. The client must have been
+    loaded with its scan_measurements and ultrasound_sites (see load_client_bundles).
+    """
+    client_data = client.to_dict()
+
+    scan_data = {}
+    if client.scan_measurements:
+        latest = max((m.scan_date for m in client.scan_measurements if m.scan_date), default=None)
+        for m in client.scan_measurements:
+            if m.scan_date == latest:
+                scan_data[m.measurement_name] = m.measurement_value
+        scan_data['Scan Date'] = latest.strftime('%Y-%m-%d') if latest else None
+
+    ultrasound_data = {}
+    if client.ultrasound_sites:
+        latest = max((s.date for s in client.ultrasound_sites if s.date), default=None)
+        for site in client.ultrasound_sites:
+            if site.date == latest:
+                ultrasound_data[site.site_name] = site.measurement_value
+        ultrasound_data['Date'] = latest.strftime('%Y-%m-%d') if latest else None
+
+    body_fat_results = {}
+    if client.body_fat_percent is not None:
+        body_fat_results = {
+            'body_fat_3c': client.body_fat_percent,
+            'fat_mass_kg': client.fat_mass_kg,
+            'fat_mass_lbs': client.fat_mass_lbs,
+            'ffm_kg': client.lean_mass_kg,
+            'ffm_lbs': client.lean_mass_lbs,
+        }
+        if client.height_cm and client.fat_mass_kg is not None and client.lean_mass_kg is not None:
+            height_m2 = (client.height_cm / 100) ** 2
+            body_fat_results['fmi'] = round(client.fat_mass_kg / height_m2, 1)
+            body_fat_results['ffmi'] = round(client.lean_mass_kg / height_m2, 1)
+
+    return client_data, scan_data, ultrasound_data, None, body_fat_results
+
+
+def client_inputs_key(client):
+    """
+    Fingerprint of a stored client's report inputs, without the report date
+
+    Changes whenever the client, its latest scan or its ultrasound sites are
+    re-saved, so a PDF recorded under it is only reused while it shows the
+    data on file, whichever day or route rendered it.
+    """
+    return report_cache_key(*client_report_inputs(client))
+
+
+def find_artifact(client_id, test_date):
+    return db.session.execute(
+        select(ReportArtifact).where(ReportArtifact.client_id == client_id,
+                                     ReportArtifact.test_date == test_date)
+    ).scalar_one_or_none()
+
+
+def record_artifact(client_id, test_date, job_key, filename, inputs_key=None, commit=True):
+    """
+    Point (client_id, test_date) at a render job, replacing any earlier one
+
+    Args:
+        client_id (int): Saved client
+        test_date (date or str): Test date the report belongs to
+        job_key (str): ReportRenderQueue cache key
+        filename (str): Download filename
+        inputs_key (str, optional): client_inputs_key() of the data the PDF shows
+        commit (bool, optional): Commit right away; pass False to batch several records
+
+    Returns:
+        ReportArtifact or None: None if the client id or test date is missing
+    """
+    test_date = parse_test_date(test_date)
+    if not client_id or not test_date:
+        return None
+    artifact = find_artifact(client_id, test_date)
+    if artifact is None:
+        artifact = ReportArtifact(client_id=client_id, test_date=test_date)
+        db.session.add(artifact)
+    artifact.job_key = job_key
+    artifact.inputs_key = inputs_key
+    artifact.filename = filename
+    if commit:
+        db.session.commit()
+    return artifact
+
+
+def record_download(client_data, job_key, filename):
+    """
+    Record a render made from a PDF request payload as a saved client's report
+
+    Only for a saved client at its stored test date; the artifact gets the
+    client's current inputs_key so a report email sent before the client is
+    re-saved attaches this PDF instead of rendering again.
+
+    Returns:
+        ReportArtifact or None
+    """
+    from client_queries import load_client_bundles
+
+    client_id = client_data.get('id')
+    if not client_id:
+        return None
+    clients = load_client_bundles([client_id], include=['scans', 'ultrasound'])
+    if not clients or not clients[0].test_date:
+        return None
+    client = clients[0]
+    if parse_test_date(client_data.get('test_date')) != client.test_date:
+        return None
+    return record_artifact(client.id, client.test_date, job_key, filename, inputs_key=client_inputs_key(client))
+
+
+def artifact_pdf(artifact):
+    """PDF bytes of a finished artifact, or None if it is not rendered (yet)."""
+    path = get_render_queue().cached(artifact.job_key) if artifact else None
+    if not path:
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def request_client_report(client_id, test_date=None):
+    """
+    The report artifact for a stored client, queueing one render if there is none
+
+    The report is built from the client's current data, which belongs to its
+    stored test date only, so any other test date has no report. An artifact
+    is reused while it is rendered, pending or rendering and was made from
+    that same data (same inputs_key), whichever route or day rendered it, so
+    every consumer asking for the same client and test date shares a render;
+    once the client is re-saved a fresh one is queued.
+
+    Args:
+        client_id (int): Client to report on
+        test_date (date or str, optional): Defaults to the client's test_date
+
+    Returns:
+        ReportArtifact or None: None if the client does not exist, has no test
+            date or test_date is not its test date
+
+    Raises:
+        QueueFullError: If a render is needed and the render queue is full
+    """
+    from client_queries import load_client_bundles
+
+    clients = load_client_bundles([client_id], include=['scans', 'ultrasound'])
+    if not clients:
+        return None
+    client = clients[0]
+    if not client.test_date:
+        return None
+    test_date = parse_test_date(test_date) if test_date else client.test_date
+    if test_date != client.test_date:
+        return None
+
+    queue = get_render_queue()
+    inputs = client_report_inputs(client)
+    inputs_key = report_cache_key(*inputs)
+    artifact = find_artifact(client.id, test_date)
+    if (artifact and artifact.inputs_key == inputs_key
+            and queue.status(artifact.job_key)['status'] in ('done', 'pending', 'rendering')):
+        return artifact
+
+    from services.pdf_service import render_body_composition_html
+
+    date_str = datetime.now().strftime('%Y-%m-%d')
+    key = report_cache_key(*inputs, date_str)
+    filename = report_filename(inputs[0], date_str)
+    html_content = render_body_composition_html(*inputs, report_date=date_str)
+    queue.submit(key, html_content, filename)
+    logger.info(f"Queued report render {key} for client {client.id} ({test_date})")
+    return record_artifact(client.id, test_date, key, filename, inputs_key=inputs_key)
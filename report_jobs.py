@@ -0,0 +1,338 @@
+"""
+Background PDF rendering
+Bounded process pool for wkhtmltopdf renders with an on-disk result cache
+keyed by a hash of the report inputs
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+
+_KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+# How often submits sweep the cache for files older than max_age (seconds)
+PRUNE_INTERVAL_SECONDS = 3600
+
+
+class QueueFullError(RuntimeError):
+    """Raised when too many renders are already pending."""
+
+
+def report_cache_key(*inputs):
+    """Stable SHA-256 over the JSON form of the report inputs."""
+    payload = json.dumps(inputs, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# Renderer backend of a pool worker process, set by _init_render_worker
+_worker_renderer = None
+
+
+def _init_render_worker(renderer_name):
+    """Warm a pool worker: build its renderer once so every job reuses it."""
+    from services.pdf_service import get_renderer
+
+    global _worker_renderer
+    _worker_renderer = renderer_name
+    get_renderer(renderer_name)
+
+
+def _render_to_file(html_content, options, path):
+    """Worker-process entry point: render HTML to PDF and publish it atomically."""
+    from services.pdf_service import html_to_pdf
+
+    pdf_content = html_to_pdf(html_content, options, renderer=_worker_renderer)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(pdf_content)
+    os.replace(tmp_path, path)
+    return len(pdf_content)
+
+
+class ReportRenderQueue:
+    """
+    Renders report PDFs in a process pool and caches them on disk
+
+    Jobs are identified by their cache key, so identical requests share one
+    render and a finished PDF is served from disk without rendering again.
+    """
+
+    def __init__(self, cache_dir, max_workers=2, max_pending=32, renderer=None, max_age=None):
+        self.cache_dir = cache_dir
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self._pruned_at = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        # Long-lived workers, each holding one warm renderer (see pdf_service.get_renderer)
+        self._executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_render_worker,
+                                             initargs=(renderer,))
+        self._futures = {}
+        self._errors = {}
+        self._waiting = set()  # Batch jobs not yet handed to the pool
+        # Re-entrant: a done-callback may run inline in the submitting thread
+        self._lock = threading.RLock()
+
+    def pdf_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pdf")
+
+    def _meta_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def cached(self, key):
+        """Path of the finished PDF for key, or None."""
+        if not _KEY_PATTERN.match(key or ''):
+            return None
+        path = self.pdf_path(key)
+        return path if os.path.isfile(path) else None
+
+    def filename(self, key):
+        """Download filename recorded when the job was submitted."""
+        try:
+            with open(self._meta_path(key)) as f:
+                return json.load(f).get('filename', f"{key}.pdf")
+        except (OSError, ValueError):
+            return f"{key}.pdf"
+
+    def _write_meta(self, key, filename):
+        with open(self._meta_path(key), 'w') as f:
+            json.dump({'filename': filename}, f)
+
+    def prune(self, max_age=None):
+        """
+        Delete cache files (PDFs, job metadata, batch manifests and ZIPs) older than max_age seconds
+
+        Files of jobs still pending or rendering are kept. Keys include the
+        report date, so without pruning the cache only ever grows.
+
+        Returns:
+            int: Number of files removed
+        """
+        max_age = self.max_age if max_age is None else max_age
+        if not max_age:
+            return 0
+        cutoff = time.time() - max_age
+        with self._lock:
+            active = set(self._futures) | self._waiting
+        removed = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.split('.', 1)[0] in active:
+                continue
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                continue
+        if removed:
+            logger.info(f"Pruned {removed} files older than {max_age}s from the PDF cache")
+        return removed
+
+    def _maybe_prune(self):
+        """Prune at most once per PRUNE_INTERVAL_SECONDS."""
+        now = time.time()
+        if not self.max_age or now - self._pruned_at < PRUNE_INTERVAL_SECONDS:
+            return
+        self._pruned_at = now
+        try:
+            self.prune()
+        except OSError as e:
+            logger.error(f"Could not prune the PDF cache: {str(e)}")
+
+    def submit(self, key, html_content, filename, options=None):
+        """
+        Queue a render unless the PDF is cached or already being rendered
+
+        Args:
+            key (str): Cache key from report_cache_key
+            html_content (str): Self-contained report HTML
+            filename (str): Download filename
+            options (dict, optional): wkhtmltopdf options
+
+        Returns:
+            dict: Job status (see status)
+
+        Raises:
+            QueueFullError: If max_pending renders are already queued
+        """
+        self._maybe_prune()
+        if self.cached(key):
+            return self.status(key)
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None or (future.done() and future.exception() is not None):
+                pending = sum(1 for f in self._futures.values() if not f.done())
+                if pending >= self.max_pending:
+                    raise QueueFullError(f"{pending} reports are already rendering, try again shortly")
+                self._write_meta(key, filename)
+                self._errors.pop(key, None)
+                future = self._executor.submit(_render_to_file, html_content, options, self.pdf_path(key))
+                self._futures[key] = future
+                future.add_done_callback(lambda f, key=key: self._finished(key, f))
+        return self.status(key)
+
+    def _finished(self, key, future):
+        with self._lock:
+            self._futures.pop(key, None)
+            if future.exception() is not None:
+                self._errors[key] = str(future.exception())
+                logger.error(f"PDF render {key} failed: {self._errors[key]}")
+
+    def status(self, key):
+        """Current state of a job: 'pending', 'rendering', 'done', 'error' or 'unknown'."""
+        if not _KEY_PATTERN.match(key or ''):
+            return {'job_id': key, 'status': 'unknown'}
+        if self.cached(key):
+            return {'job_id': key, 'status': 'done', 'filename': self.filename(key)}
+        with self._lock:
+            if key in self._futures:
+                state = 'rendering' if self._futures[key].running() else 'pending'
+                return {'job_id': key, 'status': state}
+            if key in self._waiting:
+                return {'job_id': key, 'status': 'pending'}
+            if key in self._errors:
+                return {'job_id': key, 'status': 'error', 'message': self._errors[key]}
+        return {'job_id': key, 'status': 'unknown'}
+
+    def wait(self, key, timeout=None):
+        """Block until a submitted job finishes; returns the PDF path or None."""
+        with self._lock:
+            future = self._futures.get(key)
+        if future is not None:
+            future.result(timeout=timeout)
+        return self.cached(key)
+
+    def _batch_manifest_path(self, batch_id):
+        return os.path.join(self.cache_dir, f"batch-{batch_id}.json")
+
+    def submit_batch(self, jobs):
+        """
+        Queue a batch of renders and return its batch id
+
+        Jobs are fed to the pool from a background thread as slots free up,
+        so a batch may be larger than max_pending. The batch id is derived from
+        the job keys, so resubmitting the same batch only renders what is missing.
+
+        Args:
+            jobs (list): (key, html_content, filename) tuples
+
+        Returns:
+            str: Batch id for batch_status / batch_zip
+        """
+        self._maybe_prune()
+        batch_id = report_cache_key(*[key for key, _, _ in jobs])
+        with open(self._batch_manifest_path(batch_id), 'w') as f:
+            json.dump({'jobs': [{'job_id': key, 'filename': filename} for key, _, filename in jobs]}, f)
+
+        pending = [job for job in jobs if not self.cached(job[0])]
+        with self._lock:
+            self._waiting.update(key for key, _, _ in pending)
+        threading.Thread(target=self._feed_batch, args=(pending,), daemon=True).start()
+        return batch_id
+
+    def _feed_batch(self, jobs):
+        for key, html_content, filename in jobs:
+            while True:
+                try:
+                    self.submit(key, html_content, filename)
+                    break
+                except QueueFullError:
+                    time.sleep(0.2)
+                except Exception as e:
+                    with self._lock:
+                        self._errors[key] = str(e)
+                    logger.error(f"PDF render {key} could not be queued: {str(e)}")
+                    break
+            with self._lock:
+                self._waiting.discard(key)
+
+    def _batch_jobs(self, batch_id):
+        if not _KEY_PATTERN.match(batch_id or ''):
+            return None
+        try:
+            with open(self._batch_manifest_path(batch_id)) as f:
+                return json.load(f)['jobs']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def batch_status(self, batch_id):
+        """
+        Progress of a batch: counts per state plus the state of every job
+
+        Returns:
+            dict or None: None if the batch is unknown
+        """
+        jobs = self._batch_jobs(batch_id)
+        if jobs is None:
+            return None
+        states = []
+        for job in jobs:
+            state = self.status(job['job_id'])['status']
+            states.append({'job_id': job['job_id'], 'filename': job['filename'], 'status': state})
+        done = sum(1 for s in states if s['status'] == 'done')
+        failed = sum(1 for s in states if s['status'] in ('error', 'unknown'))
+        if done == len(states):
+            overall = 'done'
+        elif done + failed == len(states):
+            overall = 'error'
+        else:
+            overall = 'rendering'
+        return {'batch_id': batch_id, 'status': overall, 'total': len(states), 'done': done,
+                'failed': failed, 'jobs': states}
+
+    def batch_zip(self, batch_id):
+        """
+        Path of a ZIP with every PDF of a finished batch, built on first request
+
+        Returns:
+            str or None: None unless every job in the batch is done
+        """
+        jobs = self._batch_jobs(batch_id)
+        if jobs is None or not all(self.cached(job['job_id']) for job in jobs):
+            return None
+        path = os.path.join(self.cache_dir, f"batch-{batch_id}.zip")
+        if not os.path.isfile(path):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            # PDFs are already compressed; store them as-is
+            with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+                names = set()
+                for job in jobs:
+                    name = job['filename']
+                    if name in names:
+                        name = f"{os.path.splitext(name)[0]}_{job['job_id'][:8]}.pdf"
+                    names.add(name)
+                    archive.write(self.pdf_path(job['job_id']), arcname=name)
+            os.replace(tmp_path, path)
+        return path
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_render_queue():
+    """Process-wide render queue configured from the current app (PDF_CACHE_DIR, PDF_RENDER_WORKERS, PDF_MAX_PENDING, PDF_RENDERER, PDF_CACHE_MAX_AGE)."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            config = current_app.config
+            _queue = ReportRenderQueue(
+                config.get('PDF_CACHE_DIR') or os.path.join(current_app.instance_path, 'pdf_cache'),
+                max_workers=config.get('PDF_RENDER_WORKERS', 2),
+                max_pending=config.get('PDF_MAX_PENDING', 32),
+                renderer=config.get('PDF_RENDERER'),
+                max_age=config.get('PDF_CACHE_MAX_AGE'),
+            )
+        return _queue
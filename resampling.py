@@ -0,0 +1,162 @@
+"""
+Resampling of RMR series for charting
+Fixed-interval bin averaging and Largest-Triangle-Three-Buckets (LTTB)
+downsampling, so chart payloads stay bounded however long the test is
+"""
+
+import numpy as np
+
+from rmr_engine import RmrInputError
+from time_index import TimeIndex, format_time
+
+RESAMPLE_METHODS = ('bins', 'lttb')
+DEFAULT_BIN_SECONDS = 15
+DEFAULT_LTTB_POINTS = 500
+MIN_LTTB_POINTS = 3
+MAX_LTTB_POINTS = 10000
+
+
+def resample_options(fields):
+    """
+    Resampling request from JSON or query fields
+
+    Args:
+        fields (dict): 'resample' ('bins' or 'lttb'), optional 'bin_seconds' and 'points'
+
+    Returns:
+        dict or None: Validated {'method', 'bin_seconds' or 'points'}; None for full resolution
+
+    Raises:
+        RmrInputError: On an unknown method or an invalid parameter
+    """
+    method = fields.get('resample')
+    if not method or method == 'none':
+        return None
+    if method not in RESAMPLE_METHODS:
+        raise RmrInputError(f"Unknown resample method: {method}")
+    try:
+        if method == 'bins':
+            bin_seconds = float(fields.get('bin_seconds') or DEFAULT_BIN_SECONDS)
+        else:
+            points = int(fields.get('points') or DEFAULT_LTTB_POINTS)
+    except (TypeError, ValueError) as e:
+        raise RmrInputError(f"Invalid resample parameter: {str(e)}")
+
+    if method == 'bins':
+        if not bin_seconds > 0:
+            raise RmrInputError('bin_seconds must be positive')
+        return {'method': method, 'bin_seconds': bin_seconds}
+    if not MIN_LTTB_POINTS <= points <= MAX_LTTB_POINTS:
+        raise RmrInputError(f"points must be between {MIN_LTTB_POINTS} and {MAX_LTTB_POINTS}")
+    return {'method': method, 'points': points}
+
+
+def bin_average(seconds, columns, bin_seconds):
+    """
+    Average every column over fixed [k * bin_seconds, (k + 1) * bin_seconds) time bins
+
+    Bin boundaries are located with np.searchsorted and summed with
+    np.add.reduceat; empty bins are left out.
+
+    Args:
+        seconds (ndarray): Non-decreasing sample times
+        columns (dict): Name -> float64 array aligned with seconds
+        bin_seconds (float): Bin width
+
+    Returns:
+        tuple: (bin start seconds, dict of per-bin means)
+    """
+    if not len(seconds):
+        return seconds, {name: values[:0] for name, values in columns.items()}
+    first = np.floor(seconds[0] / bin_seconds) * bin_seconds
+    edges = np.arange(first, seconds[-1] + bin_seconds, bin_seconds)
+    starts = np.searchsorted(seconds, edges, side='left')
+    stops = np.append(starts[1:], len(seconds))
+    filled = stops > starts
+    starts, counts = starts[filled], (stops - starts)[filled]
+    means = {name: np.add.reduceat(values, starts) / counts for name, values in columns.items()}
+    return edges[filled], means
+
+
+def lttb_indices(x, y, points):
+    """
+    Indexes of the points LTTB keeps to draw y against x with `points` points
+
+    The first and last points are always kept; every bucket in between keeps
+    the point forming the largest triangle with the previously kept point and
+    the mean of the next bucket.
+
+    Args:
+        x (ndarray): Non-decreasing x values
+        y (ndarray): y values
+        points (int): Target point count (at least 3)
+
+    Returns:
+        ndarray: Sorted indexes into x and y
+    """
+    n = len(x)
+    if points >= n or points < MIN_LTTB_POINTS:
+        return np.arange(n)
+
+    # Bucket boundaries over the points between the first and the last
+    edges = (np.linspace(1, n - 1, points - 1)).astype(np.int64)
+    counts = np.diff(edges)
+    bucket_x = np.add.reduceat(x[:-1], edges[:-1]) / counts
+    bucket_y = np.add.reduceat(y[:-1], edges[:-1]) / counts
+    # The bucket after the last one is the final point itself
+    next_x = np.append(bucket_x[1:], x[-1])
+    next_y = np.append(bucket_y[1:], y[-1])
+
+    selected = np.empty(points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        ax, ay = x[a], y[a]
+        area = np.abs((ax - next_x[i]) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (next_y[i] - ay))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def resample_series(series, options):
+    """
+    Chart-sized copy of a parsed RMR series
+
+    Args:
+        series (dict): 'vo2', 'vco2', 'rer' and 'seconds' arrays (see parse_rmr_rows)
+        options (dict): From resample_options()
+
+    Returns:
+        dict: raw_data payload (time_points, time_seconds, vo2/vco2/rer_values) plus
+            a 'resampling' summary
+
+    Raises:
+        RmrInputError: If bin averaging is asked for without a usable Time column
+    """
+    columns = {'vo2': series['vo2'], 'vco2': series['vco2'], 'rer': series['rer']}
+    n = len(columns['vo2'])
+    seconds = series.get('seconds')
+    index = TimeIndex(seconds) if seconds is not None and len(seconds) == n else None
+    timed = index is not None and index.monotonic
+
+    if options['method'] == 'bins':
+        if not timed:
+            raise RmrInputError('Fixed-interval resampling needs a complete, sorted Time column')
+        times, columns = bin_average(index.seconds, columns, options['bin_seconds'])
+    else:
+        # Without usable times the samples are spaced evenly
+        x = index.seconds if timed else np.arange(n, dtype=np.float64)
+        keep = lttb_indices(x, columns['vo2'], options['points'])
+        times = index.seconds[keep] if timed else None
+        columns = {name: values[keep] for name, values in columns.items()}
+
+    return {
+        'time_points': [format_time(t) for t in times] if times is not None else [],
+        'time_seconds': times.tolist() if times is not None else [],
+        'vo2_values': np.round(columns['vo2'], 2).tolist(),
+        'vco2_values': np.round(columns['vco2'], 2).tolist(),
+        'rer_values': np.round(columns['rer'], 3).tolist(),
+        'resampling': dict(options, source_points=n, points=len(columns['vo2'])),
+    }
@@ -0,0 +1,363 @@
+"""
+Columnar RMR computation engine
+Parses metabolic-cart CSV exports into contiguous float64 columns and
+computes the RMR summary statistics in a single reduction
+"""
+
+import codecs
+import csv
+import io
+import logging
+
+import numpy as np
+
+from time_index import parse_time_seconds
+
+logger = logging.getLogger(__name__)
+
+# Weir equation and substrate oxidation constants (per-minute -> per-day scale)
+DAY_SCALE = 1.44
+WEIR_VO2 = 3.941
+WEIR_VCO2 = 1.106
+FAT_FACTOR = 1.67
+CARB_VCO2 = 4.55
+CARB_VO2 = 3.21
+
+HISTOGRAM_BINS = 10
+Z_95 = 1.96
+
+# Rows buffered as strings before being converted into float64 blocks
+BLOCK_ROWS = 4096
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+class RmrInputError(ValueError):
+    """Raised when a CSV export cannot be turned into an RMR series."""
+
+
+def find_rmr_columns(headers):
+    """
+    Locate the columns used for RMR calculation in a header row
+
+    Args:
+        headers (list): Header row of the metabolic-cart export
+
+    Returns:
+        dict: Column indexes for time, VO2, VCO2 and RER
+
+    Raises:
+        RmrInputError: If any required column is missing
+    """
+    missing = [name for name in ('Time', 'VO2', 'VCO2', 'RER') if name not in headers]
+    if missing:
+        raise RmrInputError('Required columns not found in CSV. Needs: Time, VO2, VCO2, RER')
+
+    vo2_idx = headers.index('VO2')
+    vco2_idx = headers.index('VCO2')
+    return {
+        'time': headers.index('Time'),
+        'vo2_ml_min': vo2_idx,
+        'vo2_ml_kg_min': vo2_idx + 1,  # Assuming it's the next column
+        'vco2_ml_min': vco2_idx,
+        'vco2_ml_kg_min': vco2_idx + 1,  # Assuming it's the next column
+        'rer': headers.index('RER'),
+    }
+
+
+def _to_float_column(cells):
+    """Convert a list of CSV cells to float64, flagging cells that do not parse."""
+    try:
+        return np.array(cells, dtype=np.float64), None
+    except ValueError:
+        values = np.empty(len(cells), dtype=np.float64)
+        valid = np.ones(len(cells), dtype=bool)
+        for i, cell in enumerate(cells):
+            try:
+                values[i] = float(cell)
+            except ValueError:
+                values[i] = np.nan
+                valid[i] = False
+        return values, valid
+
+
+def parse_rmr_rows(rows):
+    """
+    Extract the RMR signal columns from parsed CSV rows
+
+    Rows are consumed lazily and converted to float64 in blocks of
+    BLOCK_ROWS, so only one block of cell strings is alive at a time.
+
+    Args:
+        rows (iterable): Header row followed by data rows (units row already removed)
+
+    Returns:
+        dict: 'vo2', 'vco2' and 'rer' float64 arrays, the raw 'time_points' strings
+            and 'seconds', the parsed elapsed time aligned with the signal arrays
+    """
+    rows = iter(rows)
+    headers = next(rows, None)
+    if headers is None:
+        raise RmrInputError('CSV file has insufficient data')
+
+    cols = find_rmr_columns(headers)
+    min_len = max(cols.values()) + 1
+    time_idx = cols['time']
+    vo2_idx, vco2_idx, rer_idx = cols['vo2_ml_min'], cols['vco2_ml_min'], cols['rer']
+
+    time_points = []
+    blocks = []
+    skipped = 0
+
+    def flush(vo2_cells, vco2_cells, rer_cells, time_cells):
+        vo2, vo2_valid = _to_float_column(vo2_cells)
+        vco2, vco2_valid = _to_float_column(vco2_cells)
+        rer, rer_valid = _to_float_column(rer_cells)
+        seconds = parse_time_seconds(time_cells)
+        masks = [m for m in (vo2_valid, vco2_valid, rer_valid) if m is not None]
+        if masks:
+            keep = np.logical_and.reduce(masks)
+            vo2, vco2, rer, seconds = vo2[keep], vco2[keep], rer[keep], seconds[keep]
+            return (vo2, vco2, rer, seconds), int(len(keep) - keep.sum())
+        return (vo2, vco2, rer, seconds), 0
+
+    # Single pass over the rows: only the selected cells are kept
+    vo2_cells = []
+    vco2_cells = []
+    rer_cells = []
+    time_cells = []
+    for row in rows:
+        row_len = len(row)
+        if row_len > time_idx:
+            time_points.append(row[time_idx])
+        if row_len < min_len:
+            continue  # Skip rows with insufficient columns
+        vo2_cells.append(row[vo2_idx])
+        vco2_cells.append(row[vco2_idx])
+        rer_cells.append(row[rer_idx])
+        time_cells.append(row[time_idx])
+        if len(vo2_cells) >= BLOCK_ROWS:
+            block, bad = flush(vo2_cells, vco2_cells, rer_cells, time_cells)
+            blocks.append(block)
+            skipped += bad
+            vo2_cells, vco2_cells, rer_cells, time_cells = [], [], [], []
+
+    block, bad = flush(vo2_cells, vco2_cells, rer_cells, time_cells)
+    blocks.append(block)
+    skipped += bad
+    if skipped:
+        logger.warning(f"Skipping {skipped} rows with non-numeric VO2/VCO2/RER values")
+
+    if len(blocks) == 1:
+        vo2, vco2, rer, seconds = blocks[0]
+    else:
+        vo2, vco2, rer, seconds = (np.concatenate(parts) for parts in zip(*blocks))
+
+    return {
+        'vo2': vo2,
+        'vco2': vco2,
+        'rer': rer,
+        'time_points': time_points,
+        'seconds': seconds,
+    }
+
+
+def _parse_export(reader):
+    """Skip the units row of a csv.reader over a raw export and parse the rest."""
+    headers = next(reader, None)
+    units = next(reader, None)
+    first = next(reader, None)
+    if headers is None or units is None or first is None:
+        # Need at least header, units, and one data row
+        raise RmrInputError('CSV file has insufficient data')
+
+    def _rows():
+        yield headers
+        yield first
+        yield from reader
+
+    return parse_rmr_rows(_rows())
+
+
+def parse_rmr_csv(csv_data):
+    """
+    Parse a raw metabolic-cart export (header, units row, data rows)
+
+    Args:
+        csv_data (str): CSV text as exported by the metabolic cart
+
+    Returns:
+        dict: Parsed columns, see parse_rmr_rows
+    """
+    return _parse_export(csv.reader(io.StringIO(csv_data)))
+
+
+def iter_stream_lines(stream, encoding='utf-8-sig', chunk_size=STREAM_CHUNK_BYTES):
+    """
+    Incrementally decode a binary stream into text lines
+
+    Args:
+        stream: File-like object with a read(size) method returning bytes
+        encoding (str, optional): Text encoding; the default strips a UTF-8 BOM
+        chunk_size (int, optional): Bytes read per call
+
+    Yields:
+        str: Lines including their trailing newline
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    pending = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        pending += decoder.decode(chunk)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+def parse_rmr_stream(stream, encoding='utf-8-sig'):
+    """
+    Parse a raw metabolic-cart export straight from a binary stream
+
+    Memory use is bounded by one read chunk plus one block of cells on top of
+    the float64 output arrays, independent of the size of the upload.
+
+    Args:
+        stream: File-like object returning bytes (e.g. request.stream)
+        encoding (str, optional): Text encoding of the upload (e.g. the request's
+            charset); UTF-8 uploads may start with a byte order mark either way
+
+    Returns:
+        dict: Parsed columns, see parse_rmr_rows
+
+    Raises:
+        RmrInputError: If the encoding is unknown
+    """
+    try:
+        encoding = codecs.lookup(encoding).name
+    except LookupError:
+        raise RmrInputError(f"Unknown charset: {encoding}")
+    if encoding == 'utf-8':
+        encoding = 'utf-8-sig'
+    return _parse_export(csv.reader(iter_stream_lines(stream, encoding)))
+
+
+def _histogram_modes(data, mins, maxs):
+    """
+    Histogram-mode estimate for every row of a 2-D array at once
+
+    Mirrors np.histogram(values, bins=10) per row (including its edge handling)
+    but counts all rows with a single bincount.
+    """
+    n_rows, n = data.shape
+    first = mins.copy()
+    last = maxs.copy()
+    flat = first == last
+    first[flat] -= 0.5
+    last[flat] += 0.5
+
+    edges = np.linspace(first, last, HISTOGRAM_BINS + 1, axis=1)
+    idx = ((data - first[:, None]) / (last - first)[:, None] * HISTOGRAM_BINS).astype(np.intp)
+    idx[idx == HISTOGRAM_BINS] -= 1
+
+    # Same floating-point corrections np.histogram applies at bin boundaries
+    rows = np.arange(n_rows)[:, None]
+    idx[data < edges[rows, idx]] -= 1
+    idx[(data >= edges[rows, idx + 1]) & (idx != HISTOGRAM_BINS - 1)] += 1
+
+    counts = np.bincount((idx + rows * HISTOGRAM_BINS).ravel(),
+                         minlength=n_rows * HISTOGRAM_BINS).reshape(n_rows, HISTOGRAM_BINS)
+    best = counts.argmax(axis=1)
+    return (edges[np.arange(n_rows), best] + edges[np.arange(n_rows), best + 1]) / 2
+
+
+def summarize_signals(data):
+    """
+    Fused descriptive statistics over stacked signals
+
+    Args:
+        data (ndarray): 2-D float64 array, one signal per row
+
+    Returns:
+        dict: Per-row mean, median, mode, std, cv, se, ci_lower and ci_upper arrays
+    """
+    n_rows, n = data.shape
+    if n == 0:
+        zeros = np.zeros(n_rows)
+        nans = np.full(n_rows, np.nan)
+        return {
+            'n': 0, 'mean': zeros, 'median': nans, 'mode': zeros, 'std': nans,
+            'cv': zeros, 'se': zeros, 'ci_lower': zeros, 'ci_upper': zeros,
+        }
+
+    mean = data.mean(axis=1)
+    centered = data - mean[:, None]
+    std = np.sqrt((centered * centered).mean(axis=1))
+    median = np.median(data, axis=1)
+    mode = _histogram_modes(data, data.min(axis=1), data.max(axis=1))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cv = np.where(mean != 0, std / mean * 100, 0.0)
+    se = std / np.sqrt(n)
+    if n > 1:
+        ci_lower = mean - Z_95 * se
+        ci_upper = mean + Z_95 * se
+    else:
+        ci_lower = ci_upper = mean
+
+    return {
+        'n': n, 'mean': mean, 'median': median, 'mode': mode, 'std': std,
+        'cv': cv, 'se': se, 'ci_lower': ci_lower, 'ci_upper': ci_upper,
+    }
+
+
+def compute_rmr_stats(vo2, vco2, rer):
+    """
+    Compute every RMR summary metric from the VO2/VCO2/RER series
+
+    Args:
+        vo2 (ndarray): VO2 in ml/min
+        vco2 (ndarray): VCO2 in ml/min
+        rer (ndarray): Respiratory exchange ratio
+
+    Returns:
+        dict: Means, descriptive statistics, Weir RMR and substrate bounds
+    """
+    stats = summarize_signals(np.vstack((vo2, vco2, rer)))
+    # Values stay np.float64 so round() matches the historical NumPy rounding
+    avg_vo2, avg_vco2, avg_rer = stats['mean']
+    vo2_lo, vco2_lo, rer_lo = stats['ci_lower']
+    vo2_hi, vco2_hi, rer_hi = stats['ci_upper']
+
+    def signal(i):
+        return {
+            'mean': stats['mean'][i],
+            'median': stats['median'][i],
+            'mode': stats['mode'][i],
+            'std': stats['std'][i],
+            'cv': stats['cv'][i],
+            'ci_95': Z_95 * stats['std'][i] / np.sqrt(stats['n']) if stats['n'] else 0,
+            'ci_lower': stats['ci_lower'][i],
+            'ci_upper': stats['ci_upper'][i],
+        }
+
+    return {
+        'sample_size': stats['n'],
+        'vo2': signal(0),
+        'vco2': signal(1),
+        'rer': signal(2),
+        # Weir equation: RMR = (3.941 * VO2 + 1.106 * VCO2) * 1.44
+        'rmr_kcal_day': (WEIR_VO2 * avg_vo2 + WEIR_VCO2 * avg_vco2) * DAY_SCALE,
+        'fat_oxidation': FAT_FACTOR * (avg_vo2 - avg_vco2) * DAY_SCALE,
+        'carb_oxidation': (CARB_VCO2 * avg_vco2 - CARB_VO2 * avg_vo2) * DAY_SCALE,
+        'rmr_lower_bound': (WEIR_VO2 * vo2_lo + WEIR_VCO2 * avg_vco2) * DAY_SCALE,
+        'rmr_upper_bound': (WEIR_VO2 * vo2_hi + WEIR_VCO2 * avg_vco2) * DAY_SCALE,
+        'fat_lower_bound': FAT_FACTOR * (vo2_lo - vco2_hi) * DAY_SCALE,
+        'fat_upper_bound': FAT_FACTOR * (vo2_hi - vco2_lo) * DAY_SCALE,
+        'glucose_lower_bound': (CARB_VCO2 * vco2_lo - CARB_VO2 * vo2_hi) * DAY_SCALE,
+        'glucose_upper_bound': (CARB_VCO2 * vco2_hi - CARB_VO2 * vo2_lo) * DAY_SCALE,
+    }
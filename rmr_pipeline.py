@@ -0,0 +1,145 @@
+"""
+One-shot RMR processing pipeline
+Runs units-row removal, warm-up trimming, steady-state selection and
+column extraction over a single parsed in-memory table
+"""
+
+import csv
+import io
+import logging
+import time
+
+from rmr_engine import RmrInputError, parse_rmr_rows
+from time_index import TimeIndex
+
+logger = logging.getLogger(__name__)
+
+
+class RmrTable:
+    """Parsed CSV held in memory while it moves through the pipeline stages."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @classmethod
+    def from_csv(cls, csv_data):
+        return cls(list(csv.reader(io.StringIO(csv_data))))
+
+    @property
+    def header(self):
+        return self.rows[0] if self.rows else []
+
+    def to_csv(self):
+        output = io.StringIO()
+        csv.writer(output).writerows(self.rows)
+        return output.getvalue()
+
+    def time_column(self):
+        """Index of the Time column (case-insensitive), or -1 if absent."""
+        for i, header in enumerate(self.header):
+            if header.lower() == 'time':
+                return i
+        return -1
+
+    def time_index(self):
+        """TimeIndex over the data rows' Time cells, or None without a Time column."""
+        time_col_idx = self.time_column()
+        if time_col_idx == -1:
+            return None
+        return TimeIndex.from_cells([row[time_col_idx] if len(row) > time_col_idx else ''
+                                     for row in self.rows[1:]])
+
+
+def _filter_time(table, start=None, end=None):
+    """Keep the header plus data rows with start <= time < end (seconds)."""
+    index = table.time_index()
+    if index is None:
+        logger.warning("Time column not found, skipping time-based removal")
+        return table
+
+    data_rows = table.rows[1:]
+    return RmrTable([table.header] + [data_rows[i] for i in index.select(start, end)])
+
+
+def strip_units_row(table, options=None):
+    """Remove row 2 (units row)."""
+    if len(table.rows) < 3:  # Need header + units + at least one data row
+        logger.error(f"CSV has insufficient rows: {len(table.rows)}")
+        return table
+    return RmrTable([table.rows[0]] + table.rows[2:])
+
+
+def trim_warmup(table, options=None):
+    """Remove the first minutesToRemove minutes of data (fractional minutes allowed)."""
+    minutes_to_remove = (options or {}).get('minutesToRemove', 0) or 0
+    if minutes_to_remove <= 0 or len(table.rows) < 2:
+        return table
+    return _filter_time(table, start=minutes_to_remove * 60)
+
+
+def select_steady_state(table, options=None):
+    """Restrict the data to an explicit [startMinute, endMinute) window."""
+    window = (options or {}).get('steadyState') or {}
+    start = window.get('startMinute')
+    end = window.get('endMinute')
+    if start is None and end is None:
+        return table
+    return _filter_time(table, start=start * 60 if start is not None else None,
+                        end=end * 60 if end is not None else None)
+
+
+PIPELINE_STAGES = (
+    ('units_row', strip_units_row, 'removeUnitsRow'),
+    ('warmup', trim_warmup, 'trimWarmup'),
+    ('steady_state', select_steady_state, 'selectSteadyState'),
+)
+
+
+def run_rmr_pipeline(csv_data, options=None, diagnostics=False):
+    """
+    Run every processing stage over one parsed table and extract the RMR series
+
+    Args:
+        csv_data (str): Raw metabolic-cart export
+        options (dict, optional): Stage options; each stage can be disabled
+            with its flag (removeUnitsRow, trimWarmup, selectSteadyState)
+        diagnostics (bool, optional): Collect per-stage row counts and timings
+
+    Returns:
+        tuple: (series dict as returned by parse_rmr_rows, list of stage diagnostics)
+    """
+    options = options or {}
+    stage_log = []
+
+    started = time.perf_counter()
+    table = RmrTable.from_csv(csv_data)
+    if diagnostics:
+        stage_log.append(_stage_entry('parse', 0, len(table.rows), started))
+
+    for name, stage, flag in PIPELINE_STAGES:
+        if not options.get(flag, True):
+            continue
+        started = time.perf_counter()
+        rows_in = len(table.rows)
+        table = stage(table, options)
+        if diagnostics:
+            stage_log.append(_stage_entry(name, rows_in, len(table.rows), started))
+
+    if len(table.rows) < 2:
+        raise RmrInputError('CSV file has insufficient data')
+
+    started = time.perf_counter()
+    series = parse_rmr_rows(table.rows)
+    if diagnostics:
+        stage_log.append(_stage_entry('stats_input', len(table.rows), len(series['vo2']), started))
+
+    return series, stage_log
+
+
+def _stage_entry(name, rows_in, rows_out, started):
+    return {
+        'stage': name,
+        'rows_in': rows_in,
+        'rows_out': rows_out,
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 3),
+    }
@@ -0,0 +1,187 @@
+"""
+RMR prediction equations
+Cunningham, Mifflin-St Jeor and revised Harris-Benedict predictions
+evaluated for whole arrays of clients at once with NumPy sex masks
+"""
+
+import logging
+
+import numpy as np
+
+from sqlalchemy import bindparam, select, update
+
+from body_composition import float_array, male_mask
+from cohort_analytics import invalidate_cohort_cache
+from models import db, Client
+
+logger = logging.getLogger(__name__)
+
+# Defaults when height or lean body mass is not known, as (male, female)
+DEFAULT_HEIGHT_CM = (170, 160)
+DEFAULT_LBM_FRACTION = (0.85, 0.75)
+
+# Cunningham: 500 + 22 * LBM
+CUNNINGHAM = (500, 22)
+# Mifflin-St Jeor: 10 * weight + 6.25 * height - 5 * age + s, s = +5 (male) / -161 (female)
+MIFFLIN = (10, 6.25, 5, (5, -161))
+# Revised Harris-Benedict: a + b * weight + c * height - d * age, as (male, female)
+HARRIS_BENEDICT = (
+    (88.362, 13.397, 4.799, 5.677),
+    (447.593, 9.247, 3.098, 4.330),
+)
+
+
+def predict_rmr(age, male, weight_kg, height_cm=None, lean_body_mass=None, valid=None):
+    """
+    Evaluate every prediction equation for arrays of clients
+
+    Missing heights (NaN) fall back to DEFAULT_HEIGHT_CM and missing lean body
+    mass to DEFAULT_LBM_FRACTION of body weight. Clients outside the valid
+    mask get 0 for every prediction, as a single client without age, gender
+    or weight always has.
+
+    Args:
+        age (ndarray): Age in years (truncated to whole years)
+        male (ndarray): Boolean sex mask (see male_mask)
+        weight_kg (ndarray): Body weight in kg
+        height_cm (ndarray, optional): Height in cm
+        lean_body_mass (ndarray, optional): Lean body mass in kg
+        valid (ndarray, optional): Clients to predict; defaults to those with
+            age, weight and a gender
+
+    Returns:
+        dict: cunningham_rmr, mifflin_rmr, harris_benedict_rmr and their mean predicted_rmr
+    """
+    n = len(age)
+    if valid is None:
+        valid = (np.nan_to_num(age) != 0) & (np.nan_to_num(weight_kg) != 0)
+    age = np.trunc(np.nan_to_num(age))
+    weight_kg = np.nan_to_num(weight_kg)
+
+    height_cm = np.full(n, np.nan) if height_cm is None else height_cm
+    height_cm = np.where(np.isnan(height_cm), np.where(male, *DEFAULT_HEIGHT_CM), height_cm)
+    lean_body_mass = np.full(n, np.nan) if lean_body_mass is None else lean_body_mass
+    lean_body_mass = np.where(np.isnan(lean_body_mass),
+                              weight_kg * np.where(male, *DEFAULT_LBM_FRACTION), lean_body_mass)
+
+    cunningham = CUNNINGHAM[0] + (CUNNINGHAM[1] * lean_body_mass)
+
+    w, h, a, (s_male, s_female) = MIFFLIN
+    mifflin = (w * weight_kg) + (h * height_cm) - (a * age) + np.where(male, s_male, s_female)
+
+    hb = np.where(male[:, None], HARRIS_BENEDICT[0], HARRIS_BENEDICT[1])
+    harris_benedict = hb[:, 0] + (hb[:, 1] * weight_kg) + (hb[:, 2] * height_cm) - (hb[:, 3] * age)
+
+    predictions = {
+        'cunningham_rmr': cunningham,
+        'mifflin_rmr': mifflin,
+        'harris_benedict_rmr': harris_benedict,
+    }
+    predictions['predicted_rmr'] = (cunningham + mifflin + harris_benedict) / 3
+    return {name: np.where(valid, values, 0.0) for name, values in predictions.items()}
+
+
+def percent_predicted(measured_rmr, predicted_rmr):
+    """Measured RMR as a percentage of predicted (0 where there is no prediction or measurement)."""
+    measured_rmr = np.nan_to_num(measured_rmr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(predicted_rmr > 0, (measured_rmr / predicted_rmr) * 100, 0.0)
+
+
+def record_inputs(records):
+    """
+    predict_rmr arguments from client records (age, gender, weight_kg, height_cm, lean_body_mass)
+    """
+    genders = [r.get('gender') for r in records]
+    return {
+        'age': float_array([r.get('age') for r in records]),
+        'male': male_mask(genders),
+        'weight_kg': float_array([r.get('weight_kg') for r in records]),
+        'height_cm': float_array([r.get('height_cm') for r in records]),
+        'lean_body_mass': float_array([r.get('lean_body_mass') for r in records]),
+        'valid': np.array([bool(r.get('age') and r.get('gender') and r.get('weight_kg')) for r in records],
+                          dtype=bool),
+    }
+
+
+def predict_records(records):
+    """
+    Predictions for a list of client records
+
+    Returns:
+        list: One dict of float predictions per record, plus rmr_percent_predicted
+            when the record has a measured rmr_kcal_day
+    """
+    predictions = predict_rmr(**record_inputs(records))
+    measured = float_array([r.get('rmr_kcal_day') for r in records])
+    percent = percent_predicted(measured, predictions['predicted_rmr'])
+
+    results = []
+    for i, record in enumerate(records):
+        row = {name: float(values[i]) for name, values in predictions.items()}
+        if record.get('rmr_kcal_day') is not None:
+            row['rmr_percent_predicted'] = float(percent[i])
+        if 'id' in record:
+            row['id'] = record['id']
+        results.append(row)
+    return results
+
+
+def backfill_client_predictions(client_ids=None, dry_run=False):
+    """
+    Recompute predicted_rmr and rmr_percent_predicted for stored clients in one pass
+
+    Uses each client's age, gender, weight, height, lean mass and measured
+    rmr_kcal_day. As in save_client, a value is NULL rather than 0 where there
+    is no prediction or no measured RMR. Rows are updated with a single
+    executemany; updated_at is left unchanged since the client's own data did
+    not change.
+
+    Args:
+        client_ids (list, optional): Defaults to every client
+        dry_run (bool, optional): Compute without writing
+
+    Returns:
+        int: Number of clients whose predictions changed
+    """
+    table = Client.__table__
+    query = select(table.c.id, table.c.age, table.c.gender, table.c.weight_kg, table.c.height_cm,
+                   table.c.lean_mass_kg, table.c.rmr_kcal_day, table.c.predicted_rmr,
+                   table.c.rmr_percent_predicted)
+    if client_ids:
+        query = query.where(table.c.id.in_(client_ids))
+    rows = db.session.execute(query).all()
+    if not rows:
+        return 0
+
+    records = [{
+        'age': row.age, 'gender': row.gender, 'weight_kg': row.weight_kg, 'height_cm': row.height_cm,
+        'lean_body_mass': row.lean_mass_kg,
+    } for row in rows]
+    inputs = record_inputs(records)
+    predictions = predict_rmr(**inputs)
+    predicted = np.round(predictions['predicted_rmr'], 2)
+    measured = float_array([row.rmr_kcal_day for row in rows])
+    percent = np.round(percent_predicted(measured, predictions['predicted_rmr']), 2)
+
+    # NULL, as save_client stores, where there is no prediction or no measured RMR
+    changes = []
+    for i, row in enumerate(rows):
+        new_predicted = float(predicted[i]) if inputs['valid'][i] else None
+        new_percent = float(percent[i]) if new_predicted and row.rmr_kcal_day else None
+        if row.predicted_rmr != new_predicted or row.rmr_percent_predicted != new_percent:
+            changes.append({'b_id': row.id, 'b_predicted': new_predicted, 'b_percent': new_percent})
+    if changes and not dry_run:
+        db.session.execute(
+            update(table).where(table.c.id == bindparam('b_id')).values(
+                predicted_rmr=bindparam('b_predicted'),
+                rmr_percent_predicted=bindparam('b_percent'),
+                updated_at=table.c.updated_at,
+            ),
+            changes,
+        )
+        db.session.commit()
+        # Core updates bypass the ORM events that normally clear the cohort cache
+        invalidate_cohort_cache()
+    logger.info(f"RMR predictions changed for {len(changes)} of {len(rows)} clients")
+    return len(changes)
@@ -0,0 +1,212 @@
+"""
+Longitudinal RMR and body composition trends
+Keeps one TestSummary row of precomputed aggregates per client and test
+date, updated as tests are saved, so trends never touch the raw series
+"""
+
+import logging
+
+import numpy as np
+from sqlalchemy import select
+
+from models import db, Client, RmrSession, TestSummary
+from rmr_engine import compute_rmr_stats
+from series_store import unpack_series
+
+logger = logging.getLogger(__name__)
+
+# Fields of a calculate-rmr result stored when no raw series is available
+RESULT_FIELDS = {
+    'rmr_kcal_day': 'rmr_kcal_day',
+    'vo2_mean': 'vo2_avg',
+    'vco2_mean': 'vco2_avg',
+    'rer_mean': 'rer_avg',
+    'predicted_rmr': 'predicted_rmr',
+    'rmr_percent_predicted': 'rmr_percent_predicted',
+    'fat_oxidation': 'fat_oxidation',
+    'carb_oxidation': 'carb_oxidation',
+}
+BODY_COMPOSITION_FIELDS = ('weight_kg', 'body_fat_percent', 'fat_mass_kg', 'lean_mass_kg')
+
+
+def _optional_float(value):
+    return float(value) if value not in (None, '') else None
+
+
+def series_aggregates(columns):
+    """
+    Session aggregates from raw signal columns
+
+    Args:
+        columns (dict): 'vo2_ml_min', 'vco2_ml_min' and 'rer' arrays (NaN for blanks),
+            as returned by raw_points_to_columns or stored in an RmrSession
+
+    Returns:
+        dict: TestSummary RMR fields, or {} if no sample has all three signals
+    """
+    vo2 = np.asarray(columns.get('vo2_ml_min', ()), dtype=np.float64)
+    vco2 = np.asarray(columns.get('vco2_ml_min', ()), dtype=np.float64)
+    rer = np.asarray(columns.get('rer', ()), dtype=np.float64)
+    if not (len(vo2) == len(vco2) == len(rer)) or not len(vo2):
+        return {}
+    complete = ~(np.isnan(vo2) | np.isnan(vco2) | np.isnan(rer))
+    if not complete.any():
+        return {}
+
+    stats = compute_rmr_stats(vo2[complete], vco2[complete], rer[complete])
+    return {
+        'sample_count': int(stats['sample_size']),
+        'rmr_kcal_day': round(float(stats['rmr_kcal_day']), 2),
+        'rmr_ci_lower': round(float(stats['rmr_lower_bound']), 2),
+        'rmr_ci_upper': round(float(stats['rmr_upper_bound']), 2),
+        'vo2_mean': round(float(stats['vo2']['mean']), 2),
+        'vo2_ci_lower': round(float(stats['vo2']['ci_lower']), 2),
+        'vo2_ci_upper': round(float(stats['vo2']['ci_upper']), 2),
+        'vco2_mean': round(float(stats['vco2']['mean']), 2),
+        'rer_mean': round(float(stats['rer']['mean']), 3),
+        'rer_ci_lower': round(float(stats['rer']['ci_lower']), 3),
+        'rer_ci_upper': round(float(stats['rer']['ci_upper']), 3),
+        'fat_oxidation': round(float(stats['fat_oxidation']), 2),
+        'carb_oxidation': round(float(stats['carb_oxidation']), 2),
+    }
+
+
+def result_aggregates(rmr_results):
+    """TestSummary RMR fields from a calculate-rmr result (means and stats CIs)."""
+    values = {field: _optional_float(rmr_results.get(key)) for field, key in RESULT_FIELDS.items()}
+    stats = rmr_results.get('stats') or {}
+    vo2 = stats.get('vo2') or {}
+    rer = stats.get('rer') or {}
+    rmr = stats.get('rmr') or {}
+    values.update({
+        'sample_count': vo2.get('sample_size'),
+        'rmr_ci_lower': _optional_float(rmr.get('lower_bound_95_ci_kcal_day')),
+        'rmr_ci_upper': _optional_float(rmr.get('upper_bound_95_ci_kcal_day')),
+        'vo2_ci_lower': _optional_float(vo2.get('lower_bound_95_ci')),
+        'vo2_ci_upper': _optional_float(vo2.get('upper_bound_95_ci')),
+        'rer_ci_lower': _optional_float(rer.get('lower_bound_95_ci')),
+        'rer_ci_upper': _optional_float(rer.get('upper_bound_95_ci')),
+    })
+    return values
+
+
+def _missing_only(values, aggregates):
+    """The series aggregates of the fields values has nothing for."""
+    return {name: value for name, value in aggregates.items() if values.get(name) is None}
+
+
+def upsert_test_summary(client_id, test_date, values):
+    """
+    Create or update the TestSummary for (client_id, test_date)
+
+    Runs in the current session transaction; the caller commits. Only the
+    given fields are written, so RMR and body composition saves for the same
+    date update their own columns of one row.
+
+    Returns:
+        TestSummary: The pending summary row
+    """
+    summary = db.session.execute(
+        select(TestSummary).where(TestSummary.client_id == client_id, TestSummary.test_date == test_date)
+    ).scalars().first()
+    if summary is None:
+        summary = TestSummary(client_id=client_id, test_date=test_date)
+        db.session.add(summary)
+    for name, value in values.items():
+        setattr(summary, name, value)
+    return summary
+
+
+def record_rmr_test(client, rmr_results, columns=None):
+    """
+    Update the client's summary for its test date after an RMR save
+
+    Values come from the calculate-rmr result, so the summary agrees with the
+    client's rmr_kcal_day and rmr_percent_predicted; the raw columns, when
+    saved, only fill in what the result lacks (CIs, sample count). They may
+    not be the exact samples the result was computed on (trimmed, a
+    steady-state window or resampled).
+    """
+    values = result_aggregates(rmr_results or {})
+    if columns is not None:
+        values.update(_missing_only(values, series_aggregates(columns)))
+    values['weight_kg'] = client.weight_kg
+    return upsert_test_summary(client.id, client.test_date, values)
+
+
+def record_body_composition(client):
+    """Update the client's summary for its test date after a body composition save."""
+    return upsert_test_summary(client.id, client.test_date,
+                               {name: getattr(client, name) for name in BODY_COMPOSITION_FIELDS})
+
+
+def client_trend(client_id, date_from=None, date_to=None):
+    """
+    A client's longitudinal series from the test summaries, oldest test first
+
+    One query on the (client_id, test_date) unique index.
+
+    Returns:
+        dict: 'test_dates' plus one list per TestSummary.TREND_FIELDS entry
+    """
+    table = TestSummary.__table__
+    query = select(table.c.test_date, *(table.c[name] for name in TestSummary.TREND_FIELDS)) \
+        .where(table.c.client_id == client_id)
+    if date_from:
+        query = query.where(table.c.test_date >= date_from)
+    if date_to:
+        query = query.where(table.c.test_date <= date_to)
+    rows = db.session.execute(query.order_by(table.c.test_date, table.c.id)).all()
+
+    trend = {'test_dates': [row.test_date.strftime('%Y-%m-%d') if row.test_date else None for row in rows]}
+    for name in TestSummary.TREND_FIELDS:
+        trend[name] = [getattr(row, name) for row in rows]
+    return trend
+
+
+def backfill_test_summaries(client_ids=None):
+    """
+    Rebuild test summaries from stored clients and RMR sessions
+
+    The client's saved RMR results and body composition fill the summary of
+    its current test date; every RmrSession then contributes the aggregates
+    of its packed series, as a save with raw data would (for the current test
+    date only those the saved results lack).
+
+    Args:
+        client_ids (list, optional): Defaults to every client
+
+    Returns:
+        int: Number of summaries written
+    """
+    clients = Client.query
+    sessions = select(RmrSession.__table__).order_by(RmrSession.client_id, RmrSession.id)
+    if client_ids:
+        clients = clients.filter(Client.id.in_(client_ids))
+        sessions = sessions.where(RmrSession.client_id.in_(client_ids))
+
+    written = set()
+    saved = {}
+    for client in clients.all():
+        if client.rmr_kcal_day is None and client.body_fat_percent is None:
+            continue
+        values = {field: getattr(client, key) for field, key in RESULT_FIELDS.items()}
+        values.update({name: getattr(client, name) for name in BODY_COMPOSITION_FIELDS})
+        upsert_test_summary(client.id, client.test_date, values)
+        written.add((client.id, client.test_date))
+        saved[(client.id, client.test_date)] = values
+
+    for row in db.session.execute(sessions).mappings():
+        columns = unpack_series(row['series'], row['signals'].split(','), row['sample_count'],
+                                row['dtype'], row['codec'])
+        aggregates = series_aggregates(columns)
+        key = (row['client_id'], row['test_date'])
+        if key in saved:
+            # The client's saved results win for its own test date, as in record_rmr_test
+            aggregates = _missing_only(saved[key], aggregates)
+        if aggregates:
+            upsert_test_summary(row['client_id'], row['test_date'], aggregates)
+            written.add(key)
+    db.session.commit()
+    logger.info(f"Wrote {len(written)} test summaries")
+    return len(written)
@@ -0,0 +1,187 @@
+"""
+Columnar storage for raw RMR series
+Packs a session's breath-by-breath signals into one contiguous (optionally
+compressed) float array blob so a session loads with a single row fetch
+"""
+
+import zlib
+
+import numpy as np
+from sqlalchemy import select
+
+from models import db, Client, RmrData, RmrSession
+from persistence import RMR_FLOAT_FIELDS
+
+SERIES_DTYPES = ('float32', 'float64')
+SERIES_CODECS = ('zlib', 'raw')
+
+
+def pack_series(columns, dtype='float32', codec='zlib'):
+    """
+    Pack equally long signal arrays into a single blob
+
+    Signals are laid out back to back (signal-major), so each one is a
+    contiguous slice of the decoded buffer.
+
+    Args:
+        columns (dict): Signal name -> 1-D array of values (NaN for missing)
+        dtype (str, optional): 'float32' or 'float64'
+        codec (str, optional): 'zlib' or 'raw'
+
+    Returns:
+        tuple: (blob bytes, list of signal names in blob order, sample count)
+    """
+    if dtype not in SERIES_DTYPES:
+        raise ValueError(f"Unsupported series dtype: {dtype}")
+    if codec not in SERIES_CODECS:
+        raise ValueError(f"Unsupported series codec: {codec}")
+
+    signals = list(columns)
+    lengths = {len(values) for values in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError("All signals in a session must have the same length")
+    n = lengths.pop() if lengths else 0
+
+    packed = np.empty((len(signals), n), dtype=dtype)
+    for i, name in enumerate(signals):
+        packed[i] = columns[name]
+    payload = packed.tobytes()
+    if codec == 'zlib':
+        payload = zlib.compress(payload, 6)
+    return payload, signals, n
+
+
+def unpack_series(blob, signals, sample_count, dtype, codec):
+    """
+    Decode a blob written by pack_series
+
+    The returned arrays are read-only np.frombuffer views over one buffer:
+    no per-signal copies (and no copy at all for the 'raw' codec).
+
+    Returns:
+        dict: Signal name -> 1-D array
+    """
+    buffer = zlib.decompress(blob) if codec == 'zlib' else blob
+    matrix = np.frombuffer(buffer, dtype=dtype).reshape(len(signals), sample_count)
+    return {name: matrix[i] for i, name in enumerate(signals)}
+
+
+def raw_points_to_columns(raw_data):
+    """Turn the raw_data list posted to save_client into float columns (NaN for blanks)."""
+    columns = {}
+    for field in RMR_FLOAT_FIELDS:
+        columns[field] = np.array(
+            [float(point[field]) if point.get(field) else np.nan for point in raw_data],
+            dtype=np.float64
+        )
+    time_points = [point.get('time_point', '') or '' for point in raw_data]
+    return columns, time_points
+
+
+def store_rmr_session(client_id, columns, time_points=None, test_date=None,
+                      dtype='float32', codec='zlib', replace_same_date=True):
+    """
+    Store one RMR session as a packed blob
+
+    Runs in the current session transaction; the caller commits.
+
+    Args:
+        client_id (int): Owning client
+        columns (dict): Signal name -> values
+        time_points (list, optional): Time strings aligned with the values
+        test_date (date, optional): Test date of the session
+        dtype (str, optional): 'float32' (half the size) or 'float64'
+        codec (str, optional): 'zlib' or 'raw'
+        replace_same_date (bool, optional): Drop the client's existing sessions for test_date first
+
+    Returns:
+        RmrSession: The new (flushed) session
+    """
+    blob, signals, n = pack_series(columns, dtype, codec)
+    if replace_same_date:
+        RmrSession.query.filter_by(client_id=client_id, test_date=test_date).delete()
+    session = RmrSession(
+        client_id=client_id,
+        test_date=test_date,
+        sample_count=n,
+        signals=','.join(signals),
+        dtype=dtype,
+        codec=codec,
+        stored_bytes=len(blob),
+        time_points='\n'.join(time_points or []),
+        series=blob,
+    )
+    db.session.add(session)
+    db.session.flush()
+    return session
+
+
+def load_rmr_session(session_id):
+    """
+    Load one session's series with a single row fetch
+
+    Returns:
+        dict or None: header fields plus 'series' (signal -> array) and 'time_points'
+    """
+    table = RmrSession.__table__
+    row = db.session.execute(select(table).where(table.c.id == session_id)).mappings().first()
+    if row is None:
+        return None
+    signals = row['signals'].split(',')
+    return {
+        'id': row['id'],
+        'client_id': row['client_id'],
+        'test_date': row['test_date'],
+        'sample_count': row['sample_count'],
+        'series': unpack_series(row['series'], signals, row['sample_count'], row['dtype'], row['codec']),
+        'time_points': row['time_points'].split('\n') if row['time_points'] else [],
+    }
+
+
+def convert_rmr_data(client_ids=None, dtype='float32', codec='zlib', delete_rows=False):
+    """
+    Convert existing per-point RmrData rows into one RmrSession per client
+
+    Args:
+        client_ids (list, optional): Limit the conversion to these clients
+        dtype (str, optional): Stored float width
+        codec (str, optional): 'zlib' or 'raw'
+        delete_rows (bool, optional): Remove the converted RmrData rows
+
+    Returns:
+        int: Number of sessions written
+    """
+    table = RmrData.__table__
+    query = select(table.c.client_id).distinct()
+    if client_ids:
+        query = query.where(table.c.client_id.in_(client_ids))
+    converted = 0
+    for client_id in db.session.execute(query).scalars().all():
+        rows = db.session.execute(
+            select(table.c.time_point, *[table.c[f] for f in RMR_FLOAT_FIELDS])
+            .where(table.c.client_id == client_id)
+            .order_by(table.c.id)
+        ).all()
+        columns = {
+            field: np.array([np.nan if r[i + 1] is None else r[i + 1] for r in rows], dtype=np.float64)
+            for i, field in enumerate(RMR_FLOAT_FIELDS)
+        }
+        test_date = db.session.execute(
+            select(Client.__table__.c.test_date).where(Client.__table__.c.id == client_id)
+        ).scalar()
+        store_rmr_session(client_id, columns, [r[0] or '' for r in rows], test_date, dtype, codec)
+        if delete_rows:
+            RmrData.query.filter_by(client_id=client_id).delete()
+        db.session.commit()
+        converted += 1
+    return converted
+
+
+def series_to_json(series, time_points):
+    """Chart-friendly lists for a decoded session (NaN becomes None)."""
+    data = {}
+    for name, values in series.items():
+        values = values.astype(np.float64)
+        data[name] = [None if v != v else round(v, 4) for v in values.tolist()]
+    data['time_points'] = time_points
+    return data
@@ -0,0 +1,141 @@
+"""
+Steady-state window detection for RMR tests
+Rolling mean/std/CV of VO2, VCO2 and RER over every time window in O(n)
+from cumulative sums, and selection of the lowest-CV steady-state window
+"""
+
+import numpy as np
+
+from rmr_engine import DAY_SCALE, WEIR_VCO2, WEIR_VO2
+from time_index import TimeIndex, format_time
+
+DEFAULT_WINDOW_SECONDS = 300
+# Steady-state criteria: coefficient of variation limits in percent
+MAX_VO2_CV = 10.0
+MAX_VCO2_CV = 10.0
+MAX_RER_CV = 5.0
+# Minimum samples for a window to count
+MIN_WINDOW_SAMPLES = 5
+# Assumed sample spacing when the time column cannot be parsed
+FALLBACK_SAMPLE_SECONDS = 5.0
+
+
+def window_bounds(index, window_seconds):
+    """
+    Start/stop indexes of every full window [t_i, t_i + window_seconds)
+
+    Args:
+        index (TimeIndex): Monotonic sample times
+        window_seconds (float): Window length
+
+    Returns:
+        tuple: (starts, stops) index arrays; stop is exclusive
+    """
+    seconds = index.seconds
+    stops = index.window_stops(window_seconds)
+    # Only windows that are fully covered by the recording
+    full = seconds + window_seconds <= seconds[-1] + _sample_interval(seconds)
+    starts = np.nonzero(full)[0]
+    return starts, stops[starts]
+
+
+def _sample_interval(seconds):
+    return float(np.median(np.diff(seconds))) if len(seconds) > 1 else 0.0
+
+
+def rolling_stats(signals, starts, stops):
+    """
+    Mean, std and CV of each signal over [start, stop) windows via cumulative sums
+
+    Signals are centred on their overall mean before accumulating so the
+    sum-of-squares variance does not lose precision.
+
+    Args:
+        signals (ndarray): 2-D array, one signal per row
+        starts (ndarray): Window start indexes
+        stops (ndarray): Window stop indexes (exclusive)
+
+    Returns:
+        dict: 'n' sample counts and 'mean', 'std', 'cv' arrays of shape (signals, windows)
+    """
+    offset = signals.mean(axis=1, keepdims=True)
+    centered = signals - offset
+    zeros = np.zeros((signals.shape[0], 1))
+    csum = np.concatenate((zeros, np.cumsum(centered, axis=1)), axis=1)
+    csq = np.concatenate((zeros, np.cumsum(centered * centered, axis=1)), axis=1)
+
+    n = (stops - starts).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_c = (csum[:, stops] - csum[:, starts]) / n
+        var = (csq[:, stops] - csq[:, starts]) / n - mean_c * mean_c
+        std = np.sqrt(np.maximum(var, 0.0))
+        mean = mean_c + offset
+        cv = np.where(mean != 0, std / mean * 100, np.inf)
+    return {'n': n, 'mean': mean, 'std': std, 'cv': cv}
+
+
+def detect_steady_state(vo2, vco2, rer, seconds=None, window_seconds=DEFAULT_WINDOW_SECONDS,
+                        max_vo2_cv=MAX_VO2_CV, max_vco2_cv=MAX_VCO2_CV, max_rer_cv=MAX_RER_CV):
+    """
+    Find the window with the lowest VO2/VCO2 CV
+
+    Every window of window_seconds starting at a sample is scored by the
+    mean of its VO2 and VCO2 CVs; windows meeting all CV limits are
+    preferred over those that do not.
+
+    Args:
+        vo2 (ndarray): VO2 in ml/min
+        vco2 (ndarray): VCO2 in ml/min
+        rer (ndarray): Respiratory exchange ratio
+        seconds (ndarray, optional): Sample times in seconds (see time_index); without
+            a complete, sorted time column samples are assumed FALLBACK_SAMPLE_SECONDS apart
+        window_seconds (float, optional): Window length
+        max_vo2_cv (float, optional): VO2 CV limit in percent
+        max_vco2_cv (float, optional): VCO2 CV limit in percent
+        max_rer_cv (float, optional): RER CV limit in percent
+
+    Returns:
+        dict or None: Best window (indexes, times, means, CVs, Weir RMR and whether
+            it meets the criteria), or None if the test is shorter than one window
+    """
+    n = len(vo2)
+    if n < MIN_WINDOW_SAMPLES:
+        return None
+    index = TimeIndex(seconds) if seconds is not None and len(seconds) == n else None
+    if index is None or not index.monotonic:
+        index = TimeIndex(np.arange(n, dtype=np.float64) * FALLBACK_SAMPLE_SECONDS)
+    seconds = index.seconds
+
+    starts, stops = window_bounds(index, window_seconds)
+    enough = stops - starts >= MIN_WINDOW_SAMPLES
+    starts, stops = starts[enough], stops[enough]
+    if len(starts) == 0:
+        return None
+
+    stats = rolling_stats(np.vstack((vo2, vco2, rer)), starts, stops)
+    vo2_cv, vco2_cv, rer_cv = stats['cv']
+    score = (vo2_cv + vco2_cv) / 2
+    meets = (vo2_cv < max_vo2_cv) & (vco2_cv < max_vco2_cv) & (rer_cv < max_rer_cv)
+    best = int(np.argmin(np.where(meets, score, score + 1e9)))
+
+    start, stop = int(starts[best]), int(stops[best])
+    avg_vo2, avg_vco2, avg_rer = stats['mean'][:, best]
+    return {
+        'start_index': start,
+        'end_index': stop - 1,
+        'start_seconds': float(seconds[start]),
+        'end_seconds': float(seconds[stop - 1]),
+        'start_time': format_time(seconds[start]),
+        'end_time': format_time(seconds[stop - 1]),
+        'sample_size': stop - start,
+        'window_seconds': window_seconds,
+        'vo2_avg': round(float(avg_vo2), 2),
+        'vco2_avg': round(float(avg_vco2), 2),
+        'rer_avg': round(float(avg_rer), 3),
+        'vo2_cv': round(float(vo2_cv[best]), 2),
+        'vco2_cv': round(float(vco2_cv[best]), 2),
+        'rer_cv': round(float(rer_cv[best]), 2),
+        'rmr_kcal_day': round(float((WEIR_VO2 * avg_vo2 + WEIR_VCO2 * avg_vco2) * DAY_SCALE), 2),
+        'meets_criteria': bool(meets[best]),
+        'windows_evaluated': int(len(starts)),
+    }